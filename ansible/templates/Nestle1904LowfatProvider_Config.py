@@ -3,4 +3,6 @@ basex = {
     'port': 1984,
     'username': '{{ basex_server_username }}',
     'password': '{{ basex_server_password }}',
-}
\ No newline at end of file
+}
+
+xml_path = '{{ basex_data_abs_dir }}/nlf/repo/syntax-trees/nestle1904-lowfat/xml/nestle1904lowfat.xml'
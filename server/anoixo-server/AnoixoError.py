@@ -1,4 +1,6 @@
 import abc
+from http import HTTPStatus
+from typing import Dict
 
 
 class AnoixoError(Exception, abc.ABC):
@@ -10,6 +12,13 @@ class AnoixoError(Exception, abc.ABC):
     def get_friendly_error_message(self) -> str:
         pass
 
+    def serialize(self) -> Dict[str, str]:
+        return {
+            'error': HTTPStatus(self.http_error_code).phrase,
+            'description': self.message,
+            'friendlyErrorMessage': self.get_friendly_error_message()
+        }
+
 
 class ProbableBugError(AnoixoError):
     def get_friendly_error_message(self) -> str:
@@ -24,3 +33,19 @@ class ServerOverwhelmedError(AnoixoError):
 class TooManyRequestsError(AnoixoError):
     def get_friendly_error_message(self) -> str:
         return 'You\'ve made too many searches in too short a period of time. Try your search again later.'
+
+
+class QueryTimeoutError(AnoixoError):
+    def __init__(self, message: str, http_error_code: int = 504):
+        super().__init__(message, http_error_code)
+
+    def get_friendly_error_message(self) -> str:
+        return 'Your search took too long to run. Try making it more specific, or try again later.'
+
+
+class QueryTooExpensiveError(AnoixoError):
+    def __init__(self, message: str, http_error_code: int = 422):
+        super().__init__(message, http_error_code)
+
+    def get_friendly_error_message(self) -> str:
+        return 'Your search would take too long to run. Try making it more specific.'
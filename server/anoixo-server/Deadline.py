@@ -0,0 +1,32 @@
+import time
+from AnoixoError import QueryTimeoutError
+
+
+class Deadline:
+    """
+    The time by which a request has to be answered. It's shared by every stage of handling the request (querying the
+    text, then fetching translations), so each stage only gets whatever time the earlier ones left.
+    """
+
+    def __init__(self, budget: float):
+        """
+        :param budget: How many seconds the request has, starting now
+        """
+        self.budget = budget
+        self._expires_at = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        """
+        :return: How many seconds are left, or 0 if the deadline has passed
+        """
+        return max(0.0, self._expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self._expires_at
+
+    def check(self) -> None:
+        """
+        Raises a QueryTimeoutError if the deadline has passed
+        """
+        if self.expired():
+            raise QueryTimeoutError(f'Request exceeded its time budget of {self.budget} seconds')
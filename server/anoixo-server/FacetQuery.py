@@ -0,0 +1,42 @@
+import json
+from typing import Any, Callable, List
+from TextQuery import TextQuery
+
+
+class FacetQuery:
+    """
+    Asks how often each value of some attributes occurs among the words matching one word query of a text query, over
+    every match of the text query
+    """
+
+    def __init__(self, json: Any, on_parsing_error: Callable[[str], Any]):
+        if not isinstance(json, dict):
+            on_parsing_error('Facet query is not a dictionary')
+        if not isinstance(json.get('query'), dict):
+            on_parsing_error('Facet query does not contain a dictionary \'query\'')
+        self.text_query = TextQuery(json['query'], on_parsing_error)
+
+        if not (isinstance(json.get('sequence'), int) and 0 <= json['sequence'] < len(self.text_query.sequences)):
+            on_parsing_error('\'sequence\' is not the index of a sequence in the query')
+        self.sequence_index: int = json['sequence']
+        word_queries = self.text_query.sequences[self.sequence_index].word_queries
+        if not (isinstance(json.get('wordQuery'), int) and 0 <= json['wordQuery'] < len(word_queries)):
+            on_parsing_error('\'wordQuery\' is not the index of a word query in the sequence')
+        self.word_query_index: int = json['wordQuery']
+
+        if not (isinstance(json.get('attributes'), list) and json['attributes'] and
+                all(isinstance(attribute, str) for attribute in json['attributes'])):
+            on_parsing_error('\'attributes\' is not a list of attribute names')
+        # duplicates would be counted twice over
+        self.attributes: List[str] = list(dict.fromkeys(json['attributes']))
+
+    def __repr__(self):
+        return f'{{query: {self.text_query}, sequence: {self.sequence_index}, word_query: {self.word_query_index}, ' \
+               f'attributes: {self.attributes}}}'
+
+    def canonical_key(self) -> str:
+        """
+        Builds a string identifying the counts this facet query will find, like TextQuery.canonical_key
+        """
+        return json.dumps([self.text_query.canonical_key(), self.sequence_index, self.word_query_index,
+                           sorted(self.attributes)], ensure_ascii=False, separators=(',', ':'))
@@ -0,0 +1,198 @@
+import atexit
+from collections import defaultdict
+from contextlib import contextmanager
+import re
+import sqlite3
+import threading
+import time
+from typing import Callable, DefaultDict, Dict, Iterator, List, Optional, Tuple
+from per_process import BackgroundThread, SqliteConnections
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # seconds
+SIZE_BUCKETS = (1_000, 10_000, 100_000, 1_000_000, 10_000_000)  # bytes
+
+# Every metric, with its Prometheus type and help text, and its buckets if it's a histogram
+METRICS: Dict[str, Tuple[str, str, Tuple[float, ...]]] = {
+    'anoixo_request_seconds': ('histogram', 'Time spent handling requests, in total and in each stage, by endpoint',
+                               LATENCY_BUCKETS),
+    'anoixo_basex_query_seconds': ('histogram', 'Time BaseX took to run a query, including retries', LATENCY_BUCKETS),
+    'anoixo_basex_result_bytes': ('histogram', 'Size of the results BaseX sent back for a query', SIZE_BUCKETS),
+    'anoixo_basex_retries_total': ('counter', 'BaseX queries run again after an error', ()),
+    'anoixo_result_processing_seconds': ('histogram', 'Time spent turning BaseX results into responses',
+                                         LATENCY_BUCKETS),
+    'anoixo_esv_request_seconds': ('histogram', 'Time the ESV API took to send the translations for a search',
+                                   LATENCY_BUCKETS),
+    'anoixo_errors_total': ('counter', 'Errors returned to clients, by type', ()),
+    'anoixo_admission_total': ('counter', 'Queries admitted to the database, shed or timed out waiting, by line', ()),
+    'anoixo_admission_wait_seconds': ('histogram', 'Time queries waited in line for the database, by line',
+                                      LATENCY_BUCKETS),
+    'anoixo_admission_queries': ('gauge', 'Queries running on the database and waiting in each line', ()),
+}
+
+# A sample's name (like anoixo_basex_query_seconds_bucket) and its labels, formatted like `le="0.1",stage="query"`
+Sample = Tuple[str, str]
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    def escape(value: str) -> str:
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{name}="{escape(str(value))}"' for name, value in sorted(labels.items()))
+
+
+def _format_bound(bound: float) -> str:
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+def _sort_key(sample: Sample) -> Tuple[str, str, float]:
+    # Buckets go in order of their bounds, after the other labels
+    (name, labels) = sample
+    bound = re.search(r'(?:^|,)le="([^"]*)"', labels)
+    return name, re.sub(r'(?:^|,)le="[^"]*"', '', labels), float(bound.group(1)) if bound else 0.0
+
+
+class Metrics:
+    """
+    Counters and latency/size histograms for the Prometheus metrics endpoint.
+
+    Each worker process adds up what it records in memory. Given a path, a background thread adds those totals into an
+    SQLite database there every FLUSH_INTERVAL seconds, so that whichever worker answers a scrape reports the numbers
+    for every worker on the host. Without a path, each worker only reports its own numbers. Gauges can't be added up
+    like that, so they're read when the metrics are rendered instead (see add_gauge).
+    """
+
+    FLUSH_INTERVAL = 5  # seconds
+    # How long to wait on another worker's write lock before trying again at the next flush
+    BUSY_TIMEOUT = 1  # seconds
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        # with a path, what's been recorded since the last flush; otherwise, everything recorded
+        self._values: DefaultDict[Sample, float] = defaultdict(float)
+        self._flusher = BackgroundThread(self._flush_periodically, 'metrics-flush')
+        self._gauges: Dict[str, Callable[[], List[Tuple[Dict[str, str], float]]]] = {}
+
+        if path:
+            self._connections = SqliteConnections(path, self.BUSY_TIMEOUT)
+            with self._connections.get() as connection:
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.execute('''
+                    CREATE TABLE IF NOT EXISTS samples (
+                        name TEXT NOT NULL,
+                        labels TEXT NOT NULL,
+                        value REAL NOT NULL,
+                        PRIMARY KEY (name, labels)
+                    )
+                ''')
+            atexit.register(self.flush)
+
+    def _flush_periodically(self) -> None:
+        while True:
+            time.sleep(self.FLUSH_INTERVAL)
+            self.flush()
+
+    def _add(self, samples: List[Tuple[Sample, float]]) -> None:
+        if self.path:
+            self._flusher.ensure_started()
+        with self._lock:
+            for sample, amount in samples:
+                self._values[sample] += amount
+
+    def increment(self, name: str, amount: float = 1, **labels: str) -> None:
+        self._add([((name, _format_labels(labels)), amount)])
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """
+        Records a value in a histogram
+        """
+        # every bucket is recorded, even at 0, since Prometheus expects each histogram to have all of its buckets
+        samples = [((f'{name}_bucket', _format_labels({**labels, 'le': _format_bound(bound)})), int(value <= bound))
+                   for bound in (*METRICS[name][2], float('inf'))]
+        samples.append(((f'{name}_sum', _format_labels(labels)), value))
+        samples.append(((f'{name}_count', _format_labels(labels)), 1))
+        self._add(samples)
+
+    @contextmanager
+    def time(self, name: str, **labels: str) -> Iterator[None]:
+        """
+        Records how long the block takes in a histogram, whether or not it raises
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def add_gauge(self, name: str, read: Callable[[], List[Tuple[Dict[str, str], float]]]) -> None:
+        """
+        :param read: Called whenever the metrics are rendered, to get the gauge's current values, each with its labels
+        """
+        self._gauges[name] = read
+
+    def flush(self) -> None:
+        """
+        Adds what this process recorded since the last flush into the shared database, if there is one
+        """
+        if not self.path:
+            return
+        with self._lock:
+            values = self._values
+            self._values = defaultdict(float)
+        if not values:
+            return
+        try:
+            connection = self._connections.get()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.executemany(
+                    'INSERT INTO samples VALUES (?, ?, ?) '
+                    'ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value',
+                    [(name, labels, value) for ((name, labels), value) in values.items()])
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        except sqlite3.Error:
+            # keep the values for the next flush
+            with self._lock:
+                for sample, value in values.items():
+                    self._values[sample] += value
+
+    def _totals(self) -> Dict[Sample, float]:
+        if not self.path:
+            with self._lock:
+                return dict(self._values)
+        self.flush()
+        try:
+            rows = self._connections.get().execute('SELECT name, labels, value FROM samples').fetchall()
+        except sqlite3.Error:
+            rows = []
+        totals: DefaultDict[Sample, float] = defaultdict(float)
+        for (name, labels, value) in rows:
+            totals[(name, labels)] += value
+        # anything a failed flush left behind
+        with self._lock:
+            for sample, value in self._values.items():
+                totals[sample] += value
+        return totals
+
+    def render(self) -> str:
+        """
+        :return: Every metric in the Prometheus text exposition format
+        """
+        totals = self._totals()
+        for gauge, read in self._gauges.items():
+            for labels, value in read():
+                totals[(gauge, _format_labels(labels))] = value
+        lines: List[str] = []
+        for metric, (metric_type, help_text, _) in METRICS.items():
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} {metric_type}')
+            suffixes = ('_bucket', '_sum', '_count') if metric_type == 'histogram' else ('',)
+            names = {metric + suffix for suffix in suffixes}
+            for sample in sorted((sample for sample in totals if sample[0] in names), key=_sort_key):
+                (name, labels) = sample
+                value = totals[sample]
+                formatted_value = str(int(value)) if value == int(value) else repr(value)
+                lines.append(f'{name}{{{labels}}} {formatted_value}' if labels else f'{name} {formatted_value}')
+        return '\n'.join(lines) + '\n'
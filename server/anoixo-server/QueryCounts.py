@@ -0,0 +1,100 @@
+from typing import Any, Callable, Dict, List, Optional
+from QueryResult import Reference
+
+
+class ChapterCount:
+    def __init__(self, chapter: int, count: int):
+        self.chapter = chapter
+        self.count = count
+
+    def serialize(self) -> Dict[str, int]:
+        return {'chapter': self.chapter, 'count': self.count}
+
+
+class BookCount:
+    def __init__(self, book: str):
+        self.book = book
+        self.count = 0
+        self.chapters: List[ChapterCount] = []
+
+    def serialize(self) -> Dict[str, Any]:
+        return {'book': self.book, 'count': self.count,
+                'chapters': [chapter.serialize() for chapter in self.chapters]}
+
+
+class QueryCounts:
+    """
+    How many passages matched a query, in total and in each book and chapter, without the passages themselves
+    """
+
+    def __init__(self, json: Any, on_parsing_error: Callable[[str], Any], query_info: Optional[Dict[str, Any]] = None):
+        """
+        :param json: A list with an entry for each chapter with matches, in text order: a list of the reference of a
+        passage in the chapter (like 'Matt.1.1') and how many passages in the chapter matched. A passage spanning
+        several chapters counts toward the chapter of its first reference.
+        :param query_info: Extra information about how the query was run, like its estimated cost
+        """
+        self.query_info = query_info
+        if not isinstance(json, list):
+            on_parsing_error('Counts are not a list')
+        self.total = 0
+        self.books: List[BookCount] = []
+        for entry in json:
+            if not (isinstance(entry, list) and len(entry) == 2 and isinstance(entry[1], int)):
+                on_parsing_error('Count is not a reference and a number')
+            reference = Reference(entry[0], on_parsing_error)
+            if not self.books or self.books[-1].book != reference.book:
+                self.books.append(BookCount(reference.book))
+            book = self.books[-1]
+            book.chapters.append(ChapterCount(reference.chapter, entry[1]))
+            book.count += entry[1]
+            self.total += entry[1]
+
+    def __repr__(self):
+        return f'{self.serialize()}'
+
+    def serialize(self) -> Dict[str, Any]:
+        serialized = {
+            'totalResults': self.total,
+            'books': [book.serialize() for book in self.books],
+        }
+        if self.query_info is not None:
+            serialized['queryInfo'] = self.query_info
+        return serialized
+
+
+class FacetCounts:
+    """
+    How often each value of some attributes occurs among the words matching a FacetQuery's word query
+    """
+
+    def __init__(self, json: Any, on_parsing_error: Callable[[str], Any], query_info: Optional[Dict[str, Any]] = None):
+        """
+        :param json: A dictionary with how many words matched ('totalWords'), and for each attribute, a dictionary from
+        each of its values to how many of those words have it ('attributes'). Words without the attribute aren't counted
+        under it.
+        :param query_info: Extra information about how the query was run, like its estimated cost
+        """
+        self.query_info = query_info
+        if not (isinstance(json, dict) and isinstance(json.get('totalWords'), int) and
+                isinstance(json.get('attributes'), dict)):
+            on_parsing_error('Facet counts are not a dictionary with a total word count and counts for each attribute')
+        self.total_words: int = json['totalWords']
+        self.attributes: Dict[str, Dict[str, int]] = {}
+        for attribute, value_counts in json['attributes'].items():
+            if not (isinstance(value_counts, dict) and all(isinstance(count, int) for count in value_counts.values())):
+                on_parsing_error(f'Counts for attribute \'{attribute}\' are not a dictionary of numbers')
+            # most common values first
+            self.attributes[attribute] = dict(sorted(value_counts.items(), key=lambda item: (-item[1], item[0])))
+
+    def __repr__(self):
+        return f'{self.serialize()}'
+
+    def serialize(self) -> Dict[str, Any]:
+        serialized = {
+            'totalWords': self.total_words,
+            'attributes': self.attributes,
+        }
+        if self.query_info is not None:
+            serialized['queryInfo'] = self.query_info
+        return serialized
@@ -1,11 +1,17 @@
-from typing import Any, Callable, Dict, List, Union
+from sys import intern
+from typing import Any, Callable, Dict, List, Optional, Union
+
+# Big pages of results hold thousands of these, so they use __slots__ instead of a __dict__ each, and WordResults share
+# one copy of each attribute value through intern()
 
 
 class Reference:
+    __slots__ = ('string_ref', 'book', 'chapter', 'verse')
+
     # Currently only handles strings in Book.Chapter.Verse format. Throws exceptions otherwise
     def _parse_string_ref(self, ref: str):
         parts = ref.split('.')
-        self.book = parts[0]
+        self.book = intern(parts[0])
         self.chapter = int(parts[1])
         self.verse = int(parts[2])
 
@@ -28,6 +34,8 @@ class Reference:
 
 
 class WordResult:
+    __slots__ = ('text', 'matchedSequence', 'matchedWordQuery', 'attributes')
+
     def __init__(self, json: Any, on_parsing_error: Callable[[str], Any]):
         if not isinstance(json, dict):
             on_parsing_error('Word is not a dictionary')
@@ -43,6 +51,10 @@ class WordResult:
         self.matchedSequence = json.pop('matchedSequence')
         self.matchedWordQuery = json.pop('matchedWordQuery')
         self.attributes = json  # any extra attributes in the dictionary
+        # JSON parsers already share one copy of each key within a document, but not of the values
+        for key, value in self.attributes.items():
+            if type(value) is str:
+                self.attributes[key] = intern(value)
 
     def __repr__(self):
         return f'{self.serialize()}'
@@ -54,6 +66,12 @@ class WordResult:
 
 
 class PassageResult:
+    """
+    The words are kept as the dictionaries they were parsed from, and only turned into WordResults when something asks
+    for them, so serializing a passage that nothing changed passes the words through without copying them
+    """
+    __slots__ = ('references', '_word_json', '_words', 'translation')
+
     def __init__(self, json: Any, on_parsing_error: Callable[[str], Any]):
         if not isinstance(json, dict):
             on_parsing_error('Result is not a dictionary')
@@ -64,35 +82,67 @@ class PassageResult:
 
         if not('words' in json and isinstance(json['words'], list)):
             on_parsing_error('Result does not have a list of words')
-        self.words = [WordResult(word, on_parsing_error) for word in json['words']]
+        for word in json['words']:
+            if not (isinstance(word, dict) and 'text' in word and 'matchedSequence' in word and
+                    'matchedWordQuery' in word):
+                # reports what's wrong with the word
+                WordResult(word, on_parsing_error)
+        self._word_json: Optional[List[Dict[str, Any]]] = json['words']
+        self._words: Optional[List[WordResult]] = None
 
         self.translation = ''
 
+    @property
+    def words(self) -> List[WordResult]:
+        if self._words is None:
+            self._words = [WordResult(word, lambda message: None) for word in self._word_json]
+            # the WordResults took the dictionaries apart, and are what's serialized from now on
+            self._word_json = None
+        return self._words
+
     def __repr__(self):
         return f'{self.serialize()}'
 
     def serialize(self) -> Dict[str, List[Dict]]:
         return {'references': [reference.serialize() for reference in self.references],
-                'words': [word.serialize() for word in self.words],
+                'words': self._word_json if self._words is None else [word.serialize() for word in self._words],
                 'translation': self.translation}
 
 
 class QueryResult:
-    def __init__(self, json: Any, page: int, total_pages: int, on_parsing_error: Callable[[str], Any]):
+    __slots__ = ('passages', 'page', 'total_pages', 'result_limit', 'query_info')
+
+    def __init__(self, json: Any, page: int, total_pages: int, on_parsing_error: Callable[[str], Any],
+                 result_limit: Optional[int] = None, query_info: Optional[Dict[str, Any]] = None):
+        """
+        :param result_limit: If there were more results than this and only the first this many were found
+        :param query_info: Extra information about how the query was run, like its estimated cost
+        """
         if not isinstance(json, list):
             on_parsing_error('Results are not a list')
         self.passages: List[PassageResult] = [PassageResult(passage, on_parsing_error) for passage in json]
         self.page = page
         self.total_pages = total_pages
+        self.result_limit = result_limit
+        self.query_info = query_info
 
     def __repr__(self):
         return f'{self.serialize()}'
 
+    def serialize_pagination(self) -> Dict[str, int]:
+        pagination = {
+            'page': self.page,
+            'totalPages': self.total_pages,
+        }
+        if self.result_limit is not None:
+            pagination['resultLimit'] = self.result_limit
+        return pagination
+
     def serialize(self) -> Dict[str, Any]:
-        return {
-            'pagination': {
-                'page': self.page,
-                'totalPages': self.total_pages,
-            },
+        serialized = {
+            'pagination': self.serialize_pagination(),
             'results': [passage.serialize() for passage in self.passages]
         }
+        if self.query_info is not None:
+            serialized['queryInfo'] = self.query_info
+        return serialized
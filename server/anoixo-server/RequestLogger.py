@@ -0,0 +1,111 @@
+import atexit
+from contextlib import contextmanager
+import json
+import queue
+import random
+import sys
+import time
+from typing import Any, Dict, Iterator, List, Optional, TextIO
+import json_codec
+from per_process import BackgroundThread
+
+
+class RequestLog:
+    """
+    What to log about one request, filled in by the handler from what it already has on hand as it goes
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.timings: Dict[str, float] = {}
+        self.fields: Dict[str, Any] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        Times a stage of handling the request, like querying the text or fetching translations. Stages with the same
+        name add up.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+    def add(self, **fields: Any) -> None:
+        self.fields.update(fields)
+
+    def stage_timings(self) -> Dict[str, float]:
+        """
+        :return: How long the request has taken so far, as 'total', and each stage, in seconds
+        """
+        return {'total': time.perf_counter() - self.start, **self.timings}
+
+    def entry(self, **fields: Any) -> Dict[str, Any]:
+        """
+        :return: The log entry for the request, with the given fields, the handler's fields and the timings (in ms)
+        """
+        return {**fields, **self.fields, 'timingsMs': {stage: round(seconds * 1000, 3)
+                                                      for stage, seconds in self.stage_timings().items()}}
+
+
+class RequestLogger:
+    """
+    Writes a JSON line for each request from a background thread, so handlers don't wait on the output, and all the
+    lines that are waiting when the thread gets to them go out in one write.
+
+    Only sample_rate of the requests that succeed are logged, to keep the output down under load. Requests that fail
+    are always logged.
+    """
+
+    def __init__(self, sample_rate: float, stream: Optional[TextIO] = None):
+        """
+        :param stream: Where to write, or None for whatever sys.stdout is at the time
+        """
+        self.sample_rate = sample_rate
+        self.stream = stream
+        self.entries: Optional[queue.Queue] = None
+        self.writer = BackgroundThread(self._write_entries, 'request-log', before_start=self._new_queue)
+        atexit.register(self.flush)
+
+    def _new_queue(self) -> None:
+        # a queue carried across a fork could have been locked by a thread that only exists in the parent
+        self.entries = queue.Queue()
+
+    def _write_entries(self) -> None:
+        entries = self.entries
+        while True:
+            lines: List[bytes] = [entries.get()]
+            while True:
+                try:
+                    lines.append(entries.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                stream = self.stream or sys.stdout
+                stream.write(b''.join(lines).decode())
+                stream.flush()
+            except Exception as err:
+                print(f'[{time.asctime()}] Could not write request log: {type(err).__name__}', file=sys.stderr)
+            finally:
+                for _ in lines:
+                    entries.task_done()
+
+    def log(self, entry: Dict[str, Any], failed: bool = False) -> None:
+        if not failed and random.random() >= self.sample_rate:
+            return
+        self.writer.ensure_started()
+        # Encoding here keeps the entry from changing before the writer gets to it
+        try:
+            line = json_codec.dumps(entry)
+        except TypeError:
+            # orjson can't encode some valid JSON, like numbers too big for 64 bits in a request body
+            line = json.dumps(entry, ensure_ascii=False, default=str).encode()
+        self.entries.put(line + b'\n')
+
+    def flush(self) -> None:
+        """
+        Waits until every entry logged so far in this process has been written
+        """
+        if self.writer.is_running():
+            self.entries.join()
@@ -0,0 +1,84 @@
+import gzip
+from typing import Dict, List, Optional, Tuple
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:
+    # brotli is optional; without it, responses are only gzipped
+    brotli = None
+
+IDENTITY = 'identity'
+
+
+class ResponseCompressor:
+    """
+    Compresses response bodies with the best encoding the client accepts. Bodies smaller than a threshold are sent as
+    they are, since compressing them saves less than it costs.
+    """
+
+    def __init__(self, gzip_level: int, brotli_quality: int, min_size: int):
+        """
+        :param gzip_level: From 1 (fastest) to 9 (smallest)
+        :param brotli_quality: From 0 (fastest) to 11 (smallest)
+        :param min_size: How many bytes a body needs to have before it's compressed
+        """
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.min_size = min_size
+
+    @staticmethod
+    def supported_encodings() -> List[str]:
+        """
+        :return: The encodings this server can compress with, most preferred first
+        """
+        return ['br', 'gzip'] if brotli else ['gzip']
+
+    def choose_encoding(self, accept_encoding: Optional[str], available: Optional[List[str]] = None) -> str:
+        """
+        :param accept_encoding: The request's Accept-Encoding header
+        :param available: The encodings to choose from, if not every supported encoding
+        :return: The encoding the client prefers most among those available, or IDENTITY if it doesn't accept any
+        """
+        accepted = parse_accept_header(accept_encoding)
+        best_encoding = IDENTITY
+        best_quality = 0.0
+        for encoding in available if available is not None else self.supported_encodings():
+            if encoding != IDENTITY and accepted[encoding] > best_quality:
+                best_encoding = encoding
+                best_quality = accepted[encoding]
+        return best_encoding
+
+    def should_compress(self, body: bytes) -> bool:
+        return len(body) >= self.min_size
+
+    def compress(self, body: bytes, encoding: str) -> bytes:
+        if encoding == 'br':
+            return brotli.compress(body, quality=self.brotli_quality)
+        if encoding == 'gzip':
+            # a fixed mtime makes the same body always compress to the same bytes
+            return gzip.compress(body, self.gzip_level, mtime=0)
+        return body
+
+    def compress_for(self, body: bytes, accept_encoding: Optional[str]) -> Tuple[bytes, str]:
+        """
+        :param accept_encoding: The request's Accept-Encoding header
+        :return: The body in the encoding the client prefers, if it's big enough to compress, and that encoding
+        """
+        if not self.should_compress(body):
+            return body, IDENTITY
+        encoding = self.choose_encoding(accept_encoding)
+        return self.compress(body, encoding), encoding
+
+    def compress_all(self, body: bytes) -> Dict[str, bytes]:
+        """
+        Compresses a body that's sent many times once with each supported encoding, at the smallest setting, since the
+        time it takes is only spent once
+        :return: The body in each encoding, including IDENTITY
+        """
+        bodies = {IDENTITY: body}
+        if self.should_compress(body):
+            smallest = ResponseCompressor(9, 11, self.min_size)
+            for encoding in self.supported_encodings():
+                bodies[encoding] = smallest.compress(body, encoding)
+        return bodies
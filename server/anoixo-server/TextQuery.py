@@ -1,3 +1,4 @@
+import json
 from typing import Any, Callable, Dict, Optional, List
 
 
@@ -44,6 +45,16 @@ class WordSequence:
     def __repr__(self):
         return str(self.word_queries)
 
+    def canonical_form(self) -> List[List[Any]]:
+        canonical_word_queries: List[List[Any]] = []
+        for index, word_query in enumerate(self.word_queries):
+            # a link on the last word query has no following word to restrict, so it doesn't affect matches
+            is_last = index == len(self.word_queries) - 1
+            allowed_words_between = word_query.link_to_next_word.allowed_words_between \
+                if word_query.link_to_next_word and not is_last else None
+            canonical_word_queries.append([sorted(word_query.attributes.items()), allowed_words_between])
+        return canonical_word_queries
+
 
 class TextQuery:
     def __init__(self, json: Dict[Any, Any], on_parsing_error: Callable[[str], Any]):
@@ -60,3 +71,12 @@ class TextQuery:
 
     def __repr__(self):
         return str(self.sequences)
+
+    def canonical_key(self) -> str:
+        """
+        Builds a string identifying the matches this query will find. It's the same for queries that differ only in
+        attribute order, in links that don't restrict anything, or in which page of results was requested.
+        :return: The key
+        """
+        return json.dumps([sequence.canonical_form() for sequence in self.sequences], ensure_ascii=False,
+                          separators=(',', ':'))
@@ -0,0 +1,318 @@
+"""
+The text and translation providers the API serves from, and the parts of handling requests that don't depend on the web
+framework, shared by app.py and async_app.py.
+"""
+import app_constants
+from caching.CacheBackend import CacheBackend
+from caching.MemoryCache import MemoryCache
+from caching.SqliteCache import SqliteCache
+import hashlib
+import json_codec
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags
+from translation_providers.ESVApiTranslationProvider import ESVApiTranslationProvider
+from text_providers.Nestle1904LowfatInMemoryProvider import Nestle1904LowfatInMemoryProvider
+from text_providers.Nestle1904LowfatProvider import Nestle1904LowfatProvider
+from text_providers import Nestle1904LowfatProvider_Config as NlfConfig
+from text_providers.TextProvider import TextProvider
+from AnoixoError import AnoixoError, ProbableBugError
+from Deadline import Deadline
+from FacetQuery import FacetQuery
+from Metrics import Metrics
+from QueryCounts import FacetCounts, QueryCounts
+from QueryResult import QueryResult
+from RequestLogger import RequestLog, RequestLogger
+from ResponseCompressor import ResponseCompressor, IDENTITY
+from TextQuery import TextQuery
+from translation_providers.TranslationProvider import TranslationProvider
+
+
+JSON_MIMETYPE = 'application/json'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+# Nginx buffers responses from the app unless told not to, which would hold back streamed lines until the end
+STREAMING_HEADERS = {'X-Accel-Buffering': 'no'}
+# Version 0.0.4 of the Prometheus text exposition format
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _create_cache() -> CacheBackend:
+    if app_constants.shared_cache_path:
+        return SqliteCache(app_constants.shared_cache_path, app_constants.cache_max_size, app_constants.cache_ttl)
+    return MemoryCache(app_constants.cache_max_size, app_constants.cache_ttl)
+
+
+def _create_translation_cache(max_size: int) -> CacheBackend:
+    """
+    :param max_size: The most the cache can hold across every worker process on the host
+    """
+    if app_constants.translation_cache_path:
+        # A faster in-memory tier in front would hold copies outside the limit
+        return SqliteCache(app_constants.translation_cache_path, max_size)
+    return MemoryCache(max(1, max_size // app_constants.worker_count))
+
+
+def _create_nlf_provider(cache: CacheBackend, metrics: Metrics) -> TextProvider:
+    if app_constants.nlf_engine == 'memory':
+        return Nestle1904LowfatInMemoryProvider(NlfConfig.xml_path)
+    return Nestle1904LowfatProvider(cache, metrics)
+
+
+cache = _create_cache()
+metrics = Metrics(app_constants.metrics_path)
+text_providers: Dict[str, TextProvider] = {
+    'nlf': _create_nlf_provider(cache, metrics)
+}
+translation_providers: Dict[str, TranslationProvider] = {
+    'esv': ESVApiTranslationProvider(_create_translation_cache(ESVApiTranslationProvider.MAX_CACHED_VERSES), metrics)
+}
+
+
+request_logger = RequestLogger(app_constants.request_log_sample_rate)
+response_compressor = ResponseCompressor(app_constants.gzip_level, app_constants.brotli_quality,
+                                         app_constants.compression_min_size)
+
+# The JSON body in each encoding and the ETag of the response for each attribute's values, by text ID and attribute ID.
+# Corpora don't change while the server runs, so these never go stale.
+attribute_responses: Dict[Tuple[str, str], Tuple[Dict[str, bytes], str]] = {}
+
+
+def warm_up_providers() -> None:
+    for text_id, text_provider in text_providers.items():
+        try:
+            text_provider.warm_up()
+            # the attribute values are compressed at the highest levels, which is too slow to do in a request
+            for attribute_id in text_provider.attribute_names():
+                _load_attribute_response(text_id, attribute_id)
+        except AnoixoError as err:
+            print(f'[{time.asctime()}] Could not warm up text provider \'{text_id}\': {err.message}', flush=True)
+
+
+def close_providers() -> None:
+    for text_provider in text_providers.values():
+        text_provider.close()
+    for translation_provider in translation_providers.values():
+        translation_provider.close()
+
+
+def json_to_text_query(query_json: Union[Dict[Any, Any], None]) -> TextQuery:
+    if query_json is None:
+        raise ProbableBugError('Request does not contain a JSON body', 400)
+
+    def on_parsing_error(message: str):
+        raise ProbableBugError(f'Error parsing JSON: {message}', 400)
+
+    return TextQuery(query_json, on_parsing_error)
+
+
+def json_to_facet_query(query_json: Union[Dict[Any, Any], None]) -> FacetQuery:
+    if query_json is None:
+        raise ProbableBugError('Request does not contain a JSON body', 400)
+
+    def on_parsing_error(message: str):
+        raise ProbableBugError(f'Error parsing JSON: {message}', 400)
+
+    return FacetQuery(query_json, on_parsing_error)
+
+
+def json_to_text_query_batch(batch_json: Any) -> List[Union[TextQuery, AnoixoError]]:
+    """
+    :return: Each query in the batch, or the error parsing it failed with
+    """
+    if batch_json is None:
+        raise ProbableBugError('Request does not contain a JSON body', 400)
+    if not isinstance(batch_json, list):
+        raise ProbableBugError('Batch is not a list of queries', 400)
+    if len(batch_json) > app_constants.max_batch_size:
+        raise ProbableBugError(f'Batch has {len(batch_json)} queries, more than the limit of '
+                               f'{app_constants.max_batch_size}', 400)
+
+    queries: List[Union[TextQuery, AnoixoError]] = []
+    for query_json in batch_json:
+        try:
+            if not isinstance(query_json, dict):
+                raise ProbableBugError('Query is not a dictionary', 400)
+            queries.append(json_to_text_query(query_json))
+        except AnoixoError as error:
+            queries.append(error)
+    return queries
+
+
+def run_text_query_batch(text_provider: TextProvider, queries: List[Union[TextQuery, AnoixoError]],
+                         deadline: Deadline) -> List[Union[QueryResult, AnoixoError]]:
+    """
+    Runs the queries that parsed successfully, leaving the errors for the ones that didn't in their place
+    """
+    query_results = iter(text_provider.text_query_batch(
+        [query for query in queries if isinstance(query, TextQuery)], deadline))
+    return [next(query_results) if isinstance(query, TextQuery) else query for query in queries]
+
+
+def fail_query_results(results: List[Union[QueryResult, AnoixoError]],
+                       error: AnoixoError) -> List[Union[QueryResult, AnoixoError]]:
+    """
+    :return: The batch results with each successful query result replaced by the error, for when something that all of
+    them depend on (like fetching their translations) fails
+    """
+    return [error if isinstance(result, QueryResult) else result for result in results]
+
+
+def serialize_batch_results(results: List[Union[QueryResult, AnoixoError]]) -> List[Dict[str, Any]]:
+    """
+    :return: Each serialized query result, or for each query that failed, its serialized error with the HTTP status code
+    it would have had on its own
+    """
+    return [result.serialize() if isinstance(result, QueryResult)
+            else {**result.serialize(), 'status': result.http_error_code}
+            for result in results]
+
+
+def get_text_provider(text_id: str) -> TextProvider:
+    if text_id not in text_providers:
+        raise ProbableBugError(f'Text provider with id \'{text_id}\' was not found. '
+                               f'Available texts: {" ".join(text_providers.keys())}', 404)
+    return text_providers[text_id]
+
+
+def get_translation_provider() -> TranslationProvider:
+    # In the future, a particular translation could be requested in the query
+    return translation_providers['esv']
+
+
+def _load_attribute_response(text_id: str, attribute_id: str) -> Tuple[Dict[str, bytes], str]:
+    """
+    Only asks the text provider for the attribute's values, and serializes and compresses them, the first time each
+    worker process needs them (which is normally while it warms up)
+    :return: The JSON body of the response for the attribute's values in each encoding, and its ETag
+    """
+    key = (text_id, attribute_id)
+    if key not in attribute_responses:
+        body = json_codec.dumps(get_text_provider(text_id).attribute_query(attribute_id))
+        attribute_responses[key] = (response_compressor.compress_all(body), hashlib.sha256(body).hexdigest()[:32])
+    return attribute_responses[key]
+
+
+def get_attribute_response(text_id: str, attribute_id: str, accept_encoding: Optional[str]) -> Tuple[bytes, str, str]:
+    """
+    :param accept_encoding: The request's Accept-Encoding header
+    :return: The JSON body of the response for the attribute's values in the encoding the client prefers, that encoding,
+    and the body's strong ETag
+    """
+    bodies, etag = _load_attribute_response(text_id, attribute_id)
+    encoding = response_compressor.choose_encoding(accept_encoding, list(bodies))
+    # each encoding of the body is a different representation, so it needs its own strong ETag
+    return bodies[encoding], encoding, etag if encoding == IDENTITY else f'{etag}-{encoding}'
+
+
+def is_not_modified(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    :return: Whether a request's If-None-Match header says the client already has the response with this ETag
+    """
+    # If-None-Match uses weak comparison
+    return parse_etags(if_none_match).contains_weak(etag)
+
+
+def attribute_cache_headers(etag: str) -> Dict[str, str]:
+    return {
+        'ETag': f'"{etag}"',
+        'Cache-Control': f'public, max-age={app_constants.attribute_cache_max_age}',
+        'Vary': 'Accept-Encoding',
+    }
+
+
+def wants_ndjson(accept_header: Optional[str]) -> bool:
+    """
+    :return: Whether a request's Accept header prefers newline-delimited JSON over plain JSON
+    """
+    return parse_accept_header(accept_header, MIMEAccept).best_match([JSON_MIMETYPE, NDJSON_MIMETYPE]) == \
+        NDJSON_MIMETYPE
+
+
+def stream_passages(query_result: QueryResult) -> Iterator[bytes]:
+    """
+    Serializes a QueryResult's passages as newline-delimited JSON, one line per passage, as soon as the passages are
+    found. Translations take a round trip to another API, so they aren't in these lines yet; stream_translations sends
+    them afterwards.
+    """
+    for passage in query_result.passages:
+        yield json_codec.dumps(passage.serialize()) + b'\n'
+
+
+def stream_translations(query_result: QueryResult, error: Optional[AnoixoError] = None) -> Iterator[bytes]:
+    """
+    Follows the lines from stream_passages with a line with the passages' translations in order, like
+    `{"translations": ["In the beginning...", ...]}`, or the error response if they couldn't be fetched. Then a trailer
+    line with the pagination information (and query information, if any), like
+    `{"pagination": {"page": 1, "totalPages": 3}}`.
+    """
+    if error is None:
+        yield json_codec.dumps({'translations': [passage.translation for passage in query_result.passages]}) + b'\n'
+    else:
+        yield json_codec.dumps(error.serialize()) + b'\n'
+    trailer: Dict[str, Any] = {'pagination': query_result.serialize_pagination()}
+    if query_result.query_info is not None:
+        trailer['queryInfo'] = query_result.query_info
+    yield json_codec.dumps(trailer) + b'\n'
+
+
+def query_result_log_fields(query_result: QueryResult) -> Dict[str, Any]:
+    fields: Dict[str, Any] = {'page': query_result.page, 'totalPages': query_result.total_pages,
+                              'results': len(query_result.passages)}
+    if query_result.result_limit is not None:
+        fields['resultLimit'] = query_result.result_limit
+    if query_result.query_info is not None:
+        fields['queryInfo'] = query_result.query_info
+    return fields
+
+
+def query_counts_log_fields(query_counts: QueryCounts) -> Dict[str, Any]:
+    fields: Dict[str, Any] = {'totalResults': query_counts.total}
+    if query_counts.query_info is not None:
+        fields['queryInfo'] = query_counts.query_info
+    return fields
+
+
+def facet_counts_log_fields(facet_counts: FacetCounts) -> Dict[str, Any]:
+    fields: Dict[str, Any] = {'totalWords': facet_counts.total_words}
+    if facet_counts.query_info is not None:
+        fields['queryInfo'] = facet_counts.query_info
+    return fields
+
+
+def batch_log_fields(results: List[Union[QueryResult, AnoixoError]]) -> Dict[str, int]:
+    return {'queries': len(results), 'failedQueries': sum(isinstance(result, AnoixoError) for result in results),
+            'results': sum(len(result.passages) for result in results if isinstance(result, QueryResult))}
+
+
+def log_request(source_address: str, method: str, path: str, status_code: int, request_log: RequestLog,
+                request_json: Any) -> None:
+    """
+    :param request_log: What the handler recorded about the request
+    :param request_json: The request's JSON body, as the handler already parsed it
+    """
+    entry = request_log.entry(time=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), address=source_address,
+                              method=method, path=path, status=status_code, request=request_json)
+    request_logger.log(entry, failed=status_code >= 400)
+
+
+def count_error(error: AnoixoError) -> None:
+    """
+    Counts an error sent to a client in the metrics
+    """
+    metrics.increment('anoixo_errors_total', type=type(error).__name__)
+
+
+def count_batch_errors(results: List[Union[QueryResult, AnoixoError]]) -> None:
+    for result in results:
+        if isinstance(result, AnoixoError):
+            count_error(result)
+
+
+def observe_request(endpoint: str, request_log: RequestLog) -> None:
+    """
+    Records how long the request took, in total and in each stage the handler timed, in the metrics
+    :param endpoint: The name of the route that handled the request
+    """
+    for stage, seconds in request_log.stage_timings().items():
+        metrics.observe('anoixo_request_seconds', seconds, endpoint=endpoint, stage=stage)
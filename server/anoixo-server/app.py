@@ -1,26 +1,25 @@
-import time
-from flask import g, jsonify, make_response, request, Flask
+import app_constants
+import json_codec
+from typing import Any, Iterator
+from flask import g, request, Flask, Response
 from flask_cors import CORS
 from flask_limiter import Limiter
-from typing import Any, Dict, Union
-from translation_providers.ESVApiTranslationProvider import ESVApiTranslationProvider
-from text_providers.Nestle1904LowfatProvider import Nestle1904LowfatProvider
-from text_providers.TextProvider import TextProvider
-from werkzeug.http import HTTP_STATUS_CODES
-from AnoixoError import AnoixoError, ProbableBugError, TooManyRequestsError
-from TextQuery import TextQuery
+from api_common import attribute_cache_headers, batch_log_fields, count_batch_errors, count_error, \
+    facet_counts_log_fields, fail_query_results, get_attribute_response, get_text_provider, get_translation_provider, \
+    is_not_modified, json_to_facet_query, json_to_text_query, json_to_text_query_batch, log_request, metrics, \
+    observe_request, query_counts_log_fields, query_result_log_fields, response_compressor, run_text_query_batch, \
+    serialize_batch_results, stream_passages, stream_translations, wants_ndjson, warm_up_providers, JSON_MIMETYPE, \
+    METRICS_CONTENT_TYPE, NDJSON_MIMETYPE, STREAMING_HEADERS
+from AnoixoError import AnoixoError, TooManyRequestsError
+from Deadline import Deadline
+from QueryResult import QueryResult
+from RequestLogger import RequestLog
+from ResponseCompressor import IDENTITY
 from translation_providers.TranslationProvider import TranslationProvider
 
 app = Flask(__name__)
 CORS(app)
 
-text_providers: Dict[str, TextProvider] = {
-    'nlf': Nestle1904LowfatProvider()
-}
-translation_providers: Dict[str, TranslationProvider] = {
-    'esv': ESVApiTranslationProvider()
-}
-
 
 def _get_address_for_request():
     """
@@ -39,19 +38,29 @@ def _get_address_for_request():
     return request.headers.get('X-Real-Ip', request.remote_addr)
 
 
+def _json_response(value: Any, status: int = 200) -> Response:
+    # json_codec is faster than the json module jsonify uses, which adds up on big pages of results
+    return Response(json_codec.dumps(value), status=status, mimetype=JSON_MIMETYPE)
+
+
 limiter = Limiter(
     app,
     key_func=_get_address_for_request
 )
 
 
+def _request_log() -> RequestLog:
+    # Made on first use, since flask-limiter's before_request can turn a request away before get_request_log runs
+    if 'request_log' not in g:
+        g.request_log = RequestLog()
+    return g.request_log
+
+
 @app.errorhandler(AnoixoError)
 def handle_anoixo_error(error: AnoixoError):
-    return make_response(jsonify({
-        'error': HTTP_STATUS_CODES[error.http_error_code],
-        'description': error.message,
-        'friendlyErrorMessage': error.get_friendly_error_message()
-    }), error.http_error_code)
+    _request_log().add(error=error.message)
+    count_error(error)
+    return _json_response(error.serialize(), error.http_error_code)
 
 
 @app.errorhandler(429)
@@ -60,66 +69,149 @@ def handle_rate_limit_exceeded(e):
 
 
 @app.before_request
-def get_request_start_time():
-    g.start_time = time.time()
+def get_request_log():
+    _request_log()
 
 
+# Registered before compress_response, so that it runs after it and the log has the compression's timing
 @app.after_request
-def log_request(response):
-    source_address = _get_address_for_request()
-    exec_time = time.time() - g.start_time
-    print(f'[{time.asctime()}] {source_address} {request.method} {request.path} {response.status_code}', flush=True)
-    print(f'\tTime: {exec_time}', flush=True)
-    print(f'\tRequest: {request.json}', flush=True)
-    response_json = response.json
-    if isinstance(response_json, list):
-        response_log = f'<{len(response_json)} results>'
-    elif response_json and 'results' in response_json:
-        response_json['results'] = f'<{len(response_json["results"])} results>'
-        response_log = response_json
+def log_request_details(response):
+    address, method, path, endpoint = _get_address_for_request(), request.method, request.path, request.endpoint
+    request_log, request_json = _request_log(), request.get_json(silent=True)
+
+    def log():
+        log_request(address, method, path, response.status_code, request_log, request_json)
+        observe_request(endpoint or 'unmatched', request_log)
+    # A newline-delimited JSON response is still being built after this, so it's logged once it has been sent
+    if response.mimetype == NDJSON_MIMETYPE:
+        response.call_on_close(log)
     else:
-        response_log = response_json
-    print(f'\tResponse: {response_log}', flush=True)
+        log()
     return response
 
 
-def _json_to_text_query(json: Union[Dict[Any, Any], None]) -> TextQuery:
-    if json is None:
-        raise ProbableBugError('Request does not contain a JSON body', 400)
-
-    def on_parsing_error(message: str):
-        raise ProbableBugError(f'Error parsing JSON: {message}', 400)
-
-    return TextQuery(json, on_parsing_error)
+@app.after_request
+def compress_response(response):
+    if response.is_streamed or response.mimetype != JSON_MIMETYPE or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    with _request_log().stage('compress'):
+        body, encoding = response_compressor.compress_for(response.get_data(), request.headers.get('Accept-Encoding'))
+    if encoding != IDENTITY:
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        _request_log().add(encoding=encoding)
+    return response
 
 
-def _get_text_provider(text_id: str) -> TextProvider:
-    if text_id not in text_providers:
-        raise ProbableBugError(f'Text provider with id \'{text_id}\' was not found. '
-                               f'Available texts: {" ".join(text_providers.keys())}', 404)
-    return text_providers[text_id]
+def _stream_query_result(translation_provider: TranslationProvider, query_result: QueryResult, deadline: Deadline,
+                         request_log: RequestLog) -> Iterator[bytes]:
+    """
+    Sends the passages while their translations are fetched. The response has already started by then, so an error
+    fetching them is sent in the stream instead of as an error response.
+    """
+    with request_log.stage('stream'):
+        yield from stream_passages(query_result)
+    error = None
+    try:
+        with request_log.stage('translations'):
+            translation_provider.add_translations(query_result, deadline)
+    except AnoixoError as err:
+        request_log.add(error=err.message)
+        count_error(err)
+        error = err
+    with request_log.stage('stream'):
+        yield from stream_translations(query_result, error)
 
 
 @app.route('/api/text/<string:text_id>', methods=['POST'])
-@limiter.limit('1000/day;200/hour;12/minute')
+@limiter.limit(app_constants.text_query_rate_limit)
 def text_query(text_id: str):
-    text_provider = _get_text_provider(text_id)
-
-    # In the future, a particular translation could be requested in the query
-    translation_provider = translation_providers['esv']
-
-    query = _json_to_text_query(request.json)
-    query_result = text_provider.text_query(query)
-    translation_provider.add_translations(query_result)
-    return jsonify(query_result.serialize())
+    text_provider = get_text_provider(text_id)
+    translation_provider = get_translation_provider()
+
+    query = json_to_text_query(request.json)
+    deadline = Deadline(app_constants.request_time_budget)
+    request_log = _request_log()
+    with request_log.stage('query'):
+        query_result = text_provider.text_query(query, deadline)
+    request_log.add(**query_result_log_fields(query_result))
+    if wants_ndjson(request.headers.get('Accept')):
+        return Response(_stream_query_result(translation_provider, query_result, deadline, request_log),
+                        mimetype=NDJSON_MIMETYPE, headers=STREAMING_HEADERS)
+    with request_log.stage('translations'):
+        translation_provider.add_translations(query_result, deadline)
+    with request_log.stage('serialize'):
+        return _json_response(query_result.serialize())
+
+
+@app.route('/api/text/<string:text_id>/batch', methods=['POST'])
+@limiter.limit(app_constants.batch_text_query_rate_limit)
+def text_query_batch(text_id: str):
+    text_provider = get_text_provider(text_id)
+    translation_provider = get_translation_provider()
+
+    queries = json_to_text_query_batch(request.json)
+    deadline = Deadline(app_constants.request_time_budget)
+    request_log = _request_log()
+    with request_log.stage('query'):
+        results = run_text_query_batch(text_provider, queries, deadline)
+    with request_log.stage('translations'):
+        try:
+            translation_provider.add_translations_batch(
+                [result for result in results if isinstance(result, QueryResult)], deadline)
+        except AnoixoError as error:
+            results = fail_query_results(results, error)
+    request_log.add(**batch_log_fields(results))
+    count_batch_errors(results)
+    with request_log.stage('serialize'):
+        return _json_response(serialize_batch_results(results))
+
+
+@app.route('/api/text/<string:text_id>/count', methods=['POST'])
+@limiter.limit(app_constants.text_query_rate_limit)
+def count_query(text_id: str):
+    text_provider = get_text_provider(text_id)
+    query = json_to_text_query(request.json)
+    with _request_log().stage('query'):
+        query_counts = text_provider.count_query(query, Deadline(app_constants.request_time_budget))
+    _request_log().add(**query_counts_log_fields(query_counts))
+    return _json_response(query_counts.serialize())
+
+
+@app.route('/api/text/<string:text_id>/facets', methods=['POST'])
+@limiter.limit(app_constants.text_query_rate_limit)
+def facet_query(text_id: str):
+    text_provider = get_text_provider(text_id)
+    query = json_to_facet_query(request.json)
+    with _request_log().stage('query'):
+        facet_counts = text_provider.facet_query(query, Deadline(app_constants.request_time_budget))
+    _request_log().add(**facet_counts_log_fields(facet_counts))
+    return _json_response(facet_counts.serialize())
 
 
 @app.route('/api/text/<string:text_id>/attribute/<string:attribute_id>', methods=['GET'])
 def attribute_query(text_id: str, attribute_id: str):
-    text_provider = _get_text_provider(text_id)
-    query_result = text_provider.attribute_query(attribute_id)
-    return jsonify(query_result)
+    body, encoding, etag = get_attribute_response(text_id, attribute_id, request.headers.get('Accept-Encoding'))
+    headers = attribute_cache_headers(etag)
+    if is_not_modified(request.headers.get('If-None-Match'), etag):
+        return Response(status=304, headers=headers)
+    if encoding != IDENTITY:
+        headers['Content-Encoding'] = encoding
+    return Response(body, mimetype=JSON_MIMETYPE, headers=headers)
+
+
+@app.route('/api/text/<string:text_id>/stats', methods=['GET'])
+def provider_stats(text_id: str):
+    text_provider = get_text_provider(text_id)
+    return _json_response(text_provider.get_stats())
+
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
 
 
 if __name__ == '__main__':
+    warm_up_providers()
     app.run(debug=True)
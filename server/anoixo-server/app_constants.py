@@ -1 +1,69 @@
+import os
+from typing import Optional
+
 page_size = 10
+
+# How many worker processes gunicorn runs (see gunicorn.conf.py). Limits that apply to the whole host are split
+# between them.
+worker_count = int(os.environ.get('ANOIXO_WORKERS', 4))
+
+# Which engine answers queries for the Nestle 1904 Lowfat text: 'basex' (Nestle1904LowfatProvider) or 'memory'
+# (Nestle1904LowfatInMemoryProvider)
+nlf_engine = os.environ.get('ANOIXO_NLF_ENGINE', 'basex')
+
+# Caches for text providers' query results. Size is measured in characters of cached database output.
+cache_max_size = 50_000_000
+cache_ttl = 24 * 60 * 60  # seconds
+# If set, the caches are kept in an SQLite database at this path and shared between all worker processes on the host.
+# Otherwise, each worker process keeps its own in-memory caches.
+shared_cache_path: Optional[str] = os.environ.get('ANOIXO_SHARED_CACHE_PATH')
+# How long clients and proxies can use attribute values without checking back. The corpus only changes with a new
+# deploy, and after this runs out, a conditional request with the response's ETag gets a cheap 304 if nothing changed.
+attribute_cache_max_age = 7 * 24 * 60 * 60  # seconds
+# The share of successful requests that get a line in the request log (requests that fail always do), from 0 to 1.
+# Lowering it keeps the log manageable under heavy load.
+request_log_sample_rate = float(os.environ.get('ANOIXO_REQUEST_LOG_SAMPLE_RATE', '1'))
+# JSON responses at least this big are compressed when the client accepts gzip (or brotli, if the optional brotli
+# package is installed). Attribute values are instead compressed once per worker process, at the highest compression
+# levels, for the smallest output.
+compression_min_size = 1024  # bytes
+gzip_level = 6  # 1-9
+brotli_quality = 5  # 0-11
+# How long a text query request can take in total, from querying the text through fetching translations. Database
+# queries still running when it runs out are stopped. gunicorn.conf.py gives workers longer than this before killing
+# them, and nginx waits 60 seconds (its default proxy_read_timeout) for a response, so raising this past about 45
+# seconds means raising that too.
+request_time_budget = 30  # seconds
+# Text queries estimated to make the database look at more words than this are turned away before they run (see
+# QueryCostEstimator). Searching every sentence for one word query looks at about 140,000 words.
+query_cost_limit = 20_000_000
+# Text queries that could match more sentences than this only find the first this many, and report that there are more
+query_result_limit = 1000
+# How long to wait for translations before giving up on a search, within the request's time budget
+translation_timeout = 10  # seconds
+# If set, translations are cached in an SQLite database at this path, which survives restarts and is shared between
+# worker processes. Otherwise, each worker process keeps its own in-memory translation cache with its share of the
+# verses the ESV API terms allow storing.
+translation_cache_path: Optional[str] = os.environ.get('ANOIXO_TRANSLATION_CACHE_PATH')
+# If set, each worker process adds its metrics into an SQLite database at this path, so the metrics endpoint reports
+# the totals for every worker. Otherwise it only reports the numbers for the worker that answers it.
+metrics_path: Optional[str] = os.environ.get('ANOIXO_METRICS_PATH')
+# If set, every worker process waits for its turn to query the database in the same lines, kept in an SQLite database at
+# this path (best on a memory-backed filesystem like /dev/shm), so the limit on queries applies to the whole host.
+# Otherwise each worker process limits its own queries.
+admission_path: Optional[str] = os.environ.get('ANOIXO_ADMISSION_PATH')
+
+# Applies to each client IP address, in flask-limiter's rate limit string format
+text_query_rate_limit = '1000/day;200/hour;12/minute'
+# Batch text queries count against their own limit, since each batch can hold up to max_batch_size queries
+batch_text_query_rate_limit = '200/day;40/hour;4/minute'
+max_batch_size = 10
+
+# How many text queries async_app.py runs at once, in threads. Matches the size of each worker's pool of BaseX sessions;
+# further queries wait for a free thread without tying up a session, up to async_max_waiting_queries of them. Any more
+# are turned away. Text providers that limit their queries make them wait for a turn on the event loop first.
+async_query_threads = 4
+async_max_waiting_queries = 16
+# How many threads async_app.py has for quick requests that can still block, like building attribute responses or
+# rendering metrics, so that they don't wait behind text queries
+async_quick_threads = 2
@@ -0,0 +1,337 @@
+"""
+Serves the same API as app.py, with the same error responses, rate limits and request logging, but on aiohttp instead
+of Flask. A worker doesn't block while a search waits on the database or the ESV API, so it can have many searches in
+flight at once. Text providers are synchronous, so their queries run in a bounded pool of threads, with a bounded queue
+in front; queries wait for their turn at the provider's database (see TextProvider.admit_async) and translations are
+awaited on the event loop.
+
+For development, run it with `python async_app.py`. In production, run it under gunicorn with:
+gunicorn --config gunicorn.conf.py --worker-class aiohttp.GunicornWebWorker async_app:create_app
+"""
+import app_constants
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+import json_codec
+import threading
+from aiohttp import web
+from limits import parse_many, RateLimitItem
+from limits.storage import MemoryStorage
+from limits.strategies import FixedWindowRateLimiter
+from typing import Any, Awaitable, Callable, List, Optional, TypeVar
+from api_common import attribute_cache_headers, batch_log_fields, count_batch_errors, count_error, \
+    facet_counts_log_fields, fail_query_results, get_attribute_response, get_text_provider, get_translation_provider, \
+    is_not_modified, json_to_facet_query, json_to_text_query, json_to_text_query_batch, log_request, metrics, \
+    observe_request, query_counts_log_fields, query_result_log_fields, response_compressor, run_text_query_batch, \
+    serialize_batch_results, stream_passages, stream_translations, translation_providers, wants_ndjson, \
+    warm_up_providers, JSON_MIMETYPE, METRICS_CONTENT_TYPE, NDJSON_MIMETYPE, STREAMING_HEADERS
+from AnoixoError import AnoixoError, ProbableBugError, ServerOverwhelmedError, TooManyRequestsError
+from Deadline import Deadline
+from QueryResult import QueryResult
+from RequestLogger import RequestLog
+from ResponseCompressor import IDENTITY
+from text_providers.TextProvider import TextProvider
+from translation_providers.TranslationProvider import TranslationProvider
+
+T = TypeVar('T')
+Q = TypeVar('Q')
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+query_threads = ThreadPoolExecutor(max_workers=app_constants.async_query_threads, thread_name_prefix='query')
+# Taken by each query waiting for or running in a query thread, so the queue for them can't grow without bound
+query_slots = threading.BoundedSemaphore(app_constants.async_query_threads + app_constants.async_max_waiting_queries)
+quick_threads = ThreadPoolExecutor(max_workers=app_constants.async_quick_threads, thread_name_prefix='quick')
+
+# Limits are counted per worker process, like flask-limiter's default in-memory storage in app.py
+rate_limit_storage = MemoryStorage()
+rate_limiter = FixedWindowRateLimiter(rate_limit_storage)
+text_query_rate_limits = parse_many(app_constants.text_query_rate_limit)
+batch_text_query_rate_limits = parse_many(app_constants.batch_text_query_rate_limit)
+
+
+def _get_address_for_request(request: web.Request) -> str:
+    """
+    Like in app.py, Nginx sets an 'X-Real-Ip' header with the original remote address when it forwards requests, so
+    that header is trusted if it's present. See the docs for app._get_address_for_request.
+    """
+    return request.headers.get('X-Real-Ip', request.remote)
+
+
+def _check_rate_limit(request: web.Request, endpoint: str, limits: List[RateLimitItem]) -> None:
+    for limit in limits:
+        if not rate_limiter.hit(limit, endpoint, _get_address_for_request(request)):
+            raise TooManyRequestsError(f'Rate limit exceeded: {limit}', http_error_code=429)
+
+
+async def _get_json(request: web.Request) -> Any:
+    """
+    :return: The request's JSON body, or None if it doesn't have one (like Flask's request.json). It's only parsed the
+    first time, so this can be called again.
+    """
+    if request.content_type != JSON_MIMETYPE or not request.body_exists:
+        return None
+    if 'json' not in request:
+        try:
+            request['json'] = await request.json()
+        except ValueError:
+            raise ProbableBugError('Request body is not valid JSON', 400)
+    return request['json']
+
+
+def _json_response(value: Any, status: int = 200) -> web.Response:
+    # Like app._json_response, json_codec is faster than web.json_response's json module
+    return web.Response(body=json_codec.dumps(value), status=status, content_type=JSON_MIMETYPE)
+
+
+def _submit_to_query_thread(function: Callable[..., T], *args: Any) -> 'Future[T]':
+    """
+    :raise ServerOverwhelmedError: If too many queries are already waiting for a query thread
+    """
+    if not query_slots.acquire(blocking=False):
+        raise ServerOverwhelmedError('Too many queries are waiting for a query thread', http_error_code=503)
+    future = query_threads.submit(function, *args)
+    # once the thread is done with it, even if the request has stopped waiting for it
+    future.add_done_callback(lambda _: query_slots.release())
+    return future
+
+
+async def _run_in_query_thread(function: Callable[..., T], *args: Any) -> T:
+    return await asyncio.wrap_future(_submit_to_query_thread(function, *args))
+
+
+async def _run_query(text_provider: TextProvider, query: Q, deadline: Deadline,
+                     quick_function: Callable[[Q], Optional[T]], function: Callable[[Q, Deadline], T]) -> T:
+    """
+    Answers the query with quick_function (like from a cache) if it can; otherwise waits on the event loop for the text
+    provider to give the query its turn at the database, then runs it with function in a query thread. The thread gives
+    back the turn once the query is done, even if the request has stopped waiting for it.
+    """
+    result = await _run_in_quick_thread(quick_function, query)
+    if result is not None:
+        return result
+    turn = await text_provider.admit_async(deadline=deadline)
+    try:
+        future = _submit_to_query_thread(turn.run, function, query, deadline)
+    except BaseException:
+        turn.give_back()
+        raise
+    return await asyncio.wrap_future(future)
+
+
+async def _run_in_quick_thread(function: Callable[..., T], *args: Any) -> T:
+    return await asyncio.get_running_loop().run_in_executor(quick_threads, function, *args)
+
+
+async def _log_request(request: web.Request, status: int) -> None:
+    try:
+        request_json = await _get_json(request)
+    except ProbableBugError:
+        request_json = None
+    log_request(_get_address_for_request(request), request.method, request.path, status, request['log'],
+                request_json)
+    observe_request(request.match_info.route.name or 'unmatched', request['log'])
+
+
+@web.middleware
+async def log_request_details(request: web.Request, handler: Handler) -> web.StreamResponse:
+    # Handlers add what they know about the request, and time its stages, in request['log']
+    request['log'] = RequestLog()
+    try:
+        response = await handler(request)
+    except web.HTTPException as exception:
+        # like a 404 for an unknown path, which aiohttp turns into a response further out
+        await _log_request(request, exception.status)
+        raise
+    await _log_request(request, response.status)
+    return response
+
+
+@web.middleware
+async def compress_response(request: web.Request, handler: Handler) -> web.StreamResponse:
+    # Runs inside log_request_details, so that the log has the compression's timing
+    response = await handler(request)
+    if not isinstance(response, web.Response) or response.content_type != JSON_MIMETYPE or \
+            'Content-Encoding' in response.headers:
+        return response
+    response.headers['Vary'] = 'Accept-Encoding'
+    with request['log'].stage('compress'):
+        body, encoding = response_compressor.compress_for(response.body, request.headers.get('Accept-Encoding'))
+    if encoding != IDENTITY:
+        response.body = body
+        response.headers['Content-Encoding'] = encoding
+        request['log'].add(encoding=encoding)
+    return response
+
+
+@web.middleware
+async def handle_anoixo_error(request: web.Request, handler: Handler) -> web.StreamResponse:
+    try:
+        return await handler(request)
+    except AnoixoError as error:
+        request['log'].add(error=error.message)
+        count_error(error)
+        return _json_response(error.serialize(), status=error.http_error_code)
+
+
+@web.middleware
+async def handle_cors_preflight(request: web.Request, handler: Handler) -> web.StreamResponse:
+    # Any origin can use the API, like with flask-cors's defaults in app.py
+    if request.method != 'OPTIONS' or 'Access-Control-Request-Method' not in request.headers:
+        return await handler(request)
+    response = web.Response()
+    response.headers['Access-Control-Allow-Methods'] = 'GET, HEAD, OPTIONS, POST'
+    if 'Access-Control-Request-Headers' in request.headers:
+        response.headers['Access-Control-Allow-Headers'] = request.headers['Access-Control-Request-Headers']
+    return response
+
+
+async def add_cors_headers(request: web.Request, response: web.StreamResponse) -> None:
+    # Runs as each response's headers are about to be sent, so streamed responses get them too
+    response.headers['Access-Control-Allow-Origin'] = '*'
+
+
+async def _stream_query_result(request: web.Request, translation_provider: TranslationProvider,
+                               query_result: QueryResult, deadline: Deadline) -> web.StreamResponse:
+    """
+    Like app._stream_query_result, sends the passages while their translations are fetched, and sends an error
+    fetching them in the stream
+    """
+    request_log: RequestLog = request['log']
+    response = web.StreamResponse(headers={'Content-Type': NDJSON_MIMETYPE, **STREAMING_HEADERS})
+    await response.prepare(request)
+    with request_log.stage('stream'):
+        for line in stream_passages(query_result):
+            await response.write(line)
+    error = None
+    try:
+        with request_log.stage('translations'):
+            await translation_provider.add_translations_async(query_result, deadline)
+    except AnoixoError as err:
+        request_log.add(error=err.message)
+        count_error(err)
+        error = err
+    with request_log.stage('stream'):
+        for line in stream_translations(query_result, error):
+            await response.write(line)
+        await response.write_eof()
+    return response
+
+
+async def text_query(request: web.Request) -> web.StreamResponse:
+    _check_rate_limit(request, 'text_query', text_query_rate_limits)
+    text_provider = get_text_provider(request.match_info['text_id'])
+    translation_provider = get_translation_provider()
+
+    query = json_to_text_query(await _get_json(request))
+    # Time spent waiting for a turn and a query thread counts against the deadline too
+    deadline = Deadline(app_constants.request_time_budget)
+    request_log: RequestLog = request['log']
+    with request_log.stage('query'):
+        query_result = await _run_query(text_provider, query, deadline, text_provider.quick_text_query,
+                                            text_provider.text_query)
+    request_log.add(**query_result_log_fields(query_result))
+    if wants_ndjson(request.headers.get('Accept')):
+        return await _stream_query_result(request, translation_provider, query_result, deadline)
+    with request_log.stage('translations'):
+        await translation_provider.add_translations_async(query_result, deadline)
+    with request_log.stage('serialize'):
+        return _json_response(query_result.serialize())
+
+
+async def text_query_batch(request: web.Request) -> web.StreamResponse:
+    _check_rate_limit(request, 'text_query_batch', batch_text_query_rate_limits)
+    text_provider = get_text_provider(request.match_info['text_id'])
+    translation_provider = get_translation_provider()
+
+    queries = json_to_text_query_batch(await _get_json(request))
+    deadline = Deadline(app_constants.request_time_budget)
+    request_log: RequestLog = request['log']
+    with request_log.stage('query'):
+        # each query in the batch waits for its own turn
+        results = await _run_in_query_thread(run_text_query_batch, text_provider, queries, deadline)
+    with request_log.stage('translations'):
+        try:
+            await translation_provider.add_translations_batch_async(
+                [result for result in results if isinstance(result, QueryResult)], deadline)
+        except AnoixoError as error:
+            results = fail_query_results(results, error)
+    request_log.add(**batch_log_fields(results))
+    count_batch_errors(results)
+    with request_log.stage('serialize'):
+        return _json_response(serialize_batch_results(results))
+
+
+async def count_query(request: web.Request) -> web.StreamResponse:
+    _check_rate_limit(request, 'count_query', text_query_rate_limits)
+    text_provider = get_text_provider(request.match_info['text_id'])
+    query = json_to_text_query(await _get_json(request))
+    deadline = Deadline(app_constants.request_time_budget)
+    with request['log'].stage('query'):
+        query_counts = await _run_query(text_provider, query, deadline, text_provider.quick_count_query,
+                                            text_provider.count_query)
+    request['log'].add(**query_counts_log_fields(query_counts))
+    return _json_response(query_counts.serialize())
+
+
+async def facet_query(request: web.Request) -> web.StreamResponse:
+    _check_rate_limit(request, 'facet_query', text_query_rate_limits)
+    text_provider = get_text_provider(request.match_info['text_id'])
+    query = json_to_facet_query(await _get_json(request))
+    deadline = Deadline(app_constants.request_time_budget)
+    with request['log'].stage('query'):
+        facet_counts = await _run_query(text_provider, query, deadline, text_provider.quick_facet_query,
+                                            text_provider.facet_query)
+    request['log'].add(**facet_counts_log_fields(facet_counts))
+    return _json_response(facet_counts.serialize())
+
+
+async def attribute_query(request: web.Request) -> web.StreamResponse:
+    body, encoding, etag = await _run_in_quick_thread(get_attribute_response, request.match_info['text_id'],
+                                                      request.match_info['attribute_id'],
+                                                      request.headers.get('Accept-Encoding'))
+    headers = attribute_cache_headers(etag)
+    if is_not_modified(request.headers.get('If-None-Match'), etag):
+        return web.Response(status=304, headers=headers)
+    if encoding != IDENTITY:
+        headers['Content-Encoding'] = encoding
+    return web.Response(body=body, content_type=JSON_MIMETYPE, headers=headers)
+
+
+async def provider_stats(request: web.Request) -> web.StreamResponse:
+    text_provider = get_text_provider(request.match_info['text_id'])
+    # reading the stats can query SQLite databases shared with other workers, which can block
+    return _json_response(await _run_in_quick_thread(text_provider.get_stats))
+
+
+async def get_metrics(request: web.Request) -> web.StreamResponse:
+    text = await _run_in_quick_thread(metrics.render)
+    return web.Response(body=text.encode(), headers={'Content-Type': METRICS_CONTENT_TYPE})
+
+
+async def close_translation_providers(app: web.Application) -> None:
+    # Their sessions belong to this loop, which is gone by the time gunicorn's worker_exit hook runs
+    for translation_provider in translation_providers.values():
+        await translation_provider.close_async()
+
+
+async def create_app() -> web.Application:
+    # gunicorn's aiohttp worker takes an async factory, so the app is created on the worker's event loop
+    app = web.Application(
+        middlewares=[log_request_details, compress_response, handle_anoixo_error, handle_cors_preflight])
+    app.on_response_prepare.append(add_cors_headers)
+    app.on_cleanup.append(close_translation_providers)
+    # Routes are named like app.py's endpoints, which label their request timings in the metrics
+    app.add_routes([
+        web.post('/api/text/{text_id}', text_query, name='text_query'),
+        web.post('/api/text/{text_id}/batch', text_query_batch, name='text_query_batch'),
+        web.post('/api/text/{text_id}/count', count_query, name='count_query'),
+        web.post('/api/text/{text_id}/facets', facet_query, name='facet_query'),
+        web.get('/api/text/{text_id}/attribute/{attribute_id}', attribute_query, name='attribute_query'),
+        web.get('/api/text/{text_id}/stats', provider_stats, name='provider_stats'),
+        web.get('/api/metrics', get_metrics, name='get_metrics'),
+    ])
+    return app
+
+
+if __name__ == '__main__':
+    warm_up_providers()
+    web.run_app(create_app())
@@ -0,0 +1,70 @@
+"""
+Compares how BaseX runs the text queries from locust/locustfile.py when the sentences to search are found through the
+attribute index, and when every sentence is walked instead: whether the compiled query uses the index, and how long
+each query takes.
+
+Run it from server/anoixo-server against a BaseX server set up with basex_setup.bxs:
+python -m benchmarks.basex_index_usage --runs 10
+"""
+import argparse
+import re
+import statistics
+import time
+from typing import List, Tuple
+from text_providers.Nestle1904LowfatProvider import Nestle1904LowfatProvider
+from TextQuery import TextQuery
+
+# The same queries locust/locustfile.py sends
+QUERIES = {
+    'tiny': [[{'attributes': {'lemma': 'ἀγανάκτησις'}}]],
+    'medium': [[
+        {'attributes': {'mood': 'participle', 'tense': 'aorist'}, 'link': {'allowedWordsBetween': 0}},
+        {'attributes': {'mood': 'imperative', 'tense': 'aorist'}},
+    ]],
+    'big': [[{'attributes': {'mood': 'participle', 'tense': 'aorist'}}]],
+}
+
+
+def run_query(provider: Nestle1904LowfatProvider, query_string: str, runs: int) -> Tuple[List[float], List[str]]:
+    """
+    :return: How long each run took in seconds, and the lines of BaseX's compilation info mentioning an index
+    """
+    timings: List[float] = []
+    info = ''
+    with provider.session_pool.session() as session:
+        session.execute('set queryinfo true')
+        for _ in range(runs):
+            query = session.query(query_string)
+            start = time.perf_counter()
+            query.execute()
+            timings.append(time.perf_counter() - start)
+            info = query.info()
+            query.close()
+        session.execute('set queryinfo false')
+    index_lines = [line.strip() for line in info.splitlines() if re.search(r'\bindex\b', line, re.IGNORECASE)]
+    return timings, index_lines
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='how many times to run each query')
+    args = parser.parse_args()
+
+    provider = Nestle1904LowfatProvider()
+    try:
+        for name, sequences in QUERIES.items():
+            query = TextQuery({'sequences': sequences}, lambda message: print(f'Invalid query: {message}'))
+            for use_attribute_index in (False, True):
+                query_string = provider._build_query_string(query, use_attribute_index=use_attribute_index)
+                timings, index_lines = run_query(provider, query_string, args.runs)
+                label = 'attribute index' if use_attribute_index else 'sentence walk'
+                print(f'{name} ({label}): median {statistics.median(timings) * 1000:.1f} ms, '
+                      f'min {min(timings) * 1000:.1f} ms over {len(timings)} runs')
+                for line in index_lines or ['(no index used)']:
+                    print(f'\t{line}')
+    finally:
+        provider.session_pool.close_all()
+
+
+if __name__ == '__main__':
+    main()
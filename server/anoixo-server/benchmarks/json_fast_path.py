@@ -0,0 +1,97 @@
+"""
+Compares the CPU time and memory it takes to turn a page of BaseX results into a response body, the way it was done
+before the fast path (json.loads, rebuilding every word without its nulls, building a WordResult for every word,
+serializing it all into fresh dictionaries and encoding them with jsonify's sorted-key json.dumps), and the way it's
+done now (json_codec, passing the words through as they were parsed). No BaseX server is needed: the page is made up,
+with words shaped like the ones Nestle1904LowfatProvider asks BaseX for.
+
+Run it from server/anoixo-server:
+python -m benchmarks.json_fast_path --runs 200 --words 60
+"""
+import argparse
+import json
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+import json_codec
+from QueryResult import QueryResult
+from text_providers.Nestle1904LowfatProvider import allowed_attributes
+
+
+def make_raw_page(passages: int, words_per_passage: int) -> str:
+    """
+    :return: A page of results as BaseX sends it, where each word is missing a few attributes (which come back as nulls)
+    """
+    results = []
+    for passage in range(passages):
+        words: List[Dict[str, Any]] = []
+        for position in range(words_per_passage):
+            word: Dict[str, Any] = {'text': 'λόγος,', 'matchedSequence': -1, 'matchedWordQuery': -1}
+            for i, attribute in enumerate(allowed_attributes):
+                word[attribute] = None if (position + i) % 3 == 0 else f'{attribute}-λόγος'
+            words.append(word)
+        results.append({'references': [f'John.1.{passage + 1}'], 'sentence': 'Ἐν ἀρχῇ ἦν ὁ λόγος',
+                        'words': words})
+    return json.dumps({'totalResults': passages, 'results': results})
+
+
+def no_parsing_errors(message: str):
+    raise ValueError(message)
+
+
+def before(raw_page: str) -> bytes:
+    results_json = json.loads(raw_page)
+    for result in results_json['results']:
+        for i, word in enumerate(result['words']):
+            result['words'][i] = {key: word[key] for key in word if word[key] is not None}
+    query_result = QueryResult(results_json['results'], 1, 1, no_parsing_errors)
+    for passage in query_result.passages:
+        # every word used to be built into a WordResult
+        passage.words
+    return json.dumps(query_result.serialize(), sort_keys=True).encode()
+
+
+def after(raw_page: str) -> bytes:
+    results_json = json_codec.loads(raw_page)
+    for result in results_json['results']:
+        for i, word in enumerate(result['words']):
+            if None in word.values():
+                result['words'][i] = {key: value for key, value in word.items() if value is not None}
+    query_result = QueryResult(results_json['results'], 1, 1, no_parsing_errors)
+    return json_codec.dumps(query_result.serialize())
+
+
+def measure(convert: Callable[[str], bytes], raw_page: str, runs: int) -> Dict[str, float]:
+    start = time.process_time()
+    for _ in range(runs):
+        convert(raw_page)
+    cpu_time = (time.process_time() - start) / runs
+
+    tracemalloc.start()
+    convert(raw_page)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'cpu_ms': cpu_time * 1000, 'peak_kib': peak / 1024}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=200, help='how many times to convert the page for timing')
+    parser.add_argument('--passages', type=int, default=10, help='how many passages are on the page')
+    parser.add_argument('--words', type=int, default=60, help='how many words each passage has')
+    args = parser.parse_args()
+
+    raw_page = make_raw_page(args.passages, args.words)
+    assert json.loads(before(raw_page)) == json.loads(after(raw_page))
+    codec = 'orjson' if json_codec.orjson else 'json module'
+    print(f'Page of {args.passages} passages of {args.words} words: '
+          f'{len(raw_page.encode()) / 1024:.0f} KiB from BaseX, {codec} for the fast path')
+    results = {'before': measure(before, raw_page, args.runs), 'after': measure(after, raw_page, args.runs)}
+    for name, result in results.items():
+        print(f'{name}: {result["cpu_ms"]:.2f} ms CPU, {result["peak_kib"]:.0f} KiB peak memory')
+    print(f'CPU time down {1 - results["after"]["cpu_ms"] / results["before"]["cpu_ms"]:.0%}, '
+          f'peak memory down {1 - results["after"]["peak_kib"] / results["before"]["peak_kib"]:.0%}')
+
+
+if __name__ == '__main__':
+    main()
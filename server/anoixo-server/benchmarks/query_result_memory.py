@@ -0,0 +1,83 @@
+"""
+Measures how much memory a large page of results takes once it's been parsed into a QueryResult, both when the words
+are passed through as they were parsed and when every word has been built into a WordResult, and how many objects the
+garbage collector has to track for it.
+
+Run it from server/anoixo-server:
+python -m benchmarks.query_result_memory --passages 10 --words 60
+"""
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+from typing import Any, Dict, List
+import json_codec
+from QueryResult import QueryResult
+from benchmarks.json_fast_path import no_parsing_errors
+
+# Roughly how many different values each attribute has in the corpus. Most words have a different lemma and form from
+# the other words on a page, but the grammatical attributes repeat all the time.
+DISTINCT_VALUES = {'class': 10, 'lemma': 5000, 'normalized': 20000, 'person': 3, 'number': 2, 'gender': 3, 'case': 5,
+                   'tense': 6, 'voice': 3, 'mood': 6}
+
+
+def make_raw_page(passages: int, words_per_passage: int, first_word: int = 0) -> str:
+    """
+    :param first_word: Pages with different first words have different words, but share the common attribute values
+    :return: A page of results as BaseX sends it after the nulls for missing attributes are taken out
+    """
+    results = []
+    for passage in range(passages):
+        words: List[Dict[str, Any]] = []
+        for position in range(words_per_passage):
+            number = first_word + passage * words_per_passage + position
+            word: Dict[str, Any] = {'text': f'λόγος{number}', 'matchedSequence': -1, 'matchedWordQuery': -1}
+            for attribute, distinct_values in DISTINCT_VALUES.items():
+                word[attribute] = f'{attribute}-{number % distinct_values}'
+            words.append(word)
+        results.append({'references': [f'John.1.{passage + 1}'], 'words': words})
+    return json.dumps({'totalResults': passages, 'results': results})
+
+
+def measure(raw_page: str, build_words: bool) -> Dict[str, float]:
+    """
+    :return: The memory the QueryResult (and what it refers to) takes, the number of objects it adds for the garbage
+    collector to track, and how long parsing it took
+    """
+    gc.collect()
+    tracked_before = len(gc.get_objects())
+    tracemalloc.start()
+    start = time.process_time()
+    query_result = QueryResult(json_codec.loads(raw_page)['results'], 1, 1, no_parsing_errors)
+    if build_words:
+        for passage in query_result.passages:
+            # builds the passage's WordResults
+            passage.words
+    cpu_time = time.process_time() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    tracked = len(gc.get_objects()) - tracked_before
+    del query_result
+    return {'kib': size / 1024, 'tracked_objects': tracked, 'cpu_ms': cpu_time * 1000}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--passages', type=int, default=10, help='how many passages are on the page')
+    parser.add_argument('--words', type=int, default=60, help='how many words each passage has')
+    args = parser.parse_args()
+
+    raw_page = make_raw_page(args.passages, args.words)
+    # the first page a process sees also fills the table of interned strings with the common attribute values, which
+    # later pages share
+    measure(make_raw_page(args.passages, args.words, first_word=args.passages * args.words), True)
+    for build_words in (False, True):
+        result = measure(raw_page, build_words)
+        label = 'WordResults built' if build_words else 'words passed through'
+        print(f'{label}: {result["kib"]:.0f} KiB, {result["tracked_objects"]} objects tracked by the garbage '
+              f'collector, {result["cpu_ms"]:.2f} ms CPU')
+
+
+if __name__ == '__main__':
+    main()
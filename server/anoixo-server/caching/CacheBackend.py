@@ -0,0 +1,30 @@
+from typing import Any, Dict, Optional
+import abc
+
+
+class CacheBackend(abc.ABC):
+    """
+    A size-bounded key/value store. Each entry is given a size when it's stored (in whatever unit makes sense to the
+    caller, e.g. characters of JSON or number of verses), and the backend evicts entries to keep the total size under
+    its limit.
+    """
+
+    @abc.abstractmethod
+    def get(self, key: str) -> Optional[Any]:
+        pass
+
+    @abc.abstractmethod
+    def set(self, key: str, value: Any, size: int = 1) -> None:
+        pass
+
+    @abc.abstractmethod
+    def delete(self, key: str) -> None:
+        pass
+
+    @abc.abstractmethod
+    def clear(self) -> None:
+        pass
+
+    @abc.abstractmethod
+    def stats(self) -> Dict[str, int]:
+        pass
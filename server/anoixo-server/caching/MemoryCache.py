@@ -0,0 +1,76 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+from caching.CacheBackend import CacheBackend
+
+
+class MemoryCache(CacheBackend):
+    """
+    An in-process LRU cache. Entries older than `ttl` seconds (if given) are treated as missing, and the least recently
+    used entries are evicted once the total size of all entries goes over `max_size`.
+    """
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (value, size, time stored), in least to most recently used order
+        self._entries: 'OrderedDict[str, Tuple[Any, int, float]]' = OrderedDict()
+        self._size = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def _remove(self, key: str) -> None:
+        _, size, _ = self._entries.pop(key)
+        self._size -= size
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            value, _, stored_at = entry
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                self._remove(key)
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def set(self, key: str, value: Any, size: int = 1) -> None:
+        if size > self.max_size:
+            return  # would evict everything else and still not fit
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic())
+            self._size += size
+            while self._size > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'size': self._size,
+                'max_size': self.max_size,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+            }
@@ -0,0 +1,125 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+from caching.CacheBackend import CacheBackend
+from per_process import SqliteConnections
+
+
+class SqliteCache(CacheBackend):
+    """
+    An LRU cache stored in an SQLite database file, so that every worker process on a host can share it. Values are
+    stored as JSON, so they need to be JSON-serializable.
+
+    Putting the file on a memory-backed filesystem like /dev/shm keeps it about as fast as a shared memory segment.
+    The cache is best-effort: if the database is busy or broken, lookups just miss and stores are dropped rather than
+    failing the request.
+    """
+
+    # How long to wait on another worker's write lock before giving up on a cache operation
+    BUSY_TIMEOUT = 1  # seconds
+
+    def __init__(self, path: str, max_size: int, ttl: Optional[float] = None):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self._connections = SqliteConnections(path, self.BUSY_TIMEOUT)
+
+        self._counter_lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._errors = 0
+
+        with self._connections.get() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    stored_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            ''')
+            connection.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+
+    def _count(self, counter: str) -> None:
+        with self._counter_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        try:
+            connection = self._connections.get()
+            row = connection.execute('SELECT value, stored_at FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+                row = None
+            if row is None:
+                self._count('_misses')
+                return None
+            connection.execute('UPDATE entries SET last_used = ? WHERE key = ?', (now, key))
+            value = json.loads(row[0])
+        except sqlite3.Error:
+            self._count('_errors')
+            self._count('_misses')
+            return None
+        self._count('_hits')
+        return value
+
+    def set(self, key: str, value: Any, size: int = 1) -> None:
+        if size > self.max_size:
+            return  # would evict everything else and still not fit
+        now = time.time()
+        try:
+            serialized = json.dumps(value, ensure_ascii=False)
+            connection = self._connections.get()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                                   (key, serialized, size, now, now))
+                total_size = connection.execute('SELECT SUM(size) FROM entries').fetchone()[0]
+                # evict least recently used entries until everything fits
+                while total_size > self.max_size:
+                    (oldest_key, oldest_size) = connection.execute(
+                        'SELECT key, size FROM entries ORDER BY last_used LIMIT 1').fetchone()
+                    connection.execute('DELETE FROM entries WHERE key = ?', (oldest_key,))
+                    total_size -= oldest_size
+                    self._count('_evictions')
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        except sqlite3.Error:
+            self._count('_errors')
+
+    def delete(self, key: str) -> None:
+        try:
+            self._connections.get().execute('DELETE FROM entries WHERE key = ?', (key,))
+        except sqlite3.Error:
+            self._count('_errors')
+
+    def clear(self) -> None:
+        try:
+            self._connections.get().execute('DELETE FROM entries')
+        except sqlite3.Error:
+            self._count('_errors')
+
+    def stats(self) -> Dict[str, int]:
+        try:
+            (entries, size) = self._connections.get().execute('SELECT COUNT(*), SUM(size) FROM entries').fetchone()
+        except sqlite3.Error:
+            (entries, size) = (0, 0)
+        with self._counter_lock:
+            return {
+                'entries': entries,
+                'size': size or 0,
+                'max_size': self.max_size,
+                # hits, misses, evictions and errors are counted per process
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'errors': self._errors,
+            }
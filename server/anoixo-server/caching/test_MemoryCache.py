@@ -0,0 +1,50 @@
+from caching.MemoryCache import MemoryCache
+
+
+def test_get_and_set():
+    cache = MemoryCache(max_size=10)
+    assert cache.get('key') is None
+    cache.set('key', ['value'])
+    assert cache.get('key') == ['value']
+
+
+def test_evicts_least_recently_used_entries_by_size():
+    cache = MemoryCache(max_size=10)
+    cache.set('a', 'a', size=4)
+    cache.set('b', 'b', size=4)
+    cache.get('a')
+    cache.set('c', 'c', size=4)
+    assert cache.get('a') == 'a'
+    assert cache.get('b') is None
+    assert cache.get('c') == 'c'
+    assert cache.stats()['size'] == 8
+    assert cache.stats()['evictions'] == 1
+
+
+def test_does_not_store_entries_larger_than_max_size():
+    cache = MemoryCache(max_size=10)
+    cache.set('a', 'a', size=4)
+    cache.set('huge', 'huge', size=11)
+    assert cache.get('huge') is None
+    assert cache.get('a') == 'a'
+
+
+def test_expires_entries_after_ttl(mocker):
+    monotonic = mocker.patch('time.monotonic', return_value=100)
+    cache = MemoryCache(max_size=10, ttl=60)
+    cache.set('key', 'value')
+    monotonic.return_value = 159
+    assert cache.get('key') == 'value'
+    monotonic.return_value = 161
+    assert cache.get('key') is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_counts_hits_and_misses():
+    cache = MemoryCache(max_size=10)
+    cache.set('key', 'value')
+    cache.get('key')
+    cache.get('missing')
+    cache.get('missing')
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 2
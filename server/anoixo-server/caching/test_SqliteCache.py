@@ -0,0 +1,77 @@
+import os
+import pytest
+from caching.SqliteCache import SqliteCache
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / 'cache.sqlite3')
+
+
+def test_get_and_set(cache_path):
+    cache = SqliteCache(cache_path, max_size=10)
+    assert cache.get('key') is None
+    cache.set('key', {'pages': {'1': 'λόγος'}})
+    assert cache.get('key') == {'pages': {'1': 'λόγος'}}
+
+
+def test_is_shared_between_instances(cache_path):
+    SqliteCache(cache_path, max_size=10).set('key', ['value'])
+    assert SqliteCache(cache_path, max_size=10).get('key') == ['value']
+
+
+def test_is_shared_with_forked_processes(cache_path):
+    cache = SqliteCache(cache_path, max_size=10)
+    cache.get('key')  # open a connection before forking
+    pid = os.fork()
+    if pid == 0:
+        cache.set('key', 'set by child')
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert cache.get('key') == 'set by child'
+
+
+def test_evicts_least_recently_used_entries_by_size(mocker, cache_path):
+    now = mocker.patch('time.time', return_value=100)
+    cache = SqliteCache(cache_path, max_size=10)
+    cache.set('a', 'a', size=4)
+    now.return_value = 101
+    cache.set('b', 'b', size=4)
+    now.return_value = 102
+    cache.get('a')
+    now.return_value = 103
+    cache.set('c', 'c', size=4)
+    assert cache.get('a') == 'a'
+    assert cache.get('b') is None
+    assert cache.get('c') == 'c'
+    assert cache.stats()['size'] == 8
+    assert cache.stats()['evictions'] == 1
+
+
+def test_expires_entries_after_ttl(mocker, cache_path):
+    now = mocker.patch('time.time', return_value=100)
+    cache = SqliteCache(cache_path, max_size=10, ttl=60)
+    cache.set('key', 'value')
+    now.return_value = 159
+    assert cache.get('key') == 'value'
+    now.return_value = 161
+    assert cache.get('key') is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_counts_hits_and_misses(cache_path):
+    cache = SqliteCache(cache_path, max_size=10)
+    cache.set('key', 'value')
+    cache.get('key')
+    cache.get('missing')
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_misses_instead_of_failing_on_database_errors(cache_path):
+    cache = SqliteCache(cache_path, max_size=10)
+    cache.set('key', 'value')
+    cache._connections.get().execute('DROP TABLE entries')
+    assert cache.get('key') is None
+    cache.set('key', 'value')
+    assert cache.stats()['errors'] == 2
@@ -0,0 +1,33 @@
+# gunicorn settings for serving the API in production: `gunicorn --config gunicorn.conf.py app:app`, or with
+# `--worker-class aiohttp.GunicornWebWorker async_app:create_app` for async_app.py
+from contextlib import suppress
+import os
+import app_constants
+
+workers = app_constants.worker_count
+# How long a worker can go silent before gunicorn kills and replaces it. A request that uses its whole time budget has
+# to end with its own 504 first, rather than the 502 nginx sends for a killed worker, so this leaves some time after
+# the budget for logging and sending the error.
+timeout = app_constants.request_time_budget + 15  # seconds
+
+
+def on_starting(server):
+    # Runs once before any workers start, so none of them waits behind turns at the database left over from the last
+    # run, whose workers' process IDs may since have been reused
+    if app_constants.admission_path:
+        for suffix in ('', '-wal', '-shm'):
+            with suppress(FileNotFoundError):
+                os.remove(app_constants.admission_path + suffix)
+
+
+def post_worker_init(worker):
+    # Runs in each worker after it has loaded the app, before it starts handling requests
+    from api_common import warm_up_providers
+    warm_up_providers()
+
+
+def worker_exit(server, worker):
+    # Runs in each worker as it shuts down, so its database sessions are closed rather than left for the server to time
+    # out
+    from api_common import close_providers
+    close_providers()
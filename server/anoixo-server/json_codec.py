@@ -0,0 +1,29 @@
+"""
+Encodes and decodes the JSON the API passes around, with orjson if it's installed, which is several times faster than
+the json module on big query results, and with the json module otherwise.
+"""
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    """
+    :raise ValueError: If the data isn't valid JSON (json.JSONDecodeError, which orjson's error subclasses)
+    """
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(value: Any) -> bytes:
+    """
+    :return: The value as compact UTF-8 JSON, with non-ASCII characters left as they are
+    """
+    if orjson:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode()
@@ -0,0 +1,68 @@
+"""
+Resources that each worker process needs its own of. gunicorn forks its workers from a parent process that has already
+imported the app, so anything made at import time would otherwise be shared with (or stuck in) the parent.
+"""
+import os
+import sqlite3
+import threading
+from typing import Callable, Optional
+
+
+class SqliteConnections:
+    """
+    Opens an SQLite database on first use in each thread of each process, since sqlite3 connections can't be shared
+    between threads, or carried across a fork
+    """
+
+    def __init__(self, path: str, busy_timeout: float):
+        """
+        :param busy_timeout: How long to wait on another connection's write lock before giving up, in seconds
+        """
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+
+    def get(self) -> sqlite3.Connection:
+        """
+        :return: This thread's connection, in autocommit mode (so transactions are started with an explicit BEGIN)
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+
+class BackgroundThread:
+    """
+    A daemon thread that's started on first use in each process: a thread started before gunicorn forks its workers
+    would only run in the parent
+    """
+
+    def __init__(self, target: Callable[[], None], name: str, before_start: Optional[Callable[[], None]] = None):
+        """
+        :param before_start: Called in each process just before the thread starts there, to set up anything the thread
+        uses that can't be carried across a fork
+        """
+        self.target = target
+        self.name = name
+        self.before_start = before_start
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def is_running(self) -> bool:
+        """
+        :return: Whether the thread has been started in this process
+        """
+        return self._pid == os.getpid()
+
+    def ensure_started(self) -> None:
+        if self.is_running():
+            return
+        with self._lock:
+            if not self.is_running():
+                if self.before_start:
+                    self.before_start()
+                threading.Thread(target=self.target, name=self.name, daemon=True).start()
+                self._pid = os.getpid()
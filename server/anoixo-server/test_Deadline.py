@@ -0,0 +1,24 @@
+import pytest
+from AnoixoError import QueryTimeoutError
+from Deadline import Deadline
+
+
+def test_remaining_counts_down(mocker):
+    monotonic = mocker.patch('time.monotonic', return_value=100)
+    deadline = Deadline(5)
+    monotonic.return_value = 102
+    assert deadline.remaining() == 3
+    assert not deadline.expired()
+    deadline.check()
+
+
+def test_expires(mocker):
+    monotonic = mocker.patch('time.monotonic', return_value=100)
+    deadline = Deadline(5)
+    monotonic.return_value = 106
+    assert deadline.remaining() == 0
+    assert deadline.expired()
+    with pytest.raises(QueryTimeoutError) as excinfo:
+        deadline.check()
+    assert excinfo.value.message == 'Request exceeded its time budget of 5 seconds'
+    assert excinfo.value.http_error_code == 504
@@ -0,0 +1,41 @@
+import pytest
+from FacetQuery import FacetQuery
+
+
+def raise_error(message: str):
+    raise ValueError(message)
+
+
+QUERY = {'sequences': [[{'attributes': {'lemma': 'λόγος'}}, {'attributes': {'class': 'verb'}}]]}
+
+
+def test_parses_facet_query():
+    facet_query = FacetQuery({'query': QUERY, 'sequence': 0, 'wordQuery': 1, 'attributes': ['tense', 'mood', 'tense']},
+                             raise_error)
+    assert facet_query.sequence_index == 0
+    assert facet_query.word_query_index == 1
+    assert facet_query.attributes == ['tense', 'mood']
+    assert facet_query.text_query.sequences[0].word_queries[1].attributes == {'class': 'verb'}
+
+
+@pytest.mark.parametrize('json, message', [
+    ({'sequence': 0, 'wordQuery': 0, 'attributes': ['case']}, 'Facet query does not contain a dictionary \'query\''),
+    ({'query': QUERY, 'sequence': 1, 'wordQuery': 0, 'attributes': ['case']},
+     '\'sequence\' is not the index of a sequence in the query'),
+    ({'query': QUERY, 'sequence': 0, 'wordQuery': 2, 'attributes': ['case']},
+     '\'wordQuery\' is not the index of a word query in the sequence'),
+    ({'query': QUERY, 'sequence': 0, 'wordQuery': 0, 'attributes': []},
+     '\'attributes\' is not a list of attribute names'),
+])
+def test_handles_wrongly_formatted_facet_query(json, message):
+    with pytest.raises(ValueError) as excinfo:
+        FacetQuery(json, raise_error)
+    assert str(excinfo.value) == message
+
+
+def test_canonical_key_ignores_attribute_order_and_page():
+    facet_query = FacetQuery({'query': QUERY, 'sequence': 0, 'wordQuery': 0, 'attributes': ['case', 'tense']},
+                             raise_error)
+    other_facet_query = FacetQuery({'query': {**QUERY, 'page': 3}, 'sequence': 0, 'wordQuery': 0,
+                                    'attributes': ['tense', 'case']}, raise_error)
+    assert facet_query.canonical_key() == other_facet_query.canonical_key()
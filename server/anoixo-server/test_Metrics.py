@@ -0,0 +1,84 @@
+import pytest
+from Metrics import Metrics
+
+
+def test_renders_counters_with_help_and_type():
+    metrics = Metrics()
+    metrics.increment('anoixo_errors_total', type='QueryTimeoutError')
+    metrics.increment('anoixo_errors_total', type='QueryTimeoutError')
+    metrics.increment('anoixo_errors_total', type='ProbableBugError')
+    metrics.increment('anoixo_basex_retries_total')
+    lines = metrics.render().splitlines()
+    assert '# HELP anoixo_errors_total Errors returned to clients, by type' in lines
+    assert '# TYPE anoixo_errors_total counter' in lines
+    assert 'anoixo_errors_total{type="ProbableBugError"} 1' in lines
+    assert 'anoixo_errors_total{type="QueryTimeoutError"} 2' in lines
+    assert 'anoixo_basex_retries_total 1' in lines
+
+
+def test_histogram_buckets_are_cumulative_and_in_order():
+    metrics = Metrics()
+    metrics.observe('anoixo_request_seconds', 0.03, endpoint='text_query', stage='total')
+    metrics.observe('anoixo_request_seconds', 3, endpoint='text_query', stage='total')
+    lines = [line for line in metrics.render().splitlines() if line.startswith('anoixo_request_seconds')]
+    assert lines == [
+        'anoixo_request_seconds_bucket{endpoint="text_query",le="0.005",stage="total"} 0',
+        'anoixo_request_seconds_bucket{endpoint="text_query",le="0.01",stage="total"} 0',
+        'anoixo_request_seconds_bucket{endpoint="text_query",le="0.025",stage="total"} 0',
+        'anoixo_request_seconds_bucket{endpoint="text_query",le="0.05",stage="total"} 1',
+        'anoixo_request_seconds_bucket{endpoint="text_query",le="0.1",stage="total"} 1',
+        'anoixo_request_seconds_bucket{endpoint="text_query",le="0.25",stage="total"} 1',
+        'anoixo_request_seconds_bucket{endpoint="text_query",le="0.5",stage="total"} 1',
+        'anoixo_request_seconds_bucket{endpoint="text_query",le="1.0",stage="total"} 1',
+        'anoixo_request_seconds_bucket{endpoint="text_query",le="2.5",stage="total"} 1',
+        'anoixo_request_seconds_bucket{endpoint="text_query",le="5.0",stage="total"} 2',
+        'anoixo_request_seconds_bucket{endpoint="text_query",le="10.0",stage="total"} 2',
+        'anoixo_request_seconds_bucket{endpoint="text_query",le="30.0",stage="total"} 2',
+        'anoixo_request_seconds_bucket{endpoint="text_query",le="+Inf",stage="total"} 2',
+        'anoixo_request_seconds_count{endpoint="text_query",stage="total"} 2',
+        'anoixo_request_seconds_sum{endpoint="text_query",stage="total"} 3.03',
+    ]
+
+
+def test_time_records_even_when_the_block_raises():
+    metrics = Metrics()
+    with pytest.raises(ValueError):
+        with metrics.time('anoixo_basex_query_seconds'):
+            raise ValueError()
+    assert 'anoixo_basex_query_seconds_count 1' in metrics.render().splitlines()
+
+
+def test_escapes_label_values():
+    metrics = Metrics()
+    metrics.increment('anoixo_errors_total', type='a"b\\c')
+    assert 'anoixo_errors_total{type="a\\"b\\\\c"} 1' in metrics.render().splitlines()
+
+
+def test_adds_up_metrics_from_every_process_sharing_a_database(tmp_path):
+    path = str(tmp_path / 'metrics.sqlite3')
+    # like two gunicorn workers
+    worker_1 = Metrics(path)
+    worker_2 = Metrics(path)
+    worker_1.increment('anoixo_basex_retries_total')
+    worker_1.observe('anoixo_basex_result_bytes', 500)
+    worker_2.increment('anoixo_basex_retries_total', 2)
+    worker_2.observe('anoixo_basex_result_bytes', 50_000)
+    worker_2.flush()
+
+    lines = worker_1.render().splitlines()
+    assert 'anoixo_basex_retries_total 3' in lines
+    assert 'anoixo_basex_result_bytes_bucket{le="1000.0"} 1' in lines
+    assert 'anoixo_basex_result_bytes_bucket{le="100000.0"} 2' in lines
+    assert 'anoixo_basex_result_bytes_count 2' in lines
+    # rendering flushed worker_1's numbers, so they aren't counted twice
+    assert worker_2.render() == worker_1.render()
+
+
+def test_reads_gauges_when_rendering():
+    metrics = Metrics()
+    running = [2]
+    metrics.add_gauge('anoixo_admission_queries', lambda: [({'state': 'running'}, running[0])])
+    running[0] = 3
+    lines = metrics.render().splitlines()
+    assert '# TYPE anoixo_admission_queries gauge' in lines
+    assert 'anoixo_admission_queries{state="running"} 3' in lines
@@ -0,0 +1,46 @@
+import pytest
+from QueryCounts import FacetCounts, QueryCounts
+
+
+def raise_error(message: str):
+    raise ValueError(message)
+
+
+def test_groups_chapters_by_book():
+    counts = QueryCounts([['Matt.1.1', 3], ['Matt.5.3', 1], ['Mark.1.1', 2]], raise_error)
+    assert counts.serialize() == {
+        'totalResults': 6,
+        'books': [
+            {'book': 'Matt', 'count': 4, 'chapters': [{'chapter': 1, 'count': 3}, {'chapter': 5, 'count': 1}]},
+            {'book': 'Mark', 'count': 2, 'chapters': [{'chapter': 1, 'count': 2}]},
+        ],
+    }
+
+
+def test_no_matches():
+    assert QueryCounts([], raise_error).serialize() == {'totalResults': 0, 'books': []}
+
+
+def test_handles_wrongly_formatted_counts():
+    with pytest.raises(ValueError) as excinfo:
+        QueryCounts({'Matt.1.1': 3}, raise_error)
+    assert str(excinfo.value) == 'Counts are not a list'
+    with pytest.raises(ValueError) as excinfo:
+        QueryCounts([['Matt.1.1', '3']], raise_error)
+    assert str(excinfo.value) == 'Count is not a reference and a number'
+
+
+def test_facet_counts_sorts_most_common_values_first():
+    counts = FacetCounts({'totalWords': 5, 'attributes': {'case': {'dative': 1, 'nominative': 3, 'accusative': 1}}},
+                         raise_error)
+    assert list(counts.serialize()['attributes']['case'].items()) == \
+        [('nominative', 3), ('accusative', 1), ('dative', 1)]
+    assert counts.serialize()['totalWords'] == 5
+
+
+def test_facet_counts_handles_wrongly_formatted_counts():
+    with pytest.raises(ValueError):
+        FacetCounts({'attributes': {}}, raise_error)
+    with pytest.raises(ValueError) as excinfo:
+        FacetCounts({'totalWords': 1, 'attributes': {'case': {'dative': '1'}}}, raise_error)
+    assert str(excinfo.value) == 'Counts for attribute \'case\' are not a dictionary of numbers'
@@ -1,3 +1,4 @@
+import pytest
 from QueryResult import QueryResult
 
 
@@ -8,3 +9,61 @@ def test_serialize_pagination():
         'page': 2,
         'totalPages': 5,
     }
+
+
+def test_serialize_result_limit_and_query_info():
+    query_result = QueryResult([], 1, 100, lambda x: None, result_limit=1000,
+                               query_info={'estimatedCandidateSentences': 5000})
+    serialized = query_result.serialize()
+    assert serialized['pagination'] == {
+        'page': 1,
+        'totalPages': 100,
+        'resultLimit': 1000,
+    }
+    assert serialized['queryInfo'] == {'estimatedCandidateSentences': 5000}
+
+
+def test_serialize_without_query_info():
+    assert 'queryInfo' not in QueryResult([], 1, 1, lambda x: None).serialize()
+
+
+def raise_error(message: str):
+    raise ValueError(message)
+
+
+def test_serialize_passes_words_through():
+    word = {'text': 'λόγος', 'matchedSequence': 0, 'matchedWordQuery': 0, 'lemma': 'λόγος'}
+    query_result = QueryResult([{'references': ['John.1.1'], 'words': [word]}], 1, 1, raise_error)
+    assert query_result.serialize()['results'][0]['words'][0] is word
+
+
+def test_words_are_built_when_asked_for():
+    word = {'text': 'λόγος', 'matchedSequence': 0, 'matchedWordQuery': 0, 'lemma': 'λόγος'}
+    passage = QueryResult([{'references': ['John.1.1'], 'words': [word]}], 1, 1, raise_error).passages[0]
+    assert passage.words[0].text == 'λόγος'
+    assert passage.words[0].attributes == {'lemma': 'λόγος'}
+    passage.words[0].attributes['lemma'] = 'changed'
+    assert passage.serialize()['words'] == [
+        {'text': 'λόγος', 'matchedSequence': 0, 'matchedWordQuery': 0, 'lemma': 'changed'}]
+
+
+def test_reports_wrongly_formatted_words():
+    with pytest.raises(ValueError) as excinfo:
+        QueryResult([{'references': ['John.1.1'], 'words': [{'text': 'λόγος', 'matchedSequence': 0}]}], 1, 1,
+                    raise_error)
+    assert str(excinfo.value) == 'Word does not contain \'matchedWordQuery\' attribute'
+
+
+def test_built_words_share_attribute_values():
+    words = [{'text': 'λόγος', 'matchedSequence': 0, 'matchedWordQuery': 0, 'case': ''.join(['nomin', 'ative'])},
+             {'text': 'θεός', 'matchedSequence': 0, 'matchedWordQuery': 0, 'case': ''.join(['nomi', 'native'])}]
+    passage = QueryResult([{'references': ['John.1.1'], 'words': words}], 1, 1, raise_error).passages[0]
+    assert passage.words[0].attributes['case'] is passage.words[1].attributes['case']
+
+
+def test_results_have_no_instance_dictionaries():
+    word = {'text': 'λόγος', 'matchedSequence': 0, 'matchedWordQuery': 0}
+    query_result = QueryResult([{'references': ['John.1.1'], 'words': [word]}], 1, 1, raise_error)
+    passage = query_result.passages[0]
+    for result in (query_result, passage, passage.references[0], passage.words[0]):
+        assert not hasattr(result, '__dict__')
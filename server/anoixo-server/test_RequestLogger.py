@@ -0,0 +1,46 @@
+import io
+import json
+from RequestLogger import RequestLog, RequestLogger
+
+
+def test_writes_a_json_line_for_each_entry():
+    stream = io.StringIO()
+    logger = RequestLogger(1, stream)
+    logger.log({'path': '/api/text/nlf', 'request': {'lemma': 'λόγος'}})
+    logger.log({'path': '/api/text/nlf/stats'})
+    logger.flush()
+    assert [json.loads(line) for line in stream.getvalue().splitlines()] == [
+        {'path': '/api/text/nlf', 'request': {'lemma': 'λόγος'}},
+        {'path': '/api/text/nlf/stats'},
+    ]
+
+
+def test_samples_successful_requests_but_not_failed_ones():
+    stream = io.StringIO()
+    logger = RequestLogger(0, stream)
+    logger.log({'status': 200})
+    logger.log({'status': 500}, failed=True)
+    logger.flush()
+    assert stream.getvalue() == '{"status":500}\n'
+
+
+def test_logs_numbers_too_big_for_orjson():
+    stream = io.StringIO()
+    logger = RequestLogger(1, stream)
+    logger.log({'request': {'page': 2 ** 70}})
+    logger.flush()
+    assert json.loads(stream.getvalue()) == {'request': {'page': 2 ** 70}}
+
+
+def test_request_log_times_stages():
+    request_log = RequestLog()
+    with request_log.stage('query'):
+        pass
+    with request_log.stage('query'):
+        pass
+    request_log.add(results=3)
+    entry = request_log.entry(status=200)
+    assert set(entry['timingsMs']) == {'total', 'query'}
+    assert entry['timingsMs']['total'] >= entry['timingsMs']['query']
+    assert entry['status'] == 200
+    assert entry['results'] == 3
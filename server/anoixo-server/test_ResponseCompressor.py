@@ -0,0 +1,38 @@
+import gzip
+from ResponseCompressor import ResponseCompressor, IDENTITY
+
+BODY = b'{"results": []}' * 100
+
+
+def test_chooses_the_encoding_the_client_prefers():
+    compressor = ResponseCompressor(6, 5, 10)
+    assert compressor.choose_encoding('gzip, deflate') == 'gzip'
+    assert compressor.choose_encoding('deflate') == IDENTITY
+    assert compressor.choose_encoding(None) == IDENTITY
+    assert compressor.choose_encoding('gzip;q=0') == IDENTITY
+    assert compressor.choose_encoding('br;q=0.5, gzip;q=0.8', ['br', 'gzip', IDENTITY]) == 'gzip'
+    assert compressor.choose_encoding('br;q=0.8, gzip;q=0.5', ['br', 'gzip', IDENTITY]) == 'br'
+    assert compressor.choose_encoding('gzip', [IDENTITY]) == IDENTITY
+
+
+def test_compresses_big_enough_bodies():
+    compressor = ResponseCompressor(6, 5, len(BODY))
+    body, encoding = compressor.compress_for(BODY, 'gzip')
+    assert encoding == 'gzip'
+    assert gzip.decompress(body) == BODY
+    assert compressor.compress_for(BODY, 'deflate') == (BODY, IDENTITY)
+
+
+def test_leaves_small_bodies_alone():
+    compressor = ResponseCompressor(6, 5, len(BODY) + 1)
+    assert compressor.compress_for(BODY, 'gzip') == (BODY, IDENTITY)
+    assert compressor.compress_all(BODY) == {IDENTITY: BODY}
+
+
+def test_compresses_with_every_supported_encoding():
+    bodies = ResponseCompressor(1, 0, 10).compress_all(BODY)
+    assert set(bodies) == {IDENTITY, *ResponseCompressor.supported_encodings()}
+    assert bodies[IDENTITY] == BODY
+    assert gzip.decompress(bodies['gzip']) == BODY
+    # always at the smallest setting
+    assert len(bodies['gzip']) == len(gzip.compress(BODY, 9))
@@ -15,3 +15,28 @@ def test_link_allowed_words_between_must_be_int():
 def test_page_defaults_to_1():
     query = TextQuery({'sequences': []}, lambda x: None)
     assert query.page == 1
+
+
+def test_canonical_key_ignores_attribute_order_and_page():
+    query1 = TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος', 'case': 'genitive'}}]]}, lambda x: None)
+    query2 = TextQuery({'sequences': [[{'attributes': {'case': 'genitive', 'lemma': 'λόγος'}}]], 'page': 3},
+                       lambda x: None)
+    assert query1.canonical_key() == query2.canonical_key()
+
+
+def test_canonical_key_ignores_link_on_last_word_query():
+    query1 = TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None)
+    query2 = TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}, 'link': {'allowedWordsBetween': 2}}]]},
+                       lambda x: None)
+    assert query1.canonical_key() == query2.canonical_key()
+
+
+def test_canonical_key_distinguishes_links_and_sequence_order():
+    linked = TextQuery({'sequences': [[{'attributes': {'lemma': 'a'}, 'link': {'allowedWordsBetween': 0}},
+                                       {'attributes': {'lemma': 'b'}}]]}, lambda x: None)
+    unlinked = TextQuery({'sequences': [[{'attributes': {'lemma': 'a'}}, {'attributes': {'lemma': 'b'}}]]},
+                         lambda x: None)
+    reordered = TextQuery({'sequences': [[{'attributes': {'lemma': 'b'}}, {'attributes': {'lemma': 'a'}}]]},
+                          lambda x: None)
+    assert linked.canonical_key() != unlinked.canonical_key()
+    assert unlinked.canonical_key() != reordered.canonical_key()
@@ -1,14 +1,27 @@
+import gzip
+import json
 import pytest
 import re
-from app import app
-from text_providers.Nestle1904LowfatProvider import Nestle1904LowfatProvider
+import api_common
+from app import app, limiter
+from text_providers.Nestle1904LowfatProvider import allowed_attributes, Nestle1904LowfatProvider
 from translation_providers.ESVApiTranslationProvider import ESVApiTranslationProvider
-from typing import Dict
+from typing import Any, Dict, List
 from werkzeug.wrappers import BaseResponse
-from AnoixoError import ServerOverwhelmedError
+from AnoixoError import QueryTimeoutError, ServerOverwhelmedError
+from caching.MemoryCache import MemoryCache
+from caching.SqliteCache import SqliteCache
+from Metrics import Metrics
+from text_providers.AdmissionGate import AdmissionGate
+from QueryCounts import FacetCounts, QueryCounts
 from QueryResult import QueryResult
 
 
+@pytest.fixture(autouse=True)
+def reset_rate_limits():
+    limiter.reset()
+
+
 @pytest.fixture
 def client(mocker):
     mocker.patch('text_providers.Nestle1904LowfatProvider.Nestle1904LowfatProvider', autospec=True)
@@ -17,19 +30,32 @@ def client(mocker):
 
     with app.test_client() as client:
         yield client
+    api_common.attribute_responses.clear()
+
+
+@pytest.fixture
+def metrics(monkeypatch):
+    metrics = Metrics()
+    monkeypatch.setattr('api_common.metrics', metrics)
+    monkeypatch.setattr('app.metrics', metrics)
+    return metrics
 
 
 def get_json_response(response: BaseResponse) -> Dict:
-    import json
     return json.loads(response.get_data(as_text=True))
 
 
+def get_log_entries(capsys) -> List[Dict[str, Any]]:
+    api_common.request_logger.flush()
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+
 def test_logging_for_text_query(monkeypatch, capsys, client):
-    def mock_provider_text_query(self, query_result):
+    def mock_provider_text_query(self, query_result, deadline=None):
         return QueryResult([{'references': ['Mark.1.1'], 'words': []}], 1, 1, lambda x: None)
     monkeypatch.setattr(Nestle1904LowfatProvider, 'text_query', mock_provider_text_query)
 
-    def mock_add_translations(self, query_result):
+    def mock_add_translations(self, query_result, deadline=None):
         return query_result
     monkeypatch.setattr(ESVApiTranslationProvider, 'add_translations', mock_add_translations)
 
@@ -42,14 +68,50 @@ def test_logging_for_text_query(monkeypatch, capsys, client):
             }
         ]
     ]})
-    captured = capsys.readouterr()
-    assert re.search(
-        r"^\[\w\w\w \w\w\w (\d| )\d \d\d:\d\d:\d\d \d\d\d\d\] 127\.0\.0\.1 POST /api/text/nlf 200\n\t" +
-        r"Time: \d+\.\d+\n\t" +
-        r"Request: {'sequences': \[\[{'attributes': {'lemma': 'λόγος'}}]]}\n\t" +
-        r"Response: {'pagination': {'page': 1, 'totalPages': 1}, 'results': '<1 results>'}$",
-        captured.out
-    )
+    [entry] = get_log_entries(capsys)
+    assert re.fullmatch(r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ', entry.pop('time'))
+    timings = entry.pop('timingsMs')
+    assert set(timings) == {'total', 'query', 'translations', 'serialize', 'compress'}
+    assert timings['total'] >= timings['query']
+    assert entry == {
+        'address': '127.0.0.1',
+        'method': 'POST',
+        'path': '/api/text/nlf',
+        'status': 200,
+        'request': {'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]},
+        'page': 1,
+        'totalPages': 1,
+        'results': 1,
+    }
+
+
+def test_logging_includes_query_info(monkeypatch, capsys, client):
+    query_info = {'estimatedCandidateSentences': 2000, 'estimatedWordVisits': 40000}
+
+    def mock_provider_text_query(self, query_result, deadline=None):
+        return QueryResult([], 1, 100, lambda x: None, result_limit=1000, query_info=query_info)
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'text_query', mock_provider_text_query)
+    monkeypatch.setattr(ESVApiTranslationProvider, 'add_translations', lambda self, query_result, deadline=None: None)
+
+    def mock_count_query(self, query, deadline=None):
+        return QueryCounts([['Mark.1.1', 2]], lambda x: None, query_info)
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'count_query', mock_count_query)
+
+    def mock_facet_query(self, facet_query, deadline=None):
+        return FacetCounts({'totalWords': 3, 'attributes': {'case': {'nominative': 3}}}, lambda x: None, query_info)
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'facet_query', mock_facet_query)
+
+    client.post('/api/text/nlf', json={'sequences': []})
+    client.post('/api/text/nlf/count', json={'sequences': []})
+    client.post('/api/text/nlf/facets', json={'query': {'sequences': [[{}]]}, 'sequence': 0, 'wordQuery': 0,
+                                              'attributes': ['case']})
+    [text_entry, count_entry, facet_entry] = get_log_entries(capsys)
+    assert text_entry['resultLimit'] == 1000
+    assert text_entry['queryInfo'] == query_info
+    assert count_entry['totalResults'] == 2
+    assert count_entry['queryInfo'] == query_info
+    assert facet_entry['totalWords'] == 3
+    assert facet_entry['queryInfo'] == query_info
 
 
 def test_logging_for_attribute_query(monkeypatch, capsys, client):
@@ -57,30 +119,23 @@ def test_logging_for_attribute_query(monkeypatch, capsys, client):
         return [f'val1', f'val2']
     monkeypatch.setattr(Nestle1904LowfatProvider, 'attribute_query', mock_attribute_query)
     client.get('/api/text/nlf/attribute/lemma')
-    captured = capsys.readouterr()
-    assert re.search(
-        r"GET /api/text/nlf/attribute/lemma 200\n\t" +
-        r"Time: .*\n\t" +
-        r"Request: None\n\t" +
-        r"Response: <2 results>$",
-        captured.out
-    )
+    [entry] = get_log_entries(capsys)
+    assert entry['method'] == 'GET'
+    assert entry['path'] == '/api/text/nlf/attribute/lemma'
+    assert entry['status'] == 200
+    assert entry['request'] is None
 
 
 def test_logging_for_error(monkeypatch, capsys, client):
-    def mock_provider_text_query(self, query_result):
+    def mock_provider_text_query(self, query_result, deadline=None):
         raise ServerOverwhelmedError('Error message')
     monkeypatch.setattr(Nestle1904LowfatProvider, 'text_query', mock_provider_text_query)
     client.post('/api/text/nlf', json={'sequences': []})
-    captured = capsys.readouterr()
-    assert re.search(
-        r"POST /api/text/nlf 500\n\t" +
-        r"Time: .*\n\t" +
-        r"Request: {'sequences': \[]}\n\t" +
-        r"Response: {'description': 'Error message', 'error': 'Internal Server Error', 'friendlyErrorMessage': " +
-        r"'It looks like the server is currently overwhelmed. Try your search again later.'}$",
-        captured.out
-    )
+    [entry] = get_log_entries(capsys)
+    assert entry['status'] == 500
+    assert entry['request'] == {'sequences': []}
+    assert entry['error'] == 'Error message'
+    assert 'query' in entry['timingsMs']
 
 
 def test_logging_with_proxy_ip(monkeypatch, capsys, client):
@@ -90,15 +145,20 @@ def test_logging_with_proxy_ip(monkeypatch, capsys, client):
     client.get('/api/text/nlf/attribute/lemma', headers={
         'X-Real-Ip': '256.256.256.256'
     })
-    captured = capsys.readouterr()
-    assert re.search(
-        r"256\.256\.256\.256 GET /api/text/nlf/attribute/lemma 200",
-        captured.out
-    )
+    [entry] = get_log_entries(capsys)
+    assert entry['address'] == '256.256.256.256'
+
+
+def test_logging_samples_successful_requests(monkeypatch, capsys, client):
+    monkeypatch.setattr(api_common.request_logger, 'sample_rate', 0)
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'get_stats', lambda self: {})
+    client.get('/api/text/nlf/stats')
+    client.get('/api/text/fake_text/stats')
+    assert [entry['status'] for entry in get_log_entries(capsys)] == [404]
 
 
 def test_text_query_success(monkeypatch, client):
-    def mock_provider_text_query(self, text_query):
+    def mock_provider_text_query(self, text_query, deadline=None):
         return QueryResult([{
             'references': ['Mark.1.1'],
             'words': [{
@@ -109,7 +169,7 @@ def test_text_query_success(monkeypatch, client):
         }], 1, 1, lambda x: None)
     monkeypatch.setattr(Nestle1904LowfatProvider, 'text_query', mock_provider_text_query)
 
-    def mock_add_translations(self, query_result):
+    def mock_add_translations(self, query_result, deadline=None):
         for passage in query_result.passages:
             passage.translation = 'translation text'
     monkeypatch.setattr(ESVApiTranslationProvider, 'add_translations', mock_add_translations)
@@ -139,6 +199,72 @@ def test_text_query_success(monkeypatch, client):
     }
 
 
+def test_text_query_streams_ndjson(monkeypatch, capsys, client):
+    def mock_provider_text_query(self, text_query, deadline=None):
+        return QueryResult([
+            {'references': ['Mark.1.1'], 'words': [{'matchedSequence': 0, 'matchedWordQuery': 0, 'text': 'word'}]},
+            {'references': ['Mark.1.2'], 'words': []},
+        ], 1, 3, lambda x: None)
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'text_query', mock_provider_text_query)
+
+    def mock_add_translations(self, query_result, deadline=None):
+        for passage in query_result.passages:
+            passage.translation = 'translation text'
+    monkeypatch.setattr(ESVApiTranslationProvider, 'add_translations', mock_add_translations)
+
+    response = client.post('/api/text/nlf', json={'sequences': []}, headers={'Accept': 'application/x-ndjson'})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    assert response.headers['X-Accel-Buffering'] == 'no'
+    lines = response.get_data(as_text=True).split('\n')
+    assert [json.loads(line) for line in lines[:-1]] == [
+        {
+            'references': [{'book': 'Mark', 'chapter': 1, 'verse': 1}],
+            'words': [{'matchedSequence': 0, 'matchedWordQuery': 0, 'text': 'word'}],
+            'translation': ''
+        },
+        {'references': [{'book': 'Mark', 'chapter': 1, 'verse': 2}], 'words': [], 'translation': ''},
+        {'translations': ['translation text', 'translation text']},
+        {'pagination': {'page': 1, 'totalPages': 3}},
+    ]
+    assert lines[-1] == ''
+    response.close()
+    [entry] = get_log_entries(capsys)
+    assert entry['results'] == 2
+    assert entry['totalPages'] == 3
+    assert {'query', 'translations', 'stream'} <= set(entry['timingsMs'])
+
+
+def test_text_query_streams_passages_before_translations_fail(monkeypatch, capsys, client):
+    def mock_provider_text_query(self, text_query, deadline=None):
+        return QueryResult([{'references': ['Mark.1.1'], 'words': []}], 1, 1, lambda x: None)
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'text_query', mock_provider_text_query)
+
+    def mock_add_translations(self, query_result, deadline=None):
+        raise QueryTimeoutError('Timed out fetching translations')
+    monkeypatch.setattr(ESVApiTranslationProvider, 'add_translations', mock_add_translations)
+
+    response = client.post('/api/text/nlf', json={'sequences': []}, headers={'Accept': 'application/x-ndjson'})
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert lines[0] == {'references': [{'book': 'Mark', 'chapter': 1, 'verse': 1}], 'words': [], 'translation': ''}
+    assert lines[1]['description'] == 'Timed out fetching translations'
+    assert lines[2] == {'pagination': {'page': 1, 'totalPages': 1}}
+    response.close()
+    [entry] = get_log_entries(capsys)
+    assert entry['error'] == 'Timed out fetching translations'
+
+
+def test_text_query_prefers_json_for_any_accept(monkeypatch, client):
+    def mock_provider_text_query(self, text_query, deadline=None):
+        return QueryResult([], 1, 1, lambda x: None)
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'text_query', mock_provider_text_query)
+    monkeypatch.setattr(ESVApiTranslationProvider, 'add_translations', lambda self, query_result, deadline=None: None)
+
+    response = client.post('/api/text/nlf', json={'sequences': []}, headers={'Accept': '*/*'})
+    assert response.mimetype == 'application/json'
+
+
 def test_text_query_handles_no_json_given(client):
     response = client.post('/api/text/nlf')
     assert response.status_code == 400
@@ -173,7 +299,7 @@ def test_text_query_handles_text_not_found(client):
 
 
 def test_text_query_handles_text_provider_error(monkeypatch, client):
-    def mock_provider_text_query(self, query_result):
+    def mock_provider_text_query(self, query_result, deadline=None):
         raise ServerOverwhelmedError('Error message')
     monkeypatch.setattr(Nestle1904LowfatProvider, 'text_query', mock_provider_text_query)
     response = client.post('/api/text/nlf', json={'sequences': []})
@@ -186,11 +312,11 @@ def test_text_query_handles_text_provider_error(monkeypatch, client):
 
 
 def test_text_query_handles_translation_provider_error(monkeypatch, client):
-    def mock_provider_text_query(self, query_result):
+    def mock_provider_text_query(self, query_result, deadline=None):
         return QueryResult([{'references': ['Mark.1.1'], 'words': []}], 1, 1, lambda x: None)
     monkeypatch.setattr(Nestle1904LowfatProvider, 'text_query', mock_provider_text_query)
 
-    def mock_add_translations(self, query_result):
+    def mock_add_translations(self, query_result, deadline=None):
         raise ServerOverwhelmedError('Error message')
     monkeypatch.setattr(ESVApiTranslationProvider, 'add_translations', mock_add_translations)
 
@@ -203,12 +329,26 @@ def test_text_query_handles_translation_provider_error(monkeypatch, client):
     }
 
 
+def test_text_query_handles_timeout(monkeypatch, client):
+    def mock_provider_text_query(self, text_query, deadline=None):
+        assert deadline.remaining() > 0
+        raise QueryTimeoutError('Timed out')
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'text_query', mock_provider_text_query)
+    response = client.post('/api/text/nlf', json={'sequences': []})
+    assert response.status_code == 504
+    assert get_json_response(response) == {
+        'error': 'Gateway Timeout',
+        'description': 'Timed out',
+        'friendlyErrorMessage': 'Your search took too long to run. Try making it more specific, or try again later.'
+    }
+
+
 def test_text_query_rate_limit(monkeypatch, client):
-    def mock_provider_text_query(self, query_result):
+    def mock_provider_text_query(self, query_result, deadline=None):
         return QueryResult([{'references': ['Mark.1.1'], 'words': []}], 1, 1, lambda x: None)
     monkeypatch.setattr(Nestle1904LowfatProvider, 'text_query', mock_provider_text_query)
 
-    def mock_add_translations(self, query_result):
+    def mock_add_translations(self, query_result, deadline=None):
         return query_result
     monkeypatch.setattr(ESVApiTranslationProvider, 'add_translations', mock_add_translations)
 
@@ -234,6 +374,83 @@ def test_attribute_query_success(monkeypatch, client):
     assert get_json_response(response) == ['lemma_val1', 'lemma_val2']
 
 
+def test_attribute_query_caching_headers(monkeypatch, client):
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'attribute_query', lambda self, attribute_id: ['λόγος'])
+    response = client.get('/api/text/nlf/attribute/lemma')
+    assert response.headers['Cache-Control'] == 'public, max-age=604800'
+    assert re.fullmatch(r'"[0-9a-f]{32}"', response.headers['ETag'])
+
+
+def test_attribute_query_not_modified(monkeypatch, client):
+    calls = []
+
+    def mock_attribute_query(self, attribute_id):
+        calls.append(attribute_id)
+        return ['λόγος']
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'attribute_query', mock_attribute_query)
+    etag = client.get('/api/text/nlf/attribute/lemma').headers['ETag']
+    response = client.get('/api/text/nlf/attribute/lemma', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.get_data() == b''
+    assert response.headers['ETag'] == etag
+    # the values are only looked up once per process
+    assert calls == ['lemma']
+
+    response = client.get('/api/text/nlf/attribute/lemma', headers={'If-None-Match': '"stale"'})
+    assert response.status_code == 200
+    assert get_json_response(response) == ['λόγος']
+
+
+def test_compresses_big_responses(monkeypatch, capsys, client):
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'get_stats', lambda self: {'values': list(range(1000))})
+    response = client.get('/api/text/nlf/stats', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert json.loads(gzip.decompress(response.get_data())) == {'values': list(range(1000))}
+    assert get_log_entries(capsys)[0]['encoding'] == 'gzip'
+
+    response = client.get('/api/text/nlf/stats')
+    assert 'Content-Encoding' not in response.headers
+    assert get_json_response(response) == {'values': list(range(1000))}
+
+
+def test_attribute_query_precompressed(monkeypatch, client):
+    calls = []
+
+    def mock_attribute_query(self, attribute_id):
+        calls.append(attribute_id)
+        return [f'value{i}' for i in range(1000)]
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'attribute_query', mock_attribute_query)
+    plain = client.get('/api/text/nlf/attribute/lemma')
+    compressed = client.get('/api/text/nlf/attribute/lemma', headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(compressed.get_data())) == get_json_response(plain)
+    # each encoding has its own ETag
+    assert compressed.headers['ETag'] != plain.headers['ETag']
+    not_modified = client.get('/api/text/nlf/attribute/lemma', headers={
+        'Accept-Encoding': 'gzip', 'If-None-Match': compressed.headers['ETag']})
+    assert not_modified.status_code == 304
+    assert calls == ['lemma']
+
+
+def test_warm_up_builds_attribute_responses(monkeypatch, client):
+    queried_attributes = []
+
+    def mock_attribute_query(self, attribute_id):
+        queried_attributes.append(attribute_id)
+        # big enough to be compressed
+        return [f'{attribute_id}_val{i}' for i in range(200)]
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'attribute_query', mock_attribute_query)
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'warm_up', lambda self: None)
+    api_common.warm_up_providers()
+    assert queried_attributes == allowed_attributes
+    assert 'gzip' in api_common.attribute_responses[('nlf', 'lemma')][0]
+
+    response = client.get('/api/text/nlf/attribute/lemma', headers={'Accept-Encoding': 'gzip'})
+    assert json.loads(gzip.decompress(response.get_data())) == [f'lemma_val{i}' for i in range(200)]
+    assert queried_attributes == allowed_attributes
+
+
 def test_attribute_query_text_not_found(client):
     response = client.get('/api/text/fake_text/attribute/lemma')
     assert response.status_code == 404
@@ -248,3 +465,151 @@ def test_attribute_query_internal_error(monkeypatch, client):
     assert response.status_code == 500
     assert get_json_response(response)['error'] == 'Internal Server Error'
     assert get_json_response(response)['description'] == 'Error message'
+
+
+def test_provider_stats(monkeypatch, client):
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'get_stats', lambda self: {'admission_gate': {'shed': 2}})
+    response = client.get('/api/text/nlf/stats')
+    assert response.status_code == 200
+    assert get_json_response(response) == {'admission_gate': {'shed': 2}}
+
+
+def test_translation_caches_share_the_esv_verse_limit(monkeypatch, tmp_path):
+    monkeypatch.setattr('app_constants.worker_count', 4)
+    monkeypatch.setattr('app_constants.translation_cache_path', None)
+    memory_cache = api_common._create_translation_cache(500)
+    assert isinstance(memory_cache, MemoryCache)
+    assert memory_cache.max_size == 125
+
+    # one cache for the whole host
+    monkeypatch.setattr('app_constants.translation_cache_path', str(tmp_path / 'translations.sqlite3'))
+    shared_cache = api_common._create_translation_cache(500)
+    assert isinstance(shared_cache, SqliteCache)
+    assert shared_cache.max_size == 500
+
+
+def test_metrics(monkeypatch, client, metrics):
+    def mock_get_stats(self):
+        raise ServerOverwhelmedError('Error message')
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'get_stats', mock_get_stats)
+    client.get('/api/text/nlf/stats')
+    client.get('/api/nowhere')
+
+    response = client.get('/api/metrics')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'text/plain; version=0.0.4; charset=utf-8'
+    lines = response.get_data(as_text=True).splitlines()
+    assert 'anoixo_errors_total{type="ServerOverwhelmedError"} 1' in lines
+    assert 'anoixo_request_seconds_count{endpoint="provider_stats",stage="total"} 1' in lines
+    assert 'anoixo_request_seconds_count{endpoint="unmatched",stage="total"} 1' in lines
+
+
+def test_text_query_is_shed_when_the_host_is_overloaded(monkeypatch, client, metrics):
+    def mock_execute_query(self, query_string, deadline=None):
+        pytest.fail('Query run without a turn')
+    monkeypatch.setattr(Nestle1904LowfatProvider, '_execute_query', mock_execute_query)
+    gate = AdmissionGate(max_in_flight=1, max_waiting=0, max_wait=1, metrics=metrics)
+    monkeypatch.setattr(api_common.text_providers['nlf'], 'admission_gate', gate)
+    # another worker on the host has the only turn
+    other_worker = AdmissionGate(max_in_flight=1, max_waiting=0, max_wait=1, path=gate.path)
+    with other_worker.admit():
+        response = client.post('/api/text/nlf', json={'sequences': []})
+        lines = client.get('/api/metrics').get_data(as_text=True).splitlines()
+    assert response.status_code == 500
+    assert get_json_response(response)['description'] == 'Too many queries are waiting for the database'
+    assert 'anoixo_admission_total{line="normal",outcome="shed"} 1' in lines
+    assert 'anoixo_admission_queries{state="running"} 1' in lines
+
+
+def test_text_query_batch(monkeypatch, client, metrics):
+    def mock_provider_text_query(self, text_query, deadline=None):
+        if not text_query.sequences:
+            raise ServerOverwhelmedError('Error message')
+        return QueryResult([{'references': ['Mark.1.1'], 'words': []}], 1, 1, lambda x: None)
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'text_query', mock_provider_text_query)
+
+    translated_batches = []
+
+    def mock_add_translations_batch(self, query_results, deadline=None):
+        translated_batches.append(query_results)
+        for query_result in query_results:
+            for passage in query_result.passages:
+                passage.translation = 'translation text'
+    monkeypatch.setattr(ESVApiTranslationProvider, 'add_translations_batch', mock_add_translations_batch)
+
+    response = client.post('/api/text/nlf/batch', json=[
+        {'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]},
+        {'sequences': []},
+        {'not': 'a query'},
+    ])
+    assert response.status_code == 200
+    [result, provider_error, parsing_error] = get_json_response(response)
+    assert result['results'][0]['translation'] == 'translation text'
+    assert provider_error['description'] == 'Error message'
+    assert provider_error['status'] == 500
+    assert parsing_error['description'] == 'Error parsing JSON: Does not contain a list \'sequences\''
+    assert parsing_error['status'] == 400
+    # all the successful results are translated together
+    assert len(translated_batches) == 1
+    assert len(translated_batches[0]) == 1
+    # each query's error is counted, even though the batch succeeded
+    assert 'anoixo_errors_total{type="ProbableBugError"} 1' in metrics.render().splitlines()
+    assert 'anoixo_errors_total{type="ServerOverwhelmedError"} 1' in metrics.render().splitlines()
+
+
+def test_text_query_batch_translation_error(monkeypatch, client):
+    def mock_provider_text_query(self, text_query, deadline=None):
+        return QueryResult([{'references': ['Mark.1.1'], 'words': []}], 1, 1, lambda x: None)
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'text_query', mock_provider_text_query)
+
+    def mock_add_translations_batch(self, query_results, deadline=None):
+        raise QueryTimeoutError('Timed out')
+    monkeypatch.setattr(ESVApiTranslationProvider, 'add_translations_batch', mock_add_translations_batch)
+
+    response = client.post('/api/text/nlf/batch', json=[{'sequences': []}, {'sequences': []}])
+    assert response.status_code == 200
+    assert [result['status'] for result in get_json_response(response)] == [504, 504]
+
+
+def test_text_query_batch_must_be_a_small_list(monkeypatch, client):
+    monkeypatch.setattr('app_constants.max_batch_size', 2)
+    response = client.post('/api/text/nlf/batch', json={'sequences': []})
+    assert response.status_code == 400
+    assert get_json_response(response)['description'] == 'Batch is not a list of queries'
+
+    response = client.post('/api/text/nlf/batch', json=[{'sequences': []}] * 3)
+    assert response.status_code == 400
+    assert get_json_response(response)['description'] == 'Batch has 3 queries, more than the limit of 2'
+
+
+def test_count_query(monkeypatch, client):
+    def mock_count_query(self, query, deadline=None):
+        return QueryCounts([['Mark.1.1', 2]], lambda x: None)
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'count_query', mock_count_query)
+    response = client.post('/api/text/nlf/count', json={'sequences': []})
+    assert response.status_code == 200
+    assert get_json_response(response) == {
+        'totalResults': 2,
+        'books': [{'book': 'Mark', 'count': 2, 'chapters': [{'chapter': 1, 'count': 2}]}],
+    }
+
+
+def test_facet_query(monkeypatch, client):
+    def mock_facet_query(self, facet_query, deadline=None):
+        assert facet_query.attributes == ['case']
+        return FacetCounts({'totalWords': 3, 'attributes': {'case': {'nominative': 3}}}, lambda x: None)
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'facet_query', mock_facet_query)
+    response = client.post('/api/text/nlf/facets', json={
+        'query': {'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, 'sequence': 0, 'wordQuery': 0,
+        'attributes': ['case'],
+    })
+    assert response.status_code == 200
+    assert get_json_response(response) == {'totalWords': 3, 'attributes': {'case': {'nominative': 3}}}
+
+
+def test_facet_query_handles_bad_target(client):
+    response = client.post('/api/text/nlf/facets', json={'query': {'sequences': []}, 'sequence': 0, 'wordQuery': 0,
+                                                         'attributes': ['case']})
+    assert response.status_code == 400
+    assert get_json_response(response)['description'] == \
+        'Error parsing JSON: \'sequence\' is not the index of a sequence in the query'
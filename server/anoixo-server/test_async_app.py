@@ -0,0 +1,360 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import pytest
+import threading
+from aiohttp.test_utils import TestClient, TestServer
+from typing import Any, Dict, List
+import api_common
+import async_app
+from async_app import create_app
+from text_providers.Nestle1904LowfatProvider import Nestle1904LowfatProvider
+from translation_providers.ESVApiTranslationProvider import ESVApiTranslationProvider
+from AnoixoError import ServerOverwhelmedError
+from Metrics import Metrics
+from text_providers.AdmissionGate import AdmissionGate
+from QueryCounts import FacetCounts, QueryCounts
+from QueryResult import QueryResult
+
+
+@pytest.fixture(autouse=True)
+def reset_rate_limits():
+    async_app.rate_limit_storage.reset()
+
+
+@pytest.fixture(autouse=True)
+def reset_attribute_responses():
+    yield
+    api_common.attribute_responses.clear()
+
+
+@pytest.fixture
+def mock_providers(monkeypatch):
+    def mock_provider_text_query(self, text_query, deadline=None):
+        return QueryResult([{
+            'references': ['Mark.1.1'],
+            'words': [{'matchedSequence': 0, 'matchedWordQuery': 0, 'text': 'word'}]
+        }], 1, 2, lambda x: None)
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'text_query', mock_provider_text_query)
+
+    async def mock_add_translations_async(self, query_result, deadline=None):
+        for passage in query_result.passages:
+            passage.translation = 'translation text'
+    monkeypatch.setattr(ESVApiTranslationProvider, 'add_translations_async', mock_add_translations_async)
+
+
+def send_requests(*requests: Dict[str, Any]):
+    """
+    Sends each request (keyword arguments for TestClient.request) to a fresh app in turn
+    :return: The status, headers and body of each response
+    """
+    async def send():
+        responses = []
+        async with TestClient(TestServer(await create_app())) as client:
+            for request in requests:
+                response = await client.request(**request)
+                responses.append((response.status, response.headers, await response.text()))
+        return responses
+    return asyncio.run(send())
+
+
+def get_log_entries(capsys) -> List[Dict[str, Any]]:
+    api_common.request_logger.flush()
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+
+def test_text_query_success(mock_providers, capsys):
+    [(status, headers, body)] = send_requests(
+        {'method': 'POST', 'path': '/api/text/nlf', 'json': {'sequences': []}})
+    assert status == 200
+    assert headers['Access-Control-Allow-Origin'] == '*'
+    assert json.loads(body) == {
+        'pagination': {'page': 1, 'totalPages': 2},
+        'results': [{
+            'references': [{'book': 'Mark', 'chapter': 1, 'verse': 1}],
+            'words': [{'matchedSequence': 0, 'matchedWordQuery': 0, 'text': 'word'}],
+            'translation': 'translation text'
+        }],
+    }
+    [entry] = get_log_entries(capsys)
+    assert entry['address'] == '127.0.0.1'
+    assert (entry['method'], entry['path'], entry['status']) == ('POST', '/api/text/nlf', 200)
+    assert entry['request'] == {'sequences': []}
+    assert (entry['page'], entry['totalPages'], entry['results']) == (1, 2, 1)
+    assert {'total', 'query', 'translations', 'serialize'} <= set(entry['timingsMs'])
+
+
+def test_text_query_streams_ndjson(mock_providers):
+    [(status, headers, body)] = send_requests({'method': 'POST', 'path': '/api/text/nlf', 'json': {'sequences': []},
+                                               'headers': {'Accept': 'application/x-ndjson'}})
+    assert status == 200
+    assert headers['Content-Type'] == 'application/x-ndjson'
+    assert headers['Access-Control-Allow-Origin'] == '*'
+    assert headers['X-Accel-Buffering'] == 'no'
+    assert [json.loads(line) for line in body.splitlines()] == [
+        {
+            'references': [{'book': 'Mark', 'chapter': 1, 'verse': 1}],
+            'words': [{'matchedSequence': 0, 'matchedWordQuery': 0, 'text': 'word'}],
+            'translation': ''
+        },
+        {'translations': ['translation text']},
+        {'pagination': {'page': 1, 'totalPages': 2}},
+    ]
+
+
+def test_text_query_handles_no_json_given():
+    [(status, headers, body)] = send_requests({'method': 'POST', 'path': '/api/text/nlf'})
+    assert status == 400
+    assert json.loads(body) == {
+        'error': 'Bad Request',
+        'description': 'Request does not contain a JSON body',
+        'friendlyErrorMessage': 'It looks like there\'s a bug in the app. Please let us know you had this problem so '
+                                'we can fix it!'
+    }
+
+
+def test_text_query_handles_text_provider_error(monkeypatch):
+    def mock_provider_text_query(self, text_query, deadline=None):
+        raise ServerOverwhelmedError('Error message')
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'text_query', mock_provider_text_query)
+    [(status, headers, body)] = send_requests({'method': 'POST', 'path': '/api/text/nlf', 'json': {'sequences': []}})
+    assert status == 500
+    assert json.loads(body) == {
+        'error': 'Internal Server Error',
+        'description': 'Error message',
+        'friendlyErrorMessage': 'It looks like the server is currently overwhelmed. Try your search again later.'
+    }
+
+
+def test_text_query_rate_limit(mock_providers):
+    responses = send_requests(*[{'method': 'POST', 'path': '/api/text/nlf', 'json': {'sequences': []}}] * 13)
+    assert [status for (status, headers, body) in responses] == [200] * 12 + [429]
+    assert json.loads(responses[-1][2]) == {
+        'error': 'Too Many Requests',
+        'description': 'Rate limit exceeded: 12 per 1 minute',
+        'friendlyErrorMessage': 'You\'ve made too many searches in too short a period of time. Try your search again ' +
+                                'later.'
+    }
+
+
+def test_attribute_query_success(monkeypatch):
+    def mock_attribute_query(self, attribute_id):
+        return [f'{attribute_id}_val1', f'{attribute_id}_val2']
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'attribute_query', mock_attribute_query)
+    [(status, headers, body)] = send_requests({'method': 'GET', 'path': '/api/text/nlf/attribute/lemma'})
+    assert status == 200
+    assert json.loads(body) == ['lemma_val1', 'lemma_val2']
+
+
+def test_attribute_query_does_not_wait_for_query_threads(monkeypatch):
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'attribute_query', lambda self, attribute_id: ['value'])
+    # every query thread is busy
+    monkeypatch.setattr(async_app, 'query_threads', ThreadPoolExecutor(max_workers=1))
+    blocker = threading.Event()
+    async_app.query_threads.submit(blocker.wait)
+    try:
+        [(status, headers, body), (metrics_status, _, _)] = send_requests(
+            {'method': 'GET', 'path': '/api/text/nlf/attribute/lemma'},
+            {'method': 'GET', 'path': '/api/metrics'})
+    finally:
+        blocker.set()
+    assert status == 200
+    assert json.loads(body) == ['value']
+    assert metrics_status == 200
+
+
+def test_text_query_is_turned_away_when_too_many_wait_for_query_threads(mock_providers, monkeypatch):
+    monkeypatch.setattr(async_app, 'query_slots', threading.BoundedSemaphore(1))
+    async_app.query_slots.acquire()
+    [(status, headers, body)] = send_requests({'method': 'POST', 'path': '/api/text/nlf', 'json': {'sequences': []}})
+    assert status == 503
+    assert json.loads(body)['description'] == 'Too many queries are waiting for a query thread'
+
+
+def test_query_slots_are_released(mock_providers, monkeypatch):
+    monkeypatch.setattr(async_app, 'query_slots', threading.BoundedSemaphore(1))
+    responses = send_requests(*[{'method': 'POST', 'path': '/api/text/nlf', 'json': {'sequences': []}}] * 3)
+    assert [status for (status, headers, body) in responses] == [200] * 3
+
+
+def test_text_query_waits_for_its_turn_before_taking_a_query_thread(mock_providers, monkeypatch):
+    metrics = Metrics()
+    monkeypatch.setattr('api_common.metrics', metrics)
+    monkeypatch.setattr('async_app.metrics', metrics)
+    gate = AdmissionGate(max_in_flight=1, max_waiting=0, max_wait=1, metrics=metrics)
+    monkeypatch.setattr(api_common.text_providers['nlf'], 'admission_gate', gate)
+    monkeypatch.setattr(async_app, 'query_slots', threading.BoundedSemaphore(1))
+    # another worker on the host has the only turn
+    other_worker = AdmissionGate(max_in_flight=1, max_waiting=0, max_wait=1, path=gate.path)
+    with other_worker.admit():
+        [(status, headers, body), (_, _, metrics_body)] = send_requests(
+            {'method': 'POST', 'path': '/api/text/nlf', 'json': {'sequences': []}},
+            {'method': 'GET', 'path': '/api/metrics'})
+    assert status == 500
+    assert json.loads(body)['description'] == 'Too many queries are waiting for the database'
+    # the query never took a query thread's slot
+    assert async_app.query_slots.acquire(blocking=False)
+    lines = metrics_body.splitlines()
+    assert 'anoixo_admission_total{line="normal",outcome="shed"} 1' in lines
+    assert 'anoixo_admission_queries{state="running"} 1' in lines
+
+
+def test_text_query_runs_in_its_turn(monkeypatch):
+    gate = AdmissionGate(max_in_flight=1, max_waiting=0, max_wait=1)
+    monkeypatch.setattr(api_common.text_providers['nlf'], 'admission_gate', gate)
+
+    def mock_provider_text_query(self, text_query, deadline=None):
+        # sheds the query unless it knows the request already has the turn
+        with self.admission_gate.admit(deadline=deadline):
+            return QueryResult([], 1, 0, lambda x: None)
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'text_query', mock_provider_text_query)
+    [(status, headers, body)] = send_requests({'method': 'POST', 'path': '/api/text/nlf', 'json': {'sequences': []}})
+    assert status == 200
+    assert gate.stats()['admitted'] == 1
+
+
+def test_quick_count_query_does_not_wait_for_a_turn(monkeypatch):
+    gate = AdmissionGate(max_in_flight=1, max_waiting=0, max_wait=1)
+    monkeypatch.setattr(api_common.text_providers['nlf'], 'admission_gate', gate)
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'quick_count_query',
+                        lambda self, query: QueryCounts([['Mark.1.1', 2]], lambda x: None))
+    # another worker on the host has the only turn
+    other_worker = AdmissionGate(max_in_flight=1, max_waiting=0, max_wait=1, path=gate.path)
+    with other_worker.admit():
+        [(status, headers, body)] = send_requests({'method': 'POST', 'path': '/api/text/nlf/count',
+                                                   'json': {'sequences': []}})
+    assert status == 200
+    assert json.loads(body)['totalResults'] == 2
+    assert gate.stats()['shed'] == 0
+
+
+def test_attribute_query_not_modified(monkeypatch, capsys):
+    calls = []
+
+    def mock_attribute_query(self, attribute_id):
+        calls.append(attribute_id)
+        return ['λόγος']
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'attribute_query', mock_attribute_query)
+    [(status, headers, body)] = send_requests({'method': 'GET', 'path': '/api/text/nlf/attribute/lemma'})
+    assert status == 200
+    assert headers['Cache-Control'] == 'public, max-age=604800'
+    [(status, not_modified_headers, body)] = send_requests(
+        {'method': 'GET', 'path': '/api/text/nlf/attribute/lemma', 'headers': {'If-None-Match': headers['ETag']}})
+    assert status == 304
+    assert body == ''
+    assert not_modified_headers['ETag'] == headers['ETag']
+    assert calls == ['lemma']
+    assert [entry['status'] for entry in get_log_entries(capsys)] == [200, 304]
+
+
+def test_compresses_big_responses(monkeypatch, capsys):
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'get_stats', lambda self: {'values': list(range(1000))})
+    [(status, headers, body), (_, plain_headers, plain_body)] = send_requests(
+        {'method': 'GET', 'path': '/api/text/nlf/stats', 'headers': {'Accept-Encoding': 'gzip'}},
+        {'method': 'GET', 'path': '/api/text/nlf/stats', 'headers': {'Accept-Encoding': 'identity'}})
+    # the test client decompresses the body
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert json.loads(body) == {'values': list(range(1000))}
+    assert [entry.get('encoding') for entry in get_log_entries(capsys)] == ['gzip', None]
+    assert 'Content-Encoding' not in plain_headers
+    assert json.loads(plain_body) == json.loads(body)
+
+
+def test_attribute_query_precompressed(monkeypatch):
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'attribute_query',
+                        lambda self, attribute_id: [f'value{i}' for i in range(1000)])
+    [(status, headers, body)] = send_requests({'method': 'GET', 'path': '/api/text/nlf/attribute/lemma',
+                                               'headers': {'Accept-Encoding': 'gzip'}})
+    assert status == 200
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['ETag'].endswith('-gzip"')
+    assert json.loads(body) == [f'value{i}' for i in range(1000)]
+
+
+def test_attribute_query_text_not_found():
+    [(status, headers, body)] = send_requests({'method': 'GET', 'path': '/api/text/fake_text/attribute/lemma'})
+    assert status == 404
+    assert json.loads(body)['error'] == 'Not Found'
+
+
+def test_answers_cors_preflight():
+    [(status, headers, body)] = send_requests({'method': 'OPTIONS', 'path': '/api/text/nlf', 'headers': {
+        'Origin': 'https://example.com',
+        'Access-Control-Request-Method': 'POST',
+        'Access-Control-Request-Headers': 'content-type',
+    }})
+    assert status == 200
+    assert headers['Access-Control-Allow-Origin'] == '*'
+    assert headers['Access-Control-Allow-Headers'] == 'content-type'
+
+
+def test_provider_stats(monkeypatch):
+    threads = []
+
+    def mock_get_stats(self):
+        threads.append(threading.current_thread().name)
+        return {'admission_gate': {'shed': 2}}
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'get_stats', mock_get_stats)
+    [(status, headers, body)] = send_requests({'method': 'GET', 'path': '/api/text/nlf/stats'})
+    assert status == 200
+    assert json.loads(body) == {'admission_gate': {'shed': 2}}
+    assert threads[0].startswith('quick')
+
+
+def test_metrics(monkeypatch):
+    metrics = Metrics()
+    monkeypatch.setattr('api_common.metrics', metrics)
+    monkeypatch.setattr('async_app.metrics', metrics)
+
+    def mock_provider_text_query(self, text_query, deadline=None):
+        raise ServerOverwhelmedError('Error message')
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'text_query', mock_provider_text_query)
+    [_, _, (status, headers, body)] = send_requests(
+        {'method': 'POST', 'path': '/api/text/nlf', 'json': {'sequences': []}},
+        {'method': 'GET', 'path': '/api/nowhere'},
+        {'method': 'GET', 'path': '/api/metrics'},
+    )
+    assert status == 200
+    assert headers['Content-Type'] == 'text/plain; version=0.0.4; charset=utf-8'
+    lines = body.splitlines()
+    assert 'anoixo_errors_total{type="ServerOverwhelmedError"} 1' in lines
+    assert 'anoixo_request_seconds_count{endpoint="text_query",stage="total"} 1' in lines
+    assert 'anoixo_request_seconds_count{endpoint="text_query",stage="query"} 1' in lines
+    assert 'anoixo_request_seconds_count{endpoint="unmatched",stage="total"} 1' in lines
+
+
+def test_text_query_batch(mock_providers, monkeypatch):
+    async def mock_add_translations_batch_async(self, query_results, deadline=None):
+        for query_result in query_results:
+            for passage in query_result.passages:
+                passage.translation = 'translation text'
+    monkeypatch.setattr(ESVApiTranslationProvider, 'add_translations_batch_async', mock_add_translations_batch_async)
+    [(status, headers, body)] = send_requests({'method': 'POST', 'path': '/api/text/nlf/batch', 'json': [
+        {'sequences': []},
+        'not a query',
+    ]})
+    assert status == 200
+    [result, error] = json.loads(body)
+    assert result['results'][0]['translation'] == 'translation text'
+    assert error['description'] == 'Query is not a dictionary'
+    assert error['status'] == 400
+
+
+def test_count_query(monkeypatch):
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'count_query',
+                        lambda self, query, deadline=None: QueryCounts([['Mark.1.1', 2]], lambda x: None))
+    [(status, headers, body)] = send_requests({'method': 'POST', 'path': '/api/text/nlf/count',
+                                               'json': {'sequences': []}})
+    assert status == 200
+    assert json.loads(body)['totalResults'] == 2
+
+
+def test_facet_query(monkeypatch):
+    monkeypatch.setattr(Nestle1904LowfatProvider, 'facet_query', lambda self, facet_query, deadline=None: FacetCounts(
+        {'totalWords': 3, 'attributes': {'case': {'nominative': 3}}}, lambda x: None))
+    [(status, headers, body)] = send_requests({'method': 'POST', 'path': '/api/text/nlf/facets', 'json': {
+        'query': {'sequences': [[{}]]}, 'sequence': 0, 'wordQuery': 0, 'attributes': ['case'],
+    }})
+    assert status == 200
+    assert json.loads(body)['totalWords'] == 3
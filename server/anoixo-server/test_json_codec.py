@@ -0,0 +1,30 @@
+import json
+import pytest
+import json_codec
+
+VALUE = {'results': [{'text': 'λόγος', 'matchedSequence': -1}], 'totalPages': 1}
+
+
+@pytest.fixture(params=['orjson', 'json'])
+def codec(request, monkeypatch):
+    if request.param == 'json':
+        monkeypatch.setattr(json_codec, 'orjson', None)
+    elif json_codec.orjson is None:
+        pytest.skip('orjson is not installed')
+
+
+def test_round_trips(codec):
+    encoded = json_codec.dumps(VALUE)
+    assert isinstance(encoded, bytes)
+    assert json.loads(encoded) == VALUE
+    assert json_codec.loads(encoded) == VALUE
+    assert json_codec.loads(encoded.decode()) == VALUE
+
+
+def test_is_compact_utf8(codec):
+    assert json_codec.dumps(VALUE) == '{"results":[{"text":"λόγος","matchedSequence":-1}],"totalPages":1}'.encode()
+
+
+def test_invalid_json_is_a_json_decode_error(codec):
+    with pytest.raises(json.JSONDecodeError):
+        json_codec.loads('{"results": [')
@@ -0,0 +1,47 @@
+import os
+import threading
+from per_process import BackgroundThread, SqliteConnections
+
+
+def test_sqlite_connections_are_reused_within_a_thread(tmp_path):
+    connections = SqliteConnections(str(tmp_path / 'test.sqlite3'), busy_timeout=1)
+    assert connections.get() is connections.get()
+
+
+def test_sqlite_connections_are_not_shared_between_threads(tmp_path):
+    connections = SqliteConnections(str(tmp_path / 'test.sqlite3'), busy_timeout=1)
+    other_thread_connections = []
+    thread = threading.Thread(target=lambda: other_thread_connections.append(connections.get()))
+    thread.start()
+    thread.join()
+    assert other_thread_connections[0] is not connections.get()
+
+
+def test_sqlite_connections_are_reopened_after_a_fork(monkeypatch, tmp_path):
+    connections = SqliteConnections(str(tmp_path / 'test.sqlite3'), busy_timeout=1)
+    parent_connection = connections.get()
+    monkeypatch.setattr(os, 'getpid', lambda: -1)
+    assert connections.get() is not parent_connection
+
+
+def test_background_thread_starts_once_in_each_process(monkeypatch):
+    runs = []
+    setups = []
+    started = threading.Semaphore(0)
+
+    def run():
+        runs.append(threading.current_thread().name)
+        started.release()
+    thread = BackgroundThread(run, 'test-thread', before_start=lambda: setups.append(os.getpid()))
+    assert not thread.is_running()
+    thread.ensure_started()
+    thread.ensure_started()
+    assert started.acquire(timeout=2)
+    assert thread.is_running()
+
+    monkeypatch.setattr(os, 'getpid', lambda: -1)
+    assert not thread.is_running()
+    thread.ensure_started()
+    assert started.acquire(timeout=2)
+    assert runs == ['test-thread', 'test-thread']
+    assert len(setups) == 2
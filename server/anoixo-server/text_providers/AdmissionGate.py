@@ -0,0 +1,310 @@
+import asyncio
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+import math
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, Generator, Iterator, List, Optional, Tuple, TypeVar
+from AnoixoError import ServerOverwhelmedError
+from Deadline import Deadline
+from Metrics import Metrics
+from per_process import SqliteConnections
+from text_providers.TextProvider import QueryTurn
+
+T = TypeVar('T')
+
+# The gate whose turn the current query is run with, if any, so it doesn't wait for another turn
+_holding: ContextVar[Optional['AdmissionGate']] = ContextVar('holding_admission_gate', default=None)
+
+
+class AdmissionGate:
+    """
+    Caps how many database queries run at once, so overload turns away requests up front instead of piling more queries
+    onto a struggling database.
+
+    Up to `max_in_flight` queries run at once. Beyond that, up to `max_waiting` queries wait in line for up to
+    `max_wait` seconds each, and anything else is shed immediately with a ServerOverwhelmedError. Priority queries
+    (cheap ones like attribute lookups) have their own line, which is always served first and doesn't count against
+    `max_waiting`.
+
+    The lines are kept in an SQLite database. Given a path (on a memory-backed filesystem like /dev/shm), every worker
+    process on the host shares them, so the limits apply to the host's queries together. Without one, the gate uses a
+    private database, and its limits apply to this process alone. Waiting queries check for their turn every
+    POLL_INTERVAL seconds.
+    """
+
+    POLL_INTERVAL = 0.01  # seconds
+    # How long to wait on another worker's write lock before giving up on checking the lines
+    BUSY_TIMEOUT = 1  # seconds
+
+    def __init__(self, max_in_flight: int, max_waiting: int, max_wait: float, path: Optional[str] = None,
+                 metrics: Optional[Metrics] = None):
+        """
+        :param metrics: Where to record how many queries are admitted, shed or time out, and how long they wait
+        """
+        self.max_in_flight = max_in_flight
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        if path is None:
+            directory = tempfile.mkdtemp(prefix='anoixo-admission-')
+            atexit.register(shutil.rmtree, directory, ignore_errors=True)
+            path = os.path.join(directory, 'admission.sqlite3')
+        self.path = path
+        self._connections = SqliteConnections(path, self.BUSY_TIMEOUT)
+        self.metrics = metrics or Metrics()
+        self.metrics.add_gauge('anoixo_admission_queries', self._gauge_values)
+
+        self._lock = threading.Lock()
+        # Checks the lines for admit_async, off the event loop. Having just one also keeps each turn's checks in order.
+        self._checks = ThreadPoolExecutor(max_workers=1, thread_name_prefix='admission')
+        # tickets that couldn't be given back because the database was busy, to give back next time
+        self._unreleased: List[int] = []
+        # counted in this process
+        self._admitted = 0
+        self._shed = 0
+        self._timed_out = 0
+        self._total_wait = 0.0
+        self._longest_wait = 0.0
+
+        with self._connections.get() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            # A ticket for each query waiting or running, numbered in the order they arrived
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS tickets (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    pid INTEGER NOT NULL,
+                    priority INTEGER NOT NULL,
+                    running INTEGER NOT NULL
+                )
+            ''')
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        connection = self._connections.get()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def _clean_up(self, connection: sqlite3.Connection) -> None:
+        """
+        Gives back tickets this process couldn't before, and the tickets of worker processes that died holding them
+        """
+        with self._lock:
+            unreleased, self._unreleased = self._unreleased, []
+        connection.executemany('DELETE FROM tickets WHERE id = ?', [(ticket,) for ticket in unreleased])
+        for (pid,) in connection.execute('SELECT DISTINCT pid FROM tickets WHERE pid != ?', (os.getpid(),)).fetchall():
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                connection.execute('DELETE FROM tickets WHERE pid = ?', (pid,))
+            except PermissionError:
+                pass  # it's alive, just not ours to signal
+
+    def _start_if_next(self, connection: sqlite3.Connection, ticket: int, priority: bool) -> bool:
+        """
+        :return: Whether the ticket's query can run now, in which case the ticket is marked as running
+        """
+        (running,) = connection.execute('SELECT COUNT(*) FROM tickets WHERE running = 1').fetchone()
+        if running >= self.max_in_flight:
+            return False
+        (next_priority,) = connection.execute(
+            'SELECT MIN(id) FROM tickets WHERE running = 0 AND priority = 1').fetchone()
+        if priority:
+            is_next = next_priority == ticket
+        else:
+            (next_normal,) = connection.execute(
+                'SELECT MIN(id) FROM tickets WHERE running = 0 AND priority = 0').fetchone()
+            is_next = next_priority is None and next_normal == ticket
+        if is_next:
+            connection.execute('UPDATE tickets SET running = 1 WHERE id = ?', (ticket,))
+        return is_next
+
+    def _join_line(self, priority: bool) -> Tuple[Optional[int], bool]:
+        """
+        :return: The query's ticket (or None if the line was full) and whether it can run right away
+        """
+        with self._transaction() as connection:
+            self._clean_up(connection)
+            ticket = connection.execute('INSERT INTO tickets (pid, priority, running) VALUES (?, ?, 0)',
+                                        (os.getpid(), int(priority))).lastrowid
+            if self._start_if_next(connection, ticket, priority):
+                return ticket, True
+            if not priority:
+                (waiting,) = connection.execute(
+                    'SELECT COUNT(*) FROM tickets WHERE running = 0 AND priority = 0 AND id != ?', (ticket,)).fetchone()
+                if waiting >= self.max_waiting:
+                    connection.execute('DELETE FROM tickets WHERE id = ?', (ticket,))
+                    return None, False
+            return ticket, False
+
+    def _take_turn(self, ticket: int, priority: bool) -> bool:
+        """
+        :return: Whether it's the ticket's turn
+        """
+        try:
+            with self._transaction() as connection:
+                return self._start_if_next(connection, ticket, priority)
+        except sqlite3.Error:
+            return False
+
+    def _release(self, ticket: int) -> None:
+        try:
+            with self._transaction() as connection:
+                connection.execute('DELETE FROM tickets WHERE id = ?', (ticket,))
+        except sqlite3.Error:
+            with self._lock:
+                self._unreleased.append(ticket)
+
+    def _record(self, line: str, outcome: str, waited: Optional[float] = None) -> None:
+        self.metrics.increment('anoixo_admission_total', line=line, outcome=outcome)
+        if waited is not None:
+            self.metrics.observe('anoixo_admission_wait_seconds', waited, line=line)
+        with self._lock:
+            if outcome == 'admitted':
+                self._admitted += 1
+            elif outcome == 'shed':
+                self._shed += 1
+            else:
+                self._timed_out += 1
+            if waited is not None:
+                self._total_wait += waited
+                self._longest_wait = max(self._longest_wait, waited)
+
+    def _turn(self, priority: bool, deadline: Optional[Deadline]) -> Generator[Optional[float], None, None]:
+        """
+        Joins a line and waits for the query's turn. Yields how long to sleep before checking again, so the sleeping can
+        be done in a thread or on an event loop, then None once it's the query's turn. Closing the generator gives back
+        the turn, or leaves the line if it's still waiting.
+        """
+        line = 'priority' if priority else 'normal'
+        start = time.monotonic()
+        try:
+            (ticket, admitted) = self._join_line(priority)
+        except sqlite3.Error as err:
+            raise ServerOverwhelmedError(f'Error joining the line for the database: {type(err).__name__}')
+        if ticket is None:
+            self._record(line, 'shed')
+            raise ServerOverwhelmedError('Too many queries are waiting for the database')
+
+        try:
+            while not admitted:
+                waited = time.monotonic() - start
+                give_up = waited >= self.max_wait or (deadline is not None and deadline.expired())
+                admitted = self._take_turn(ticket, priority)
+                if not admitted and give_up:
+                    self._record(line, 'timed_out', waited)
+                    if deadline:
+                        deadline.check()
+                    raise ServerOverwhelmedError(f'Timed out after {waited:.1f} seconds waiting for the database')
+                if not admitted:
+                    time_left = min(self.max_wait - waited, deadline.remaining() if deadline else math.inf)
+                    yield min(self.POLL_INTERVAL, time_left)
+            self._record(line, 'admitted', time.monotonic() - start)
+            yield None
+        finally:
+            self._release(ticket)
+
+    @contextmanager
+    def admit(self, priority: bool = False, deadline: Optional[Deadline] = None) -> Iterator[None]:
+        """
+        Waits for a turn to query the database, and gives it up when the with block finishes. Does nothing in a query
+        run by a turn from admit_async.
+        :param priority: Whether to use the priority line
+        :param deadline: If given, a query never waits past it
+        """
+        if _holding.get() is self:
+            yield
+            return
+        turn = self._turn(priority, deadline)
+        try:
+            for sleep in turn:
+                if sleep is None:
+                    break
+                time.sleep(sleep)
+            yield
+        finally:
+            turn.close()
+
+    async def admit_async(self, priority: bool = False, deadline: Optional[Deadline] = None) -> QueryTurn:
+        """
+        Does the same as admit, waiting on the event loop, for callers that run the query in another thread. The gate's
+        database is only touched from the gate's own thread, so a busy database never blocks the event loop.
+        :return: The query's turn, which it runs the query with
+        """
+        turn = self._turn(priority, deadline)
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                sleep = await loop.run_in_executor(self._checks, next, turn)
+                if sleep is None:
+                    return _GateTurn(self, turn)
+                await asyncio.sleep(sleep)
+        except BaseException:
+            # like when the client disconnects; leaves the line after any check still running on the gate's thread
+            self._checks.submit(turn.close)
+            raise
+
+    def _counts(self) -> Dict[str, int]:
+        """
+        :return: How many queries are running and waiting in each line, on the host if the gate is shared
+        """
+        try:
+            rows = self._connections.get().execute(
+                'SELECT running, priority, COUNT(*) FROM tickets GROUP BY running, priority').fetchall()
+        except sqlite3.Error:
+            rows = []
+        counts = {'running': 0, 'waiting': 0, 'waiting_priority': 0}
+        for (running, priority, count) in rows:
+            state = 'running' if running else 'waiting_priority' if priority else 'waiting'
+            counts[state] += count
+        return counts
+
+    def _gauge_values(self) -> List[Tuple[Dict[str, str], float]]:
+        return [({'state': state}, count) for state, count in self._counts().items()]
+
+    def stats(self) -> Dict[str, float]:
+        counts = self._counts()
+        with self._lock:
+            waited = self._admitted + self._timed_out
+            return {
+                'max_in_flight': self.max_in_flight,
+                'max_waiting': self.max_waiting,
+                # in_flight and the waiting counts are for everything sharing the gate; the rest are for this process
+                'in_flight': counts['running'],
+                'waiting': counts['waiting'],
+                'waiting_priority': counts['waiting_priority'],
+                'admitted': self._admitted,
+                'shed': self._shed,
+                'timed_out': self._timed_out,
+                # wait times are averaged over every query that was admitted or timed out, including ones that didn't
+                # have to wait at all
+                'mean_wait': self._total_wait / waited if waited else 0.0,
+                'longest_wait': self._longest_wait,
+            }
+
+
+class _GateTurn(QueryTurn):
+    def __init__(self, gate: AdmissionGate, turn: Generator[Optional[float], None, None]):
+        self.gate = gate
+        self.turn = turn
+
+    def run(self, function: Callable[..., T], *args: Any) -> T:
+        token = _holding.set(self.gate)
+        try:
+            return function(*args)
+        finally:
+            _holding.reset(token)
+            self.turn.close()
+
+    def give_back(self) -> None:
+        self.gate._checks.submit(self.turn.close)
@@ -0,0 +1,131 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Tuple
+from BaseXClient import BaseXClient
+
+
+class SessionPoolExhaustedError(Exception):
+    pass
+
+
+class BaseXSessionPool:
+    """
+    A bounded, thread-safe pool of long-lived BaseX sessions.
+
+    Opening a session means a TCP connect, an authentication handshake and (for our providers) opening a database, so
+    sessions are kept open and reused across queries. At most `max_size` sessions are open at once; callers that can't
+    get one within `checkout_timeout` seconds get a SessionPoolExhaustedError. Sessions that have sat idle for longer
+    than `health_check_after` seconds are pinged before being handed out, and any session that raises while in use is
+    assumed to be broken and is closed instead of being returned to the pool.
+    """
+
+    def __init__(self, connect: Callable[[], BaseXClient.Session], max_size: int = 4, checkout_timeout: float = 5,
+                 health_check_after: float = 30):
+        self._connect = connect
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.health_check_after = health_check_after
+
+        self._condition = threading.Condition()
+        # idle sessions along with when they were last checked in; used as a stack so the warmest session goes out first
+        self._idle: List[Tuple[BaseXClient.Session, float]] = []
+        self._open = 0  # idle + checked out sessions
+
+        self._created = 0
+        self._evicted = 0
+        self._checkouts = 0
+        self._waits = 0
+
+    def _is_healthy(self, session: BaseXClient.Session) -> bool:
+        try:
+            session.execute('xquery 1')
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, session: BaseXClient.Session) -> None:
+        try:
+            session.close()
+        except Exception:
+            pass  # the session is being thrown away anyway
+        with self._condition:
+            self._open -= 1
+            self._evicted += 1
+            self._condition.notify()
+
+    def checkout(self) -> BaseXClient.Session:
+        deadline = time.monotonic() + self.checkout_timeout
+        while True:
+            with self._condition:
+                while not self._idle and self._open >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise SessionPoolExhaustedError('Timed out waiting for a free BaseX session')
+                    self._waits += 1
+                    self._condition.wait(remaining)
+
+                self._checkouts += 1
+                if self._idle:
+                    session, last_used = self._idle.pop()
+                else:
+                    session, last_used = None, None
+                    self._open += 1
+
+            if session is None:
+                try:
+                    session = self._connect()
+                except Exception:
+                    with self._condition:
+                        self._open -= 1
+                        self._condition.notify()
+                    raise
+                with self._condition:
+                    self._created += 1
+                return session
+
+            if time.monotonic() - last_used < self.health_check_after or self._is_healthy(session):
+                return session
+            self._discard(session)  # and try again with another session
+
+    def checkin(self, session: BaseXClient.Session, broken: bool = False) -> None:
+        if broken:
+            self._discard(session)
+            return
+        with self._condition:
+            self._idle.append((session, time.monotonic()))
+            self._condition.notify()
+
+    @contextmanager
+    def session(self) -> Iterator[BaseXClient.Session]:
+        """
+        Checks out a session for the duration of a `with` block. If the block raises, the session is evicted from the
+        pool rather than reused, since there's no telling what state its connection was left in.
+        """
+        session = self.checkout()
+        try:
+            yield session
+        except BaseException:
+            self.checkin(session, broken=True)
+            raise
+        self.checkin(session)
+
+    def close_all(self) -> None:
+        with self._condition:
+            idle = self._idle
+            self._idle = []
+        for session, _ in idle:
+            self._discard(session)
+
+    def stats(self) -> Dict[str, int]:
+        with self._condition:
+            return {
+                'max_size': self.max_size,
+                'open': self._open,
+                'idle': len(self._idle),
+                'in_use': self._open - len(self._idle),
+                'created': self._created,
+                'evicted': self._evicted,
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+            }
@@ -0,0 +1,201 @@
+from array import array
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+import xml.etree.ElementTree as ElementTree
+from Deadline import Deadline
+from TextQuery import TextQuery, WordSequence
+
+"""
+For each word in a matching sentence that matched a word query, which word query in which sequence it matched. Indexed
+by sequence; each entry maps word indexes to the index of the word query the word matched.
+"""
+SequenceMatches = List[Dict[int, int]]
+
+
+class ColumnarCorpus:
+    """
+    A treebank held in memory as flat arrays ("columns") with one entry per word, so queries can be answered without a
+    database.
+
+    Words are numbered in document order, and the words of each sentence are numbered contiguously. For every word
+    there's its sentence, its position in the text (its rank when all words are ordered by their `n` attribute, the
+    same as the `position` attribute added to the BaseX database), its text with any following punctuation, and an
+    integer code for each attribute's value (or -1 if the word doesn't have that attribute). For every attribute value
+    there's also a sorted list of the words that have it.
+    """
+
+    def __init__(self, attributes: List[str]):
+        self.attributes = attributes
+        self.values: Dict[str, List[str]] = {attribute: [] for attribute in attributes}  # code -> value
+        self.codes: Dict[str, Dict[str, int]] = {attribute: {} for attribute in attributes}  # value -> code
+        self.columns: Dict[str, array] = {attribute: array('i') for attribute in attributes}
+        self.postings: Dict[str, List[array]] = {attribute: [] for attribute in attributes}
+
+        self.texts: List[str] = []
+        self.positions = array('i')
+        self.word_sentences = array('i')
+        # index of the first word of each sentence, plus the total number of words at the end
+        self.sentence_starts = array('i', [0])
+        self.sentence_references: List[Tuple[str, ...]] = []
+
+    @classmethod
+    def from_xml(cls, path: str, attributes: List[str]) -> 'ColumnarCorpus':
+        corpus = cls(attributes)
+        word_orders: List[str] = []
+        for sentence in ElementTree.parse(path).getroot().iter('sentence'):
+            # a word's text includes the punctuation element immediately following it, if there is one
+            punctuation: Dict[int, str] = {}
+            for parent in sentence.iter():
+                children = list(parent)
+                for child, next_child in zip(children, children[1:]):
+                    if child.tag == 'w' and next_child.tag == 'pc':
+                        punctuation[id(child)] = ''.join(next_child.itertext())
+
+            for word in sentence.iter('w'):
+                corpus._add_word(word.text or '', punctuation.get(id(word), ''), word.attrib)
+                word_orders.append(word.get('n', ''))
+            corpus.sentence_starts.append(len(corpus.texts))
+            corpus.sentence_references.append(
+                tuple(milestone.get('id') for milestone in sentence.iter('milestone') if milestone.get('id')))
+
+        corpus._finish(word_orders)
+        return corpus
+
+    def _add_word(self, text: str, punctuation: str, attributes: Dict[str, str]) -> None:
+        self.texts.append(text + punctuation)
+        self.word_sentences.append(len(self.sentence_references))
+        for attribute in self.attributes:
+            value = attributes.get(attribute)
+            if value is None:
+                self.columns[attribute].append(-1)
+                continue
+            code = self.codes[attribute].get(value)
+            if code is None:
+                code = len(self.values[attribute])
+                self.codes[attribute][value] = code
+                self.values[attribute].append(value)
+            self.columns[attribute].append(code)
+
+    def _finish(self, word_orders: List[str]) -> None:
+        self.positions = array('i', [0]) * len(word_orders)
+        for position, word in enumerate(sorted(range(len(word_orders)), key=word_orders.__getitem__), start=1):
+            self.positions[word] = position
+
+        for attribute in self.attributes:
+            postings = [array('i') for _ in self.values[attribute]]
+            for word, code in enumerate(self.columns[attribute]):
+                if code >= 0:
+                    postings[code].append(word)
+            self.postings[attribute] = postings
+
+    def sentence_count(self) -> int:
+        return len(self.sentence_references)
+
+    def _words_matching(self, attributes: Dict[str, str]) -> Optional[array]:
+        """
+        :return: Sorted indexes of all words with the given attribute values, or None if any word matches
+        """
+        if not attributes:
+            return None
+        postings: List[array] = []
+        for attribute, value in attributes.items():
+            code = self.codes[attribute].get(value)
+            if code is None:
+                return array('i')
+            postings.append(self.postings[attribute][code])
+        postings.sort(key=len)
+        matching = postings[0]
+        for other in postings[1:]:
+            other_words = set(other)
+            matching = array('i', [word for word in matching if word in other_words])
+        return matching
+
+    def _words_in_sentence(self, words: Optional[array], sentence: int) -> List[int]:
+        start = self.sentence_starts[sentence]
+        end = self.sentence_starts[sentence + 1]
+        if words is None:
+            return list(range(start, end))
+        return list(words[bisect_left(words, start):bisect_left(words, end)])
+
+    def _match_sequence(self, candidates: List[List[int]], links: List[Optional[int]]) -> Dict[int, int]:
+        """
+        Finds every combination of one candidate word per word query where the words are in order and within the
+        allowed distance of each other. Combinations are visited in the same order as nested loops over the candidates
+        would, and a word that's part of several combinations keeps the word query index from the first one.
+        """
+        positions = self.positions
+        matches: Dict[int, int] = {}
+        chosen: List[int] = []
+
+        def extend(depth: int) -> None:
+            if depth == len(candidates):
+                for word_query_index, word in enumerate(chosen):
+                    matches.setdefault(word, word_query_index)
+                return
+            for word in candidates[depth]:
+                if chosen:
+                    distance = positions[word] - positions[chosen[-1]]
+                    if distance <= 0:
+                        continue
+                    allowed_words_between = links[depth - 1]
+                    if allowed_words_between is not None and distance > allowed_words_between + 1:
+                        continue
+                chosen.append(word)
+                extend(depth + 1)
+                chosen.pop()
+
+        if candidates:
+            extend(0)
+        return matches
+
+    def find_matches(self, query: TextQuery, deadline: Optional[Deadline] = None) -> List[Tuple[int, SequenceMatches]]:
+        """
+        :param deadline: If given, searching stops with a QueryTimeoutError once it has passed
+        :return: Each sentence where every sequence in the query matched, in document order, along with the words that
+        matched each sequence
+        """
+        sequence_words: List[List[Optional[array]]] = [
+            [self._words_matching(word_query.attributes) for word_query in sequence.word_queries]
+            for sequence in query.sequences
+        ]
+
+        # Only sentences containing at least one candidate word for every word query can match
+        candidate_sentences = set(range(self.sentence_count()))
+        for words_for_sequence in sequence_words:
+            if not words_for_sequence:
+                return []  # an empty sequence never matches anything
+            for words in words_for_sequence:
+                if words is not None:
+                    candidate_sentences.intersection_update(self.word_sentences[word] for word in words)
+
+        matches: List[Tuple[int, SequenceMatches]] = []
+        for sentence in sorted(candidate_sentences):
+            if deadline:
+                deadline.check()
+            sentence_matches: SequenceMatches = []
+            for sequence, words_for_sequence in zip(query.sequences, sequence_words):
+                sequence_match = self._match_sequence(
+                    [self._words_in_sentence(words, sentence) for words in words_for_sequence],
+                    self._links(sequence))
+                if not sequence_match:
+                    break
+                sentence_matches.append(sequence_match)
+            else:
+                matches.append((sentence, sentence_matches))
+        return matches
+
+    def _links(self, sequence: WordSequence) -> List[Optional[int]]:
+        return [word_query.link_to_next_word.allowed_words_between if word_query.link_to_next_word else None
+                for word_query in sequence.word_queries]
+
+    def words_in_order(self, sentence: int) -> List[int]:
+        return sorted(range(self.sentence_starts[sentence], self.sentence_starts[sentence + 1]),
+                      key=self.positions.__getitem__)
+
+    def word_attributes(self, word: int) -> Dict[str, str]:
+        attributes: Dict[str, str] = {}
+        for attribute in self.attributes:
+            code = self.columns[attribute][word]
+            if code >= 0:
+                attributes[attribute] = self.values[attribute][code]
+        return attributes
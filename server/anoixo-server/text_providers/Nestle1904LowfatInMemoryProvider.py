@@ -0,0 +1,134 @@
+import math
+import threading
+from typing import Any, Dict, List, Optional
+from AnoixoError import ProbableBugError, ServerOverwhelmedError
+import app_constants
+from Deadline import Deadline
+from FacetQuery import FacetQuery
+from QueryCounts import FacetCounts, QueryCounts
+from QueryResult import QueryResult
+from text_providers.ColumnarCorpus import ColumnarCorpus, SequenceMatches
+from text_providers.nlf_attributes import allowed_attributes, check_attributes, check_query_attributes, sanitized
+from text_providers.TextProvider import TextProvider
+from TextQuery import TextQuery
+
+
+class Nestle1904LowfatInMemoryProvider(TextProvider):
+    """
+    Answers queries on the Nestle 1904 Lowfat treebank entirely in-process, from a ColumnarCorpus loaded from the
+    treebank's XML file, instead of going through BaseX. Results are the same as Nestle1904LowfatProvider's.
+
+    The corpus is loaded on the first query, or when load() is called.
+    """
+
+    def __init__(self, xml_path: str):
+        self.xml_path = xml_path
+        self._corpus: Optional[ColumnarCorpus] = None
+        self._load_lock = threading.Lock()
+
+    def get_provided_text_name(self) -> str:
+        return 'New Testament (Greek)'
+
+    def get_source_name(self) -> str:
+        return 'Nestle 1904 Lowfat Treebank'
+
+    def load(self) -> ColumnarCorpus:
+        with self._load_lock:
+            if self._corpus is None:
+                try:
+                    self._corpus = ColumnarCorpus.from_xml(self.xml_path, allowed_attributes)
+                except Exception as err:
+                    raise ServerOverwhelmedError(f'Error loading treebank XML: {type(err).__name__}')
+            return self._corpus
+
+    def warm_up(self) -> None:
+        self.load()
+
+    def _build_passage(self, corpus: ColumnarCorpus, sentence: int,
+                       sentence_matches: SequenceMatches) -> Dict[str, Any]:
+        words: List[Dict[str, Any]] = []
+        for word in corpus.words_in_order(sentence):
+            matched_sequence = -1
+            matched_word_query = -1
+            for sequence_index, sequence_match in enumerate(sentence_matches):
+                if word in sequence_match:
+                    matched_sequence = sequence_index
+                    matched_word_query = sequence_match[word]
+                    break
+            words.append({
+                'text': corpus.texts[word],
+                'matchedSequence': matched_sequence,
+                'matchedWordQuery': matched_word_query,
+                **corpus.word_attributes(word),
+            })
+        return {'references': list(corpus.sentence_references[sentence]), 'words': words}
+
+    def text_query(self, query: TextQuery, deadline: Optional[Deadline] = None) -> QueryResult:
+        check_query_attributes(query)
+        query = sanitized(query)
+        corpus = self.load()
+
+        matches = corpus.find_matches(query, deadline)
+        total_pages = math.ceil(len(matches) / app_constants.page_size) or 1
+        if query.page > total_pages:
+            raise ProbableBugError(
+                f'Requested page {query.page} is out of bounds for results with {total_pages} total pages')
+        page_start = (query.page - 1) * app_constants.page_size
+        page_end = page_start + app_constants.page_size
+
+        def on_parsing_error(message: str):
+            raise ProbableBugError(f'Error building results: {message}')
+
+        passages = [self._build_passage(corpus, sentence, sentence_matches)
+                    for (sentence, sentence_matches) in matches[page_start:page_end]]
+        return QueryResult(passages, query.page, total_pages, on_parsing_error)
+
+    def count_query(self, query: TextQuery, deadline: Optional[Deadline] = None) -> QueryCounts:
+        check_query_attributes(query)
+        query = sanitized(query)
+        corpus = self.load()
+
+        # Matches are in text order, so each chapter's matches are next to each other
+        chapter_counts: List[List[Any]] = []
+        for (sentence, _) in corpus.find_matches(query, deadline):
+            first_reference = corpus.sentence_references[sentence][0]
+            chapter = first_reference.rsplit('.', 1)[0]
+            if chapter_counts and chapter_counts[-1][0].rsplit('.', 1)[0] == chapter:
+                chapter_counts[-1][1] += 1
+            else:
+                chapter_counts.append([first_reference, 1])
+
+        def on_parsing_error(message: str):
+            raise ProbableBugError(f'Error building counts: {message}')
+
+        return QueryCounts(chapter_counts, on_parsing_error)
+
+    def facet_query(self, facet_query: FacetQuery, deadline: Optional[Deadline] = None) -> FacetCounts:
+        check_query_attributes(facet_query.text_query)
+        check_attributes(facet_query.attributes)
+        query = sanitized(facet_query.text_query)
+        corpus = self.load()
+
+        total_words = 0
+        value_counts: Dict[str, Dict[str, int]] = {attribute: {} for attribute in facet_query.attributes}
+        for (_, sentence_matches) in corpus.find_matches(query, deadline):
+            for (word, word_query_index) in sentence_matches[facet_query.sequence_index].items():
+                if word_query_index != facet_query.word_query_index:
+                    continue
+                total_words += 1
+                word_attributes = corpus.word_attributes(word)
+                for attribute, counts in value_counts.items():
+                    if attribute in word_attributes:
+                        counts[word_attributes[attribute]] = counts.get(word_attributes[attribute], 0) + 1
+
+        def on_parsing_error(message: str):
+            raise ProbableBugError(f'Error building counts: {message}')
+
+        return FacetCounts({'totalWords': total_words, 'attributes': value_counts}, on_parsing_error)
+
+    def attribute_names(self) -> List[str]:
+        return allowed_attributes
+
+    def attribute_query(self, attribute_name: str) -> List[str]:
+        check_attributes([attribute_name])
+        return sorted(self.load().values[attribute_name])
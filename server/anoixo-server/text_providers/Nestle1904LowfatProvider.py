@@ -1,31 +1,69 @@
-from typing import Any, Callable, Dict, List, Union
-from AnoixoError import AnoixoError, ProbableBugError, ServerOverwhelmedError
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Union
+from AnoixoError import AnoixoError, ProbableBugError, QueryTimeoutError, QueryTooExpensiveError, \
+    ServerOverwhelmedError
 import app_constants
 from BaseXClient import BaseXClient
 import math
+from FacetQuery import FacetQuery
+from QueryCounts import FacetCounts, QueryCounts
 from QueryResult import QueryResult
-from text_providers.TextProvider import TextProvider
-from TextQuery import TextQuery
+from caching.CacheBackend import CacheBackend
+from caching.MemoryCache import MemoryCache
+from Deadline import Deadline
+import json_codec
+from Metrics import Metrics
+from text_providers.AdmissionGate import AdmissionGate
+from text_providers.BaseXSessionPool import BaseXSessionPool, SessionPoolExhaustedError
+from text_providers.QueryCostEstimator import QueryCost, QueryCostEstimator
+from text_providers.QueryPlanner import QueryPlanner
+from text_providers.QueryResultCache import QueryResultCache
+from text_providers.nlf_attributes import allowed_attributes, check_attributes, check_query_attributes, sanitize
+from text_providers.SentenceIndex import SentenceIndex
+from text_providers.TextProvider import QueryTurn, TextProvider
+from TextQuery import TextQuery, WordQuery
 import json
 from text_providers import Nestle1904LowfatProvider_Config as Config
-
-allowed_attributes = [
-    'class',
-    'lemma',
-    'normalized',
-    'person',
-    'number',
-    'gender',
-    'case',
-    'tense',
-    'voice',
-    'mood'
-]
+import threading
+import time
 
 
 class Nestle1904LowfatProvider(TextProvider):
-    def __init__(self):
-        self.cache: Dict[str, Any] = {}
+    DATABASE_NAME = 'nestle1904lowfat'
+    # Maximum number of BaseX sessions each worker keeps open, and so the most queries it runs at once
+    SESSION_POOL_SIZE = 4
+    # The most queries run at once by every worker on the host together (when they share app_constants.admission_path),
+    # few enough that any one worker can run them all on its own sessions
+    MAX_QUERIES_IN_FLIGHT = SESSION_POOL_SIZE
+    # How many text queries on the host can wait for a turn, and for how long, before more are turned away
+    MAX_WAITING_QUERIES = 8
+    MAX_QUERY_WAIT = 2  # seconds
+    # How long to wait before trying again to load the sentence index after it fails to, doubling after each failure
+    SENTENCE_INDEX_RETRY_MIN = 5  # seconds
+    SENTENCE_INDEX_RETRY_MAX = 300  # seconds
+    # Bump this whenever the database build changes, so cached results from the old build aren't served
+    CORPUS_VERSION = '2'
+
+    def __init__(self, cache: Optional[CacheBackend] = None, metrics: Optional[Metrics] = None):
+        """
+        :param cache: Where to cache attribute values and query results. Pass a shared backend to share the cache
+        between worker processes; otherwise this provider keeps its own in-memory cache.
+        :param metrics: Where to record query timings, result sizes and retries
+        """
+        self.cache = cache or MemoryCache(app_constants.cache_max_size, app_constants.cache_ttl)
+        self.metrics = metrics or Metrics()
+        self.session_pool = BaseXSessionPool(self._connect_to_basex, max_size=self.SESSION_POOL_SIZE)
+        self.admission_gate = AdmissionGate(self.MAX_QUERIES_IN_FLIGHT, self.MAX_WAITING_QUERIES, self.MAX_QUERY_WAIT,
+                                            app_constants.admission_path, self.metrics)
+        # Runs the queries in a batch at the same time, each on its own pooled session
+        self.batch_threads = ThreadPoolExecutor(max_workers=self.SESSION_POOL_SIZE, thread_name_prefix='nlf-batch')
+        self.result_cache = QueryResultCache(self.cache, self.CORPUS_VERSION)
+        self.sentence_index: Optional[SentenceIndex] = None
+        self._sentence_index_lock = threading.Lock()
+        # when to try loading the sentence index again, if it failed to load
+        self._sentence_index_retry_at: Optional[float] = None
+        self._sentence_index_retry_delay = self.SENTENCE_INDEX_RETRY_MIN
+        self.attribute_values: Optional[Dict[str, List[str]]] = None
 
     def get_provided_text_name(self) -> str:
         return 'New Testament (Greek)'
@@ -38,160 +76,230 @@ class Nestle1904LowfatProvider(TextProvider):
                                       Config.basex['port'],
                                       Config.basex['username'],
                                       Config.basex['password'])
-        session.execute('open nestle1904lowfat')
+        session.execute(f'open {self.DATABASE_NAME}')
         return session
 
-    def _close_basex_session(self, session: Union[BaseXClient.Session, None]) -> None:
-        if session:
-            try:
-                session.close()
-            except BrokenPipeError:
-                pass
+    def _with_timeout(self, query_string: str, timeout: float) -> str:
+        """
+        Wraps a query so that BaseX itself stops running it after `timeout` seconds (rounded up to a whole second),
+        rather than leaving it running on the server after we've given up on it.
+        """
+        # XQuery string literals escape quotes by doubling them, and are parsed for entity references
+        escaped_query = query_string.replace('&', '&amp;').replace('\'', '\'\'')
+        return f"xquery:eval('{escaped_query}', map {{}}, map {{'timeout': {max(1, math.ceil(timeout))}}})"
+
+    def _execute_query(self, query_string: str, deadline: Optional[Deadline] = None) -> str:
+        with self.metrics.time('anoixo_basex_query_seconds'):
+            raw_results = self._execute_query_with_retries(query_string, deadline)
+        self.metrics.observe('anoixo_basex_result_bytes', len(raw_results))
+        return raw_results
 
-    def _execute_query(self, query_string: str) -> str:
-        session = None
+    def _execute_query_with_retries(self, query_string: str, deadline: Optional[Deadline] = None) -> str:
         exception = None
         for retry in range(3):
+            if deadline:
+                deadline.check()
+            if retry:
+                self.metrics.increment('anoixo_basex_retries_total')
             try:
-                session = self._connect_to_basex()
-                return session.query(query_string).execute()
+                with self.session_pool.session() as session:
+                    if deadline:
+                        return session.query(self._with_timeout(query_string, deadline.remaining())).execute()
+                    return session.query(query_string).execute()
+            except SessionPoolExhaustedError:
+                raise  # retrying would just mean waiting on the pool again
             except Exception as err:
+                if deadline and deadline.expired():
+                    # BaseX stopped the query for running out of time; running it again would just do the same
+                    raise QueryTimeoutError(f'XML database query exceeded the request\'s time budget of '
+                                            f'{deadline.budget} seconds')
                 exception = err
-            finally:
-                self._close_basex_session(session)
 
         # if this code is reached, the last retry errored out with an exception
         raise exception
 
-    def _check_attributes(self, query: TextQuery) -> None:
-        for sequence in query.sequences:
-            for word_query in sequence.word_queries:
-                for attribute in word_query.attributes:
-                    if attribute not in allowed_attributes:
-                        raise ProbableBugError(f'Attribute \'{attribute}\' not allowed')
+    def _estimate_matches(self, word_query: WordQuery) -> float:
+        """
+        Estimates how many words match a word query, for QueryPlanner. Without the sentence index's statistics every
+        word query looks the same, so the query is searched in the order the user gave.
+        """
+        if self.sentence_index is None:
+            return 0
+        return self.sentence_index.estimated_matches(word_query, sanitize)
 
-    def _sanitize(self, string: str) -> str:
+    def _indexed_sentence_lookup(self, query: TextQuery) -> str:
         """
-        Sanitizes a user-input string so it can be safely included in an XQuery query without the risk of injection
-        attacks.
-        :param string: The string to sanitize
-        :return: The sanitized string
+        Builds an XQuery expression for the sentences that contain a word matching every word query with attributes,
+        found with the database's attribute index instead of walking every sentence. Each word query is looked up by its
+        rarest attribute value (or its first, without the sentence index's statistics), and any other attributes filter
+        the words found. Produces something like:
+        (db:attribute('nestle1904lowfat', 'κύριος', 'lemma')/parent::w[@case='genitive']/ancestor::sentence)
+        intersect (db:attribute('nestle1904lowfat', 'Ἰησοῦς', 'lemma')/parent::w/ancestor::sentence)
         """
-        return string.replace('&', '').replace('\'', '’')
+        def value_count(attribute: str, value: str) -> int:
+            if self.sentence_index is None:
+                return 0
+            return self.sentence_index.value_counts.get(attribute, {}).get(sanitize(value), 0)
+
+        lookups: List[str] = []
+        for sequence in query.sequences:
+            for word_query in sequence.word_queries:
+                if not word_query.attributes:
+                    continue  # any sentence has a word matching this
+                # min() keeps the first attribute on ties
+                indexed_attribute = min(word_query.attributes,
+                                        key=lambda key: value_count(key, word_query.attributes[key]))
+                other_filters = " and ".join(f"@{key}='{sanitize(val)}'"
+                                             for key, val in word_query.attributes.items() if key != indexed_attribute)
+                lookups.append(
+                    f"(db:attribute('{self.DATABASE_NAME}', "
+                    f"'{sanitize(word_query.attributes[indexed_attribute])}', '{indexed_attribute}')"
+                    f"/parent::w{f'[{other_filters}]' if other_filters else ''}/ancestor::sentence)")
+        return '\nintersect '.join(lookups) if lookups else '//sentence'
 
     """
-    Builds an XQuery string to find matches for the given TextQuery.
+    Builds an XQuery string to find matches for the given TextQuery. If candidate_sentences is given, only those
+    sentences (0-indexed, in document order) are searched. Otherwise, sentences are found through the database's
+    attribute index if use_attribute_index is set, or by walking every sentence if it isn't. If result_limit is given,
+    the search stops once it has found one more matching sentence than that, so the results can say there are more.
+
+    The query returns the matches in order, each as the matching sentence's `index` and what each sequence matched in
+    it, like `[{"sentence": 3, "sequences": [{"n40001001001": 0}]}]`. Pass some of them back as page_matches to build
+    the full results for just those sentences instead, without searching again.
+
+    If counts_only is set, the query counts the matching sentences in each chapter instead (see QueryCounts for the
+    format). If facet_query is given (for the same text query), the query counts the values of the facet query's
+    attributes on its word query's matches instead (see FacetCounts for the format).
+
+    The query relies on the attributes added to the database when it's built (see basex_setup.bxs): `position` and
+    `punctuated` on words, and `index` and `references` on sentences.
 
     TODO: Split this function up into smaller pieces. Sorry for how long this is. At least it's mostly comments.
     """
-    def _build_query_string(self, query: TextQuery) -> str:
+    def _build_query_string(self, query: TextQuery, candidate_sentences: Optional[List[int]] = None,
+                            use_attribute_index: bool = True, result_limit: Optional[int] = None,
+                            counts_only: bool = False, facet_query: Optional[FacetQuery] = None,
+                            page_matches: Optional[List[Dict[str, Any]]] = None) -> str:
         # the code for getting matches for each sequence
         sequence_matchers: List[str] = []
-        # checks for whether a sequence had matches
-        sequence_match_checks: List[str] = []
         # variables with what index a word matched in each sequence (if any)
         index_in_sequences_variables: List[str] = []
         # clauses to get a matched word's sequence index
         sequence_index_getters: List[str] = []
         # clauses to get a matched word's index within its sequence
         word_query_index_getters: List[str] = []
+        # entries saving each sequence's matches alongside its sentence, and declarations restoring them
+        saved_sequence_matches: List[str] = []
+        restored_sequence_matches: List[str] = []
 
+        planner = QueryPlanner(self._estimate_matches)
         for sequence_index, sequence in enumerate(query.sequences):
             """
-            First, build XQuery loops to grab matching words for each sequence. The goal is to produce something like 
-            this for every sequence:
-            let $matching_sequence0 :=
-              for $word0 in $sentence//w[@lemma='κύριος' and @case='genitive']
-              for $word1 in $sentence//w[@lemma='Ἰησοῦς' and @case='genitive']
-              for $word2 in $sentence//w[@lemma='Χριστός' and @case='genitive']
-              let $pos0 := xs:integer($word0/@position)
+            First, build XQuery loops to grab matching words for each sequence. QueryPlanner decides which word query to
+            look for first; every other word query is then only looked for within the allowed range of positions next
+            to a word that has already matched. The goal is to produce something like this for every sequence (here
+            Ἰησοῦς is the rarest word, so it's looked for first):
+            let $matching_sequence0 := map:merge(
+              for $word1 in $sentence//w[@lemma='Ἰησοῦς']
               let $pos1 := xs:integer($word1/@position)
+              for $word0 in $sentence//w[@lemma='κύριος'][@position < $pos1 and @position >= $pos1 - 1]
+              let $pos0 := xs:integer($word0/@position)
+              for $word2 in $sentence//w[@lemma='Χριστός'][@position > $pos1 and @position <= $pos1 + 1]
               let $pos2 := xs:integer($word2/@position)
-              where ($pos0 < $pos1) and ($pos1 < $pos2) and ($pos1 - $pos0 <= 1) and ($pos2 - pos1 <= 1)
+              order by db:node-pre($word0), db:node-pre($word1), db:node-pre($word2)
               return map {$word0/@osisId: 0, $word1/@osisId: 1, $word2/@osisId: 2}
+            )
             """
             sequence_var = f'$matching_sequence{sequence_index}'
 
-            word_match_variables: List[str] = []  # names for the variables containing words matched by each word query
-            position_variables: List[str] = []  # names for the variables containing the position of each matched word
-            position_variable_declarations: List[str] = []  # declarations of those position variables
-            word_matchers: List[str] = []  # loops for getting matches for each word query
-            # how many words are allowed between a given word query and the next word query, if there is any restriction
-            words_between_filters: List[Union[int, None]] = []
+            word_matchers: List[str] = []  # loops for getting matches for each word query, in the planned order
             # dictionary entries mapping the word's ID to its matched word query index
             word_ids_to_indexes: List[str] = []
-            for word_query_index, word_query in enumerate(sequence.word_queries):
+            plan = planner.plan_sequence(sequence)
+            for (word_query_index, neighbour_index) in plan:
+                word_query = sequence.word_queries[word_query_index]
                 word_variable = f'$word{word_query_index}'
-                word_match_variables.append(word_variable)
-
-                # Create a variable for this word's position/order, and a declaration of it. The declaration will look
-                # something like:
-                # let $pos0 := xs:integer($word0/@position)
-                pos_var = f'$pos{word_query_index}'
-                position_variables.append(pos_var)
-                position_variable_declarations.append(f'let {pos_var} := xs:integer({word_variable}/@position)')
 
                 # A filter string for only matching words with the given attributes. Will look something like:
                 # `[@lemma='κύριος' and @case='genitive']`
                 if word_query.attributes:
                     attribute_filters = " and ".join([
                         # key has already been checked using check_attributes
-                        f"@{key}='{self._sanitize(val)}'" for key, val in word_query.attributes.items()
+                        f"@{key}='{sanitize(val)}'" for key, val in word_query.attributes.items()
                     ])
                     attribute_filter_string = f'[{attribute_filters}]'
                 else:
                     attribute_filter_string = ''
 
-                # Collect information about words between restrictions for each word query
-                if word_query.link_to_next_word:
-                    words_between_filters.append(word_query.link_to_next_word.allowed_words_between)
-                else:
-                    words_between_filters.append(None)
-
-                # A loop for grabbing matches for this word query. Will look something like:
+                # A filter string for only matching words in order with the neighbouring word that already matched,
+                # and within any restriction on allowed words between them. Will look something like:
+                # `[@position > $pos0 and @position <= $pos0 + 1]`
+                position_filter_string = ''
+                if neighbour_index is not None:
+                    neighbour_pos_var = f'$pos{neighbour_index}'
+                    if neighbour_index > word_query_index:
+                        # this word comes before its neighbour, and its own link restricts the distance between them
+                        position_filters = [f'@position < {neighbour_pos_var}']
+                        link = word_query.link_to_next_word
+                        if link:
+                            position_filters.append(
+                                f'@position >= {neighbour_pos_var} - {link.allowed_words_between + 1}')
+                    else:
+                        position_filters = [f'@position > {neighbour_pos_var}']
+                        link = sequence.word_queries[neighbour_index].link_to_next_word
+                        if link:
+                            position_filters.append(
+                                f'@position <= {neighbour_pos_var} + {link.allowed_words_between + 1}')
+                    position_filter_string = f'[{" and ".join(position_filters)}]'
+
+                # A loop for grabbing matches for this word query, and a declaration of the matched word's position.
+                # Will look something like:
                 # for $word0 in $sentence//w[@lemma='κύριος' and @case='genitive']
-                word_matchers.append(f'for {word_variable} in $sentence//w{attribute_filter_string}')
-
-                # Will be used to build a dictionary mapping word IDs to their matched word query indexes. Looks like:
-                # $word0/@osisId: 0
-                word_ids_to_indexes.append(f'{word_variable}/@osisId: {word_query_index}')
-
-            for_matching_words = ' '.join(word_matchers)
-            let_position_variables = '\n'.join(position_variable_declarations)
-
-            # Build conditionals to only keep matched words that are in order and follow any restrictions on allowed
-            # words between matches. Will look something like:
-            # where ($pos0 < $pos1) and ($pos1 < $pos2) and ($pos1 - $pos0 <= 1) and ($pos2 - pos1 <= 1)
-            position_variable_pairs = \
-                [position_variables[index:index + 2] for index in range(0, len(position_variables) - 1)]
-            word_order_checks = [f'({pos1} < {pos2})' for (pos1, pos2) in position_variable_pairs]
-            for filter_word_query_index, allowed_words_between in enumerate(words_between_filters):
-                if allowed_words_between is None:
-                    continue
-                (word_position, following_word_position) = position_variable_pairs[filter_word_query_index]
-                word_order_checks.append(
-                    f'({following_word_position} - {word_position} <= {allowed_words_between + 1})')
-            # There will not be anything in word_order_checks if there was just 1 word query in the sequence
-            where_words_in_order = \
-                f'where {" and ".join(word_order_checks)}' if word_order_checks else ''
+                # let $pos0 := xs:integer($word0/@position)
+                word_matchers.append(
+                    f'for {word_variable} in $sentence//w{attribute_filter_string}{position_filter_string}\n'
+                    f'let $pos{word_query_index} := xs:integer({word_variable}/@position)')
+
+            # A word that's part of several matches keeps the word query index from the first match in the order that
+            # nested loops in the user's order would find them. If the plan changed the loop order, sort the matches
+            # back into that order. Looks like:
+            # order by db:node-pre($word0), db:node-pre($word1)
+            word_query_indexes = [word_query_index for (word_query_index, _) in plan]
+            if word_query_indexes != sorted(word_query_indexes):
+                order_by_user_order = 'order by ' + ', '.join(
+                    f'db:node-pre($word{word_query_index})' for word_query_index in sorted(word_query_indexes))
+            else:
+                order_by_user_order = ''
 
             # Build the dictionary mapping word IDs to their matched word query indexes. Looks like:
             # map {$word0/@osisId: 0, $word1/@osisId: 1}
+            word_ids_to_indexes = [f'$word{word_query_index}/@osisId: {word_query_index}'
+                                   for word_query_index in range(len(sequence.word_queries))]
             word_id_to_index_map = f'map {{{", ".join(word_ids_to_indexes)}}}'
 
-            sequence_matcher = f"""
-                let {sequence_var} := map:merge(
-                    {for_matching_words}
-                    {let_position_variables}
-                    {where_words_in_order}
-                    return {word_id_to_index_map}
-                )
-            """
-            sequence_matchers.append(sequence_matcher)
-
-            # Build a check for whether this sequence found any matches. Looks like:
-            # (map:size($matching_sequence0) > 0)
-            sequence_match_checks.append(f'(map:size({sequence_var}) > 0)')
+            if word_matchers:
+                for_matching_words = '\n'.join(word_matchers)
+                sequence_matcher = f"""
+                    let {sequence_var} := map:merge(
+                        {for_matching_words}
+                        {order_by_user_order}
+                        return {word_id_to_index_map}
+                    )
+                """
+            else:
+                # an empty sequence never matches anything
+                sequence_matcher = f'let {sequence_var} := map {{}}'
+
+            # Stop looking at the sentence as soon as a sequence doesn't match. Looks like:
+            # where map:size($matching_sequence0) > 0
+            sequence_matchers.append(f'{sequence_matcher}\nwhere map:size({sequence_var}) > 0')
+
+            # Matches are collected before the requested page is picked out, so each sequence's matches need to be saved
+            # alongside their sentence and then restored when building the page. These will look like:
+            # "sequence0": $matching_sequence0
+            # let $matching_sequence0 := $match?sequence0
+            saved_sequence_matches.append(f'"sequence{sequence_index}": {sequence_var}')
+            restored_sequence_matches.append(f'let {sequence_var} := $match?sequence{sequence_index}')
 
             """
             Now we're onto handling the results found by the sequence matchers. Let's build:
@@ -222,10 +330,11 @@ class Nestle1904LowfatProvider(TextProvider):
         """
         Now that we've built code snippets for each sequence, let's finally build the full query!
         """
-        get_matching_sequences = '\n'.join(sequence_matchers)
-        # Produces something like:
-        # where (map:size($matching_sequence0) > 0) and (map:size($matching_sequence1) > 0)
-        where_matching_sequences_found = f'where {" and ".join(sequence_match_checks)}'
+        # The most selective sequences are checked first, so most sentences are ruled out before the others are searched
+        get_matching_sequences = '\n'.join(sequence_matchers[sequence_index]
+                                            for sequence_index in planner.plan_sequences(query))
+        save_sequence_matches = ''.join(f',\n{entry}' for entry in saved_sequence_matches)
+        restore_sequence_matches = '\n'.join(restored_sequence_matches)
         declare_index_in_sequences_variables = '\n'.join(index_in_sequences_variables)
         # Produces something like:
         # if (not(empty($index_in_sequence_0))) then 0
@@ -244,111 +353,494 @@ class Nestle1904LowfatProvider(TextProvider):
         attribute_getters = [f'"{attribute}": data($w/@{attribute})' for attribute in allowed_attributes]
         get_addl_attributes = ",\n".join(attribute_getters)
 
-        return f"""
-        declare function local:punctuated($w as node()) as xs:string {{
-          let $punc := $w/following-sibling::*[1][name()='pc']
-          let $text := $w/text()
-          return
-            if ($punc) then $text || $punc
-            else $text
-        }};
-        
-        json:serialize(
-          array {{
-            for $sentence in //sentence
-            {get_matching_sequences}
-            {where_matching_sequences_found}
-            return map {{
-              "references": array {{for $ref in $sentence//milestone/@id return string($ref)}},
-              "sentence": $sentence//p/text(),
-              "words":  array {{
-                for $w in $sentence//w
-                {declare_index_in_sequences_variables}
-                order by $w/@position 
+        if page_matches is not None:
+            # The page's matches were found by an earlier query, so each sentence is looked up through the attribute
+            # index by its `index` attribute and given the matches saved for it, instead of being searched again.
+            # Produces something like:
+            # (map {
+            # "sentence": db:attribute('nestle1904lowfat', '3', 'index')/parent::sentence,
+            # "sequence0": map {'n40001001001': 0}
+            # })
+            saved_matches = ',\n'.join(self._saved_match(match) for match in page_matches)
+            return f"""
+            let $matches := ({saved_matches})
+            return json:serialize(
+              array {{
+                for $match in $matches
+                let $sentence := $match?sentence
+                {restore_sequence_matches}
                 return map {{
-                  "text": local:punctuated($w),
-                  "matchedSequence": {matched_sequence_switch},
-                  "matchedWordQuery": {matched_word_query_switch},
-                  {get_addl_attributes}
+                  "references": array {{tokenize($sentence/@references)}},
+                  "sentence": $sentence//p/text(),
+                  "words":  array {{
+                    for $w in $sentence//w
+                    {declare_index_in_sequences_variables}
+                    order by $w/@position 
+                    return map {{
+                      "text": string($w/@punctuated),
+                      "matchedSequence": {matched_sequence_switch},
+                      "matchedWordQuery": {matched_word_query_switch},
+                      {get_addl_attributes}
+                    }}
+                  }}
                 }}
               }}
+            )
+            """
+
+        # Look up candidate sentences through the attribute index by their `index` attribute, which counts sentences
+        # from 1 in document order. Produces something like:
+        # for $sentence_index in ('3', '17', '42')
+        # let $sentence := db:attribute('nestle1904lowfat', $sentence_index, 'index')/parent::sentence
+        # Without candidate sentences, the attribute index finds the sentences to search.
+        if candidate_sentences is None:
+            sentences = self._indexed_sentence_lookup(query) if use_attribute_index else '//sentence'
+            for_sentences = f'for $sentence in {sentences}'
+        else:
+            sentence_indexes = ", ".join(f"'{sentence + 1}'" for sentence in candidate_sentences)
+            for_sentences = f'for $sentence_index in ({sentence_indexes})\n' \
+                            f"let $sentence := db:attribute('{self.DATABASE_NAME}', $sentence_index, 'index')" \
+                            f'/parent::sentence'
+
+        # Counting only needs the matching sentences themselves
+        if counts_only:
+            match = '$sentence'
+        else:
+            match = f'map {{\n"sentence": $sentence{save_sequence_matches}\n}}'
+        # BaseX stops evaluating the loop over sentences once subsequence() has all the matches it asks for
+        find_matches = f"""
+          {for_sentences}
+          {get_matching_sequences}
+          return {match}
+        """
+        if result_limit is not None:
+            find_matches = f'subsequence(({find_matches}), 1, {result_limit + 1})'
+
+        if counts_only:
+            # Group matches by the chapter of their first reference, like `Matt.1` for `Matt.1.1`
+            return f"""
+            let $matches := {find_matches}
+            return json:serialize(
+              array {{
+                for $sentence in $matches
+                let $first_reference := tokenize($sentence/@references)[1]
+                group by $chapter := replace($first_reference, '\\.[^.]*$', '')
+                order by db:node-pre($sentence[1])
+                return array {{$first_reference[1], count($sentence)}}
+              }}
+            )
+            """
+
+        if facet_query:
+            # The word query's matches are the words whose ID the sequence's matches map to the word query's index
+            facet_sequence_var = f'$matching_sequence{facet_query.sequence_index}'
+            count_facet_values = ",\n".join(f'"{attribute}": {self._count_values(f"$words/@{attribute}")}'
+                                             for attribute in facet_query.attributes)
+            return f"""
+            let $matches := {find_matches}
+            let $words :=
+              for $match in $matches
+              let $sentence := $match?sentence
+              let {facet_sequence_var} := $match?sequence{facet_query.sequence_index}
+              for $id in map:keys({facet_sequence_var})
+              where {facet_sequence_var}($id) = {facet_query.word_query_index}
+              return $sentence//w[@osisId = $id]
+            return json:serialize(
+              map {{
+                "totalWords": count($words),
+                "attributes": map {{
+                  {count_facet_values}
+                }}
+              }}
+            )
+            """
+
+        # Each match is the sentence's index and the matches for each sequence, which is all a page of results needs to
+        # be built from later. Produces something like:
+        # "sequences": array {$match?sequence0, $match?sequence1}
+        get_sequences = ', '.join(f'$match?sequence{sequence_index}' for sequence_index in range(len(query.sequences)))
+        return f"""
+        let $matches := {find_matches}
+        return json:serialize(
+          array {{
+            for $match in $matches
+            return map {{
+              "sentence": xs:integer($match?sentence/@index),
+              "sequences": array {{{get_sequences}}}
             }}
           }}
         )
         """
 
-    def _execute_query_and_process_results(self, query_string: str, process_results: Callable):
-        try:
-            raw_results = self._execute_query(query_string)
-        except Exception as err:
-            raise ServerOverwhelmedError(f'Error executing XML database query: {type(err).__name__}')
+    def _saved_match(self, match: Dict[str, Any]) -> str:
+        """
+        :param match: A match from the query _build_query_string builds without page_matches
+        :return: An XQuery expression for the match as the query had it before it was serialized
+        """
+        # the word IDs come from the database, but are sanitized like anything else put in a query
+        saved_sequences = ''.join(
+            f',\n"sequence{sequence_index}": map {{'
+            + ', '.join(f"'{sanitize(word_id)}': {int(word_query_index)}"
+                        for word_id, word_query_index in sequence_matches.items())
+            + '}'
+            for sequence_index, sequence_matches in enumerate(match['sequences']))
+        return f"map {{\n\"sentence\": db:attribute('{self.DATABASE_NAME}', '{int(match['sentence'])}', 'index')" \
+               f"/parent::sentence{saved_sequences}\n}}"
+
+    async def admit_async(self, priority: bool = False, deadline: Optional[Deadline] = None) -> QueryTurn:
+        return await self.admission_gate.admit_async(priority, deadline)
+
+    def _execute_query_and_get_raw_results(self, query_string: str, deadline: Optional[Deadline] = None,
+                                           priority: bool = False) -> str:
+        """
+        :param priority: Whether this is a cheap query that should skip ahead of waiting text queries
+        """
+        with self.admission_gate.admit(priority, deadline):
+            try:
+                return self._execute_query(query_string, deadline)
+            except QueryTimeoutError:
+                raise
+            except Exception as err:
+                raise ServerOverwhelmedError(f'Error executing XML database query: {type(err).__name__}')
 
+    def _process_raw_results(self, raw_results: str, process_results: Callable):
         try:
-            return process_results(raw_results)
+            with self.metrics.time('anoixo_result_processing_seconds'):
+                return process_results(raw_results)
         except AnoixoError:
             raise
         except Exception as err:
             raise ProbableBugError(f'Error processing query results: {type(err).__name__}')
 
-    def text_query(self, query: TextQuery) -> QueryResult:
-        self._check_attributes(query)
+    @staticmethod
+    def _count_values(attribute_nodes: str) -> str:
+        """
+        :param attribute_nodes: An XQuery expression for some attribute nodes, like `$sentence//w/@class`
+        :return: An XQuery expression for a map from each of the attributes' values to how many of them have it, like:
+        map:merge(for $value in $sentence//w/@class group by $key := string($value) return map {$key: count($value)})
+        """
+        return f'map:merge(for $value in {attribute_nodes} group by $key := string($value) ' \
+               f'return map {{$key: count($value)}})'
+
+    def _candidate_sentence_list(self, candidates: Optional[int]) -> Optional[List[int]]:
+        """
+        :param candidates: A bitmap of candidate sentences from the sentence index, if it's loaded
+        :return: The candidate sentences to pass to _build_query_string, or None to search every sentence
+        """
+        if candidates is None or candidates == self.sentence_index.all_sentences:
+            return None
+        return SentenceIndex.sentence_indexes(candidates)
+
+    def _estimate_cost(self, query: TextQuery, candidates: int) -> QueryCost:
+        """
+        :return: The estimated cost of running the query, after checking it isn't over the limit
+        """
+        cost = QueryCostEstimator(self.sentence_index, sanitize).estimate(query, candidates)
+        if cost.word_visits > app_constants.query_cost_limit:
+            raise QueryTooExpensiveError(f'Query would look at about {cost.word_visits} words, more than the limit of '
+                                         f'{app_constants.query_cost_limit}')
+        return cost
+
+    def text_query(self, query: TextQuery, deadline: Optional[Deadline] = None) -> QueryResult:
+        return self._text_query(query, deadline)
 
-        query_string = self._build_query_string(query)
+    def quick_text_query(self, query: TextQuery) -> Optional[QueryResult]:
+        return self._text_query(query, use_database=False)
+
+    def _text_query(self, query: TextQuery, deadline: Optional[Deadline] = None,
+                    use_database: bool = True) -> Optional[QueryResult]:
+        """
+        :param use_database: If False, None is returned instead of querying the database
+        """
+        check_query_attributes(query)
+        if use_database:
+            self._retry_loading_sentence_index()
+
+        # Without the sentence index, there's nothing to estimate the query's cost from, so it always runs in full
+        candidates = None
+        cost = None
+        result_limit = None
+        if self.sentence_index:
+            candidates = self.sentence_index.candidate_sentences(query, sanitize)
+            cost = self._estimate_cost(query, candidates)
+            # the candidates are an upper bound on the number of results, so smaller queries never hit the limit
+            if cost.candidate_sentences > app_constants.query_result_limit:
+                result_limit = app_constants.query_result_limit
+
+        def on_parsing_error(message: str):
+            raise ProbableBugError(f'Error parsing XML database response JSON: {message}')
+
+        def process_matches(raw_matches: str) -> List[Dict[str, Any]]:
+            matches = json_codec.loads(raw_matches)
+            if not (isinstance(matches, list) and
+                    all(isinstance(match, dict) and isinstance(match.get('sentence'), int) and
+                        isinstance(match.get('sequences'), list) for match in matches)):
+                on_parsing_error('Matches are not a list of sentences with the matches for each sequence')
+            return matches
+
+        # Every page of a search is built from the same matches, so they're only searched for once
+        matches = self.result_cache.get_matches(query)
+        if matches is None:
+            if candidates == 0:
+                # nothing can match, so there's no need to ask the database
+                matches = []
+            elif not use_database:
+                return None
+            else:
+                query_string = self._build_query_string(query, self._candidate_sentence_list(candidates),
+                                                        result_limit=result_limit)
+                raw_matches = self._execute_query_and_get_raw_results(query_string, deadline)
+                matches = self._process_raw_results(raw_matches, process_matches)
+                # only cache matches that processed successfully
+                self.result_cache.set_matches(query, matches, size=len(raw_matches))
+
+        # With a result limit, the database stops after finding one more match than the limit
+        total_results = len(matches)
+        hit_result_limit = result_limit is not None and total_results > result_limit
+        if hit_result_limit:
+            total_results = result_limit
+
+        total_pages = math.ceil(total_results / app_constants.page_size) or 1
+        if query.page > total_pages:
+            raise ProbableBugError(
+                f'Requested page {query.page} is out of bounds for results with {total_pages} total pages')
+        page_start = (query.page - 1) * app_constants.page_size
+        page_matches = matches[page_start:min(page_start + app_constants.page_size, total_results)]
 
         def process_results(raw_results: str) -> QueryResult:
+            results_for_page = json_codec.loads(raw_results)
+            if not isinstance(results_for_page, list):
+                on_parsing_error('Results are not a list')
+
+            # Attributes a word doesn't have come back as nulls
+            for result in results_for_page:
+                for i, word in enumerate(result["words"]):
+                    if None in word.values():
+                        result["words"][i] = {key: value for key, value in word.items() if value is not None}
+
+            return QueryResult(results_for_page, query.page, total_pages, on_parsing_error,
+                               result_limit=result_limit if hit_result_limit else None,
+                               query_info=cost.serialize() if cost else None)
+
+        if not page_matches:
+            return self._process_raw_results('[]', process_results)
+        if not use_database:
+            return None
+        # Only the sentences on the requested page get their full word payload built and serialized
+        query_string = self._build_query_string(query, page_matches=page_matches)
+        raw_results = self._execute_query_and_get_raw_results(query_string, deadline)
+        return self._process_raw_results(raw_results, process_results)
+
+    def count_query(self, query: TextQuery, deadline: Optional[Deadline] = None) -> QueryCounts:
+        return self._count_query(query, deadline)
+
+    def quick_count_query(self, query: TextQuery) -> Optional[QueryCounts]:
+        return self._count_query(query, use_database=False)
+
+    def _count_query(self, query: TextQuery, deadline: Optional[Deadline] = None,
+                     use_database: bool = True) -> Optional[QueryCounts]:
+        """
+        :param use_database: If False, None is returned instead of querying the database
+        """
+        check_query_attributes(query)
+        if use_database:
+            self._retry_loading_sentence_index()
+
+        candidates = None
+        cost = None
+        if self.sentence_index:
+            candidates = self.sentence_index.candidate_sentences(query, sanitize)
+            # counting skips building results, but still has to search everything the query could match
+            cost = self._estimate_cost(query, candidates)
+
+        def process_results(raw_results: str) -> QueryCounts:
             def on_parsing_error(message: str):
                 raise ProbableBugError(f'Error parsing XML database response JSON: {message}')
+            return QueryCounts(json_codec.loads(raw_results), on_parsing_error, cost.serialize() if cost else None)
 
-            results_json = json.loads(raw_results)
-            if not isinstance(results_json, list):
-                on_parsing_error('Results are not a list')
+        cache_key = f'count_query:{self.CORPUS_VERSION}:{query.canonical_key()}'
+        raw_results = self.cache.get(cache_key)
+        if raw_results is not None:
+            return self._process_raw_results(raw_results, process_results)
 
-            for result in results_json:
-                for i, word in enumerate(result["words"]):
-                    result["words"][i] = {
-                        key: word[key] for key in word
-                            if word[key] is not None
-                    }
+        if candidates == 0:
+            return self._process_raw_results('[]', process_results)
+        if not use_database:
+            return None
 
-            num_results = len(results_json)
-            total_pages = math.ceil(num_results / app_constants.page_size) or 1
-            if query.page > total_pages:
-                raise ProbableBugError(
-                    f'Requested page {query.page} is out of bounds for results with {total_pages} total pages')
-            page_start = (query.page - 1) * app_constants.page_size
-            page_end = page_start + app_constants.page_size
-            results_for_page = results_json[page_start:page_end]
+        query_string = self._build_query_string(query, self._candidate_sentence_list(candidates), counts_only=True)
+        raw_results = self._execute_query_and_get_raw_results(query_string, deadline)
+        counts = self._process_raw_results(raw_results, process_results)
+        self.cache.set(cache_key, raw_results, size=len(raw_results))
+        return counts
 
-            return QueryResult(results_for_page, query.page, total_pages, on_parsing_error)
+    def facet_query(self, facet_query: FacetQuery, deadline: Optional[Deadline] = None) -> FacetCounts:
+        return self._facet_query(facet_query, deadline)
 
-        return self._execute_query_and_process_results(query_string, process_results)
+    def quick_facet_query(self, facet_query: FacetQuery) -> Optional[FacetCounts]:
+        return self._facet_query(facet_query, use_database=False)
 
-    def attribute_query(self, attribute_name: str) -> List[str]:
-        if attribute_name not in allowed_attributes:
-            raise ProbableBugError(f'Attribute \'{attribute_name}\' not allowed')
+    def _facet_query(self, facet_query: FacetQuery, deadline: Optional[Deadline] = None,
+                     use_database: bool = True) -> Optional[FacetCounts]:
+        """
+        :param use_database: If False, None is returned instead of querying the database
+        """
+        query = facet_query.text_query
+        check_query_attributes(query)
+        check_attributes(facet_query.attributes)
+        if use_database:
+            self._retry_loading_sentence_index()
+
+        candidates = None
+        cost = None
+        if self.sentence_index:
+            candidates = self.sentence_index.candidate_sentences(query, sanitize)
+            cost = self._estimate_cost(query, candidates)
+
+        def process_results(raw_results: str) -> FacetCounts:
+            def on_parsing_error(message: str):
+                raise ProbableBugError(f'Error parsing XML database response JSON: {message}')
+            return FacetCounts(json_codec.loads(raw_results), on_parsing_error, cost.serialize() if cost else None)
+
+        cache_key = f'facet_query:{self.CORPUS_VERSION}:{facet_query.canonical_key()}'
+        raw_results = self.cache.get(cache_key)
+        if raw_results is not None:
+            return self._process_raw_results(raw_results, process_results)
+
+        if candidates == 0:
+            no_counts = {'totalWords': 0, 'attributes': {attribute: {} for attribute in facet_query.attributes}}
+            return self._process_raw_results(json.dumps(no_counts), process_results)
+        if not use_database:
+            return None
+
+        query_string = self._build_query_string(query, self._candidate_sentence_list(candidates),
+                                                facet_query=facet_query)
+        raw_results = self._execute_query_and_get_raw_results(query_string, deadline)
+        counts = self._process_raw_results(raw_results, process_results)
+        self.cache.set(cache_key, raw_results, size=len(raw_results))
+        return counts
+
+    def text_query_batch(self, queries: List[TextQuery],
+                         deadline: Optional[Deadline] = None) -> List[Union[QueryResult, AnoixoError]]:
+        def text_query_or_error(query: TextQuery) -> Union[QueryResult, AnoixoError]:
+            try:
+                return self.text_query(query, deadline)
+            except AnoixoError as error:
+                return error
 
-        if attribute_name == 'lemma' and self.cache.get('lemma'):
-            return self.cache.get('lemma')
-        if attribute_name == 'normalized' and self.cache.get('normalized'):
-            return self.cache.get('normalized')
+        return list(self.batch_threads.map(text_query_or_error, queries))
 
-        query_string = f"""
-            json:serialize(
-              array {{
-                sort(distinct-values(//w/@{attribute_name}))
-              }}
-            )
+    def warm_up(self) -> None:
+        self.load_sentence_index()
+        self.load_attribute_values()
+
+    def close(self) -> None:
+        self.session_pool.close_all()
+
+    def get_stats(self) -> Dict[str, Dict[str, float]]:
+        return {
+            'admission_gate': self.admission_gate.stats(),
+            'session_pool': self.session_pool.stats(),
+            'cache': self.cache.stats(),
+        }
+
+    def load_sentence_index(self) -> None:
         """
+        Loads the SentenceIndex used to narrow down which sentences text queries search, building it from the database
+        if it isn't cached. Until this succeeds, text queries search every sentence. If it fails, queries try again
+        (see _retry_loading_sentence_index).
+        """
+        try:
+            self._load_sentence_index()
+        except AnoixoError:
+            self._sentence_index_retry_at = time.monotonic() + self._sentence_index_retry_delay
+            self._sentence_index_retry_delay = min(self._sentence_index_retry_delay * 2, self.SENTENCE_INDEX_RETRY_MAX)
+            raise
+        self._sentence_index_retry_at = None
+        self._sentence_index_retry_delay = self.SENTENCE_INDEX_RETRY_MIN
 
-        def process_results(raw_results: str) -> List[str]:
-            results = json.loads(raw_results)
-            if not isinstance(results, list):
-                raise ProbableBugError(f'Error parsing XML database response JSON: not a list')
+    def _retry_loading_sentence_index(self) -> None:
+        """
+        Tries loading the sentence index again if it failed to load (like when the database wasn't up when the worker
+        warmed up) and it's been long enough since the last try. Only one query at a time tries; the others go
+        on searching every sentence.
+        """
+        retry_at = self._sentence_index_retry_at
+        if self.sentence_index is not None or retry_at is None or time.monotonic() < retry_at:
+            return
+        if not self._sentence_index_lock.acquire(blocking=False):
+            return
+        try:
+            if self.sentence_index is None:
+                self.load_sentence_index()
+        except AnoixoError as err:
+            print(f'[{time.asctime()}] Could not load the sentence index: {err.message}', flush=True)
+        finally:
+            self._sentence_index_lock.release()
+
+    def _load_sentence_index(self) -> None:
+        cache_key = f'sentence_index:{self.CORPUS_VERSION}'
+        raw_results = self.cache.get(cache_key)
+        if raw_results is None:
+            # Produces an entry for each attribute counting how many words in the sentence have each value
+            attribute_values = ",\n".join(f'"{attribute}": {self._count_values(f"$sentence//w/@{attribute}")}'
+                                          for attribute in allowed_attributes)
+            raw_results = self._execute_query_and_get_raw_results(f"""
+                json:serialize(
+                  array {{
+                    for $sentence in //sentence
+                    return map {{
+                      {attribute_values}
+                    }}
+                  }}
+                )
+            """)
+
+        def on_parsing_error(message: str):
+            raise ProbableBugError(f'Error parsing XML database response JSON: {message}')
+
+        self.sentence_index = self._process_raw_results(
+            raw_results, lambda raw: SentenceIndex.from_json(json_codec.loads(raw), on_parsing_error))
+        self.cache.set(cache_key, raw_results, size=len(raw_results))
+
+    def load_attribute_values(self) -> Dict[str, List[str]]:
+        """
+        Loads the sorted values of every allowed attribute in one query, or from the cache if another worker already
+        loaded them. They're kept in this process after that, since the corpus never changes while it runs.
+        :return: The values of each attribute
+        """
+        if self.attribute_values is not None:
+            return self.attribute_values
+
+        cache_key = f'attributes:{self.CORPUS_VERSION}'
+        raw_results = self.cache.get(cache_key)
+        if raw_results is None:
+            # Produces an entry for each attribute like:
+            # "class": array {sort(distinct-values(//w/@class))}
+            attribute_values = ",\n".join(f'"{attribute}": array {{sort(distinct-values(//w/@{attribute}))}}'
+                                          for attribute in allowed_attributes)
+            raw_results = self._execute_query_and_get_raw_results(f"""
+                json:serialize(
+                  map {{
+                    {attribute_values}
+                  }}
+                )
+            """, priority=True)
+
+        def process_results(raw: str) -> Dict[str, List[str]]:
+            results = json_codec.loads(raw)
+            if not (isinstance(results, dict) and all(isinstance(results.get(attribute), list)
+                                                      for attribute in allowed_attributes)):
+                raise ProbableBugError('Error parsing XML database response JSON: not a list for each attribute')
             return results
 
-        results = self._execute_query_and_process_results(query_string, process_results)
-        if attribute_name == 'lemma':
-            self.cache['lemma'] = results
-        if attribute_name == 'normalized':
-            self.cache['normalized'] = results
-        return results
+        self.attribute_values = self._process_raw_results(raw_results, process_results)
+        self.cache.set(cache_key, raw_results, size=len(raw_results))
+        return self.attribute_values
+
+    def attribute_names(self) -> List[str]:
+        return allowed_attributes
+
+    def attribute_query(self, attribute_name: str) -> List[str]:
+        check_attributes([attribute_name])
+        return self.load_attribute_values()[attribute_name]
@@ -5,3 +5,6 @@ basex = {
     'username': 'admin',
     'password': 'admin',
 }
+
+# Path to the treebank's XML file, if using Nestle1904LowfatInMemoryProvider instead of BaseX
+xml_path = 'nestle1904lowfat.xml'
@@ -0,0 +1,75 @@
+import math
+from typing import Callable, Dict
+from text_providers.QueryPlanner import QueryPlanner
+from text_providers.SentenceIndex import SentenceIndex
+from TextQuery import TextQuery, WordQuery, WordSequence
+
+
+class QueryCost:
+    def __init__(self, candidate_sentences: int, word_visits: int):
+        """
+        :param candidate_sentences: How many sentences could match the query, and so have to be searched. Also an upper
+        bound on how many results there are.
+        :param word_visits: Roughly how many words the database looks at while searching those sentences
+        """
+        self.candidate_sentences = candidate_sentences
+        self.word_visits = word_visits
+
+    def __repr__(self):
+        return f'{self.serialize()}'
+
+    def serialize(self) -> Dict[str, int]:
+        return {
+            'estimatedCandidateSentences': self.candidate_sentences,
+            'estimatedWordVisits': self.word_visits,
+        }
+
+
+class QueryCostEstimator:
+    """
+    Estimates how much work the database will do for a text query before it runs, from how often each attribute value
+    occurs and the structure of the query's sequences.
+
+    The database searches each candidate sentence with nested loops in the order QueryPlanner picks: the first loop
+    looks at every word in the sentence, and every later loop looks at every word again for each match of the loop
+    before it. So the work for a sequence grows with how many matches each word query has per sentence, except where a
+    link to the neighbouring word limits how far away a match can be.
+    """
+
+    def __init__(self, sentence_index: SentenceIndex, sanitize: Callable[[str], str] = lambda value: value):
+        self.sentence_index = sentence_index
+        self.sanitize = sanitize
+
+    def _estimated_matches(self, word_query: WordQuery) -> float:
+        return min(self.sentence_index.estimated_matches(word_query, self.sanitize), self.sentence_index.total_words)
+
+    def _sentence_scans(self, sequence: WordSequence, candidate_sentences: int) -> float:
+        """
+        :return: How many times each candidate sentence's words are looked at to find matches for the sequence
+        """
+        planner = QueryPlanner(self._estimated_matches)
+        scans = 0.0
+        matches_so_far = 1.0  # how many partial matches each loop runs for
+        for (word_query_index, neighbour_index) in planner.plan_sequence(sequence):
+            scans += matches_so_far
+            word_query = sequence.word_queries[word_query_index]
+            # every candidate sentence has at least one match for each word query
+            matches_per_sentence = max(1.0, self._estimated_matches(word_query) / candidate_sentences)
+            if neighbour_index is not None:
+                link = word_query.link_to_next_word if neighbour_index > word_query_index \
+                    else sequence.word_queries[neighbour_index].link_to_next_word
+                if link:
+                    matches_per_sentence = min(matches_per_sentence, link.allowed_words_between + 1)
+            matches_so_far *= matches_per_sentence
+        return scans
+
+    def estimate(self, query: TextQuery, candidates: int) -> QueryCost:
+        """
+        :param candidates: The bitmap of sentences that could match the query, from the sentence index
+        """
+        candidate_sentences = bin(candidates).count('1')
+        if not candidate_sentences:
+            return QueryCost(0, 0)
+        words_per_sentence = self.sentence_index.total_words / self.sentence_index.sentence_count
+        scans = sum(self._sentence_scans(sequence, candidate_sentences) for sequence in query.sequences)
+        return QueryCost(candidate_sentences, math.ceil(candidate_sentences * words_per_sentence * scans))
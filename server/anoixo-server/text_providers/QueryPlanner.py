@@ -0,0 +1,56 @@
+from typing import Callable, List, Optional, Tuple
+from TextQuery import TextQuery, WordQuery, WordSequence
+
+"""
+A step in evaluating a sequence: the index of the word query to find matches for, and the index of the already-matched
+neighbouring word query whose position restricts where to look (None for the first step).
+"""
+PlanStep = Tuple[int, Optional[int]]
+
+
+class QueryPlanner:
+    """
+    Decides what order to search for a text query's sequences and word queries in, so that the most selective ones
+    are searched first and drive the search for the rest.
+
+    A sequence is searched starting from its most selective word query. The matched words then grow outward one
+    neighbour at a time, always to whichever neighbouring word query is more selective, so that each new word query
+    only has to be looked for within a bounded range of positions next to a word that already matched.
+    """
+
+    def __init__(self, estimate_matches: Callable[[WordQuery], float]):
+        """
+        :param estimate_matches: Estimates how many words match a word query. Only the relative order of estimates
+        matters. Ties are broken in favour of the order the user gave.
+        """
+        self.estimate_matches = estimate_matches
+
+    def plan_sequence(self, sequence: WordSequence) -> List[PlanStep]:
+        if not sequence.word_queries:
+            return []
+        estimates = [self.estimate_matches(word_query) for word_query in sequence.word_queries]
+
+        first = min(range(len(estimates)), key=estimates.__getitem__)
+        steps: List[PlanStep] = [(first, None)]
+        (low, high) = (first, first)
+        while high - low + 1 < len(estimates):
+            can_go_left = low > 0
+            can_go_right = high < len(estimates) - 1
+            if can_go_left and (not can_go_right or estimates[low - 1] < estimates[high + 1]):
+                steps.append((low - 1, low))
+                low -= 1
+            else:
+                steps.append((high + 1, high))
+                high += 1
+        return steps
+
+    def plan_sequences(self, query: TextQuery) -> List[int]:
+        """
+        :return: The indexes of the query's sequences, from the most to the least selective. A sequence is as selective
+        as its most selective word query.
+        """
+        def sequence_estimate(sequence: WordSequence) -> float:
+            # an empty sequence never matches anything, so checking it first rules out every sentence immediately
+            return min((self.estimate_matches(word_query) for word_query in sequence.word_queries), default=0)
+
+        return sorted(range(len(query.sequences)), key=lambda index: sequence_estimate(query.sequences[index]))
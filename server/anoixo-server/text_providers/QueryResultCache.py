@@ -0,0 +1,29 @@
+from typing import Any, Dict, List, Optional
+from caching.CacheBackend import CacheBackend
+from TextQuery import TextQuery
+
+
+class QueryResultCache:
+    """
+    Caches the matches the database finds for text queries (see Nestle1904LowfatProvider._build_query_string), so that
+    repeated searches, and every page of a search, are built from the same matches instead of searching again.
+
+    Entries are keyed on the query's canonical form, which leaves out the page. The corpus version is part of the key,
+    so entries from an older build of the corpus are never served and simply age out of the backend.
+    """
+
+    def __init__(self, backend: CacheBackend, corpus_version: str):
+        self.backend = backend
+        self.corpus_version = corpus_version
+
+    def _key(self, query: TextQuery) -> str:
+        return f'text_matches:{self.corpus_version}:{query.canonical_key()}'
+
+    def get_matches(self, query: TextQuery) -> Optional[List[Dict[str, Any]]]:
+        return self.backend.get(self._key(query))
+
+    def set_matches(self, query: TextQuery, matches: List[Dict[str, Any]], size: int) -> None:
+        """
+        :param size: How big the matches are, like the length of the database's response they came from
+        """
+        self.backend.set(self._key(query), matches, size=size)
@@ -0,0 +1,106 @@
+import math
+from typing import Any, Callable, Dict, List, Optional
+from TextQuery import TextQuery, WordQuery
+
+
+class SentenceIndex:
+    """
+    An inverted index from each attribute value to the set of sentences containing a word with that value. Sets of
+    sentences are bitmaps: Python ints where bit i is set if sentence i (0-indexed, in document order) is included.
+
+    Intersecting the bitmaps for a query's attribute values gives the only sentences that could possibly match it, so
+    the database doesn't have to look at any others.
+
+    The index also counts how many words have each attribute value, which QueryPlanner uses to estimate how selective a
+    word query is.
+    """
+
+    def __init__(self, sentence_count: int, bitmaps: Dict[str, Dict[str, int]],
+                 value_counts: Optional[Dict[str, Dict[str, int]]] = None):
+        self.sentence_count = sentence_count
+        self.bitmaps = bitmaps
+        self.value_counts = value_counts or {}
+        self.all_sentences = (1 << sentence_count) - 1
+        # every word has a value for at least some attributes, so the most common attribute's count is the word count
+        self.total_words = max((sum(counts.values()) for counts in self.value_counts.values()), default=0)
+
+    @classmethod
+    def from_json(cls, json: Any, on_parsing_error: Callable[[str], Any]) -> 'SentenceIndex':
+        """
+        :param json: A list with an entry for each sentence in document order. Each entry is a dictionary mapping
+        attribute names to the values of that attribute in the sentence: either a dictionary from each value to how many
+        words in the sentence have it, or a list with the value of each word.
+        """
+        if not isinstance(json, list):
+            on_parsing_error('Sentence index is not a list')
+
+        sentences_with_value: Dict[str, Dict[str, List[int]]] = {}
+        value_counts: Dict[str, Dict[str, int]] = {}
+        for sentence_index, sentence in enumerate(json):
+            if not isinstance(sentence, dict):
+                on_parsing_error('Sentence index entry is not a dictionary')
+            for attribute, values in sentence.items():
+                attribute_sentences = sentences_with_value.setdefault(attribute, {})
+                attribute_counts = value_counts.setdefault(attribute, {})
+                value_words = values.items() if isinstance(values, dict) else [(value, 1) for value in values]
+                for value, word_count in value_words:
+                    value_sentences = attribute_sentences.setdefault(value, [])
+                    if not value_sentences or value_sentences[-1] != sentence_index:
+                        value_sentences.append(sentence_index)
+                    attribute_counts[value] = attribute_counts.get(value, 0) + word_count
+
+        # Setting bits one at a time on a big int copies it every time, so build each bitmap's bytes instead
+        bitmap_bytes = (len(json) + 7) // 8
+        bitmaps: Dict[str, Dict[str, int]] = {}
+        for attribute, values in sentences_with_value.items():
+            bitmaps[attribute] = {}
+            for value, sentence_indexes in values.items():
+                bitmap = bytearray(bitmap_bytes)
+                for sentence_index in sentence_indexes:
+                    bitmap[sentence_index >> 3] |= 1 << (sentence_index & 7)
+                bitmaps[attribute][value] = int.from_bytes(bitmap, 'little')
+        return cls(len(json), bitmaps, value_counts)
+
+    def _candidates_for_word_query(self, word_query: WordQuery, sanitize: Callable[[str], str]) -> int:
+        candidates = self.all_sentences
+        for attribute, value in word_query.attributes.items():
+            candidates &= self.bitmaps.get(attribute, {}).get(sanitize(value), 0)
+        return candidates
+
+    def estimated_matches(self, word_query: WordQuery, sanitize: Callable[[str], str] = lambda value: value) -> float:
+        """
+        :return: An upper bound on how many words match the word query, or infinity if it has no attributes and so
+        matches every word
+        """
+        if not word_query.attributes:
+            return math.inf
+        return min(self.value_counts.get(attribute, {}).get(sanitize(value), 0)
+                   for attribute, value in word_query.attributes.items())
+
+    def candidate_sentences(self, query: TextQuery, sanitize: Callable[[str], str] = lambda value: value) -> int:
+        """
+        :param query: The query to find candidate sentences for
+        :param sanitize: Applied to attribute values before looking them up, so they match what the database will
+        actually be searched for
+        :return: A bitmap of the sentences that could match the query
+        """
+        candidates = self.all_sentences
+        for sequence in query.sequences:
+            if not sequence.word_queries:
+                return 0  # an empty sequence never matches anything
+            for word_query in sequence.word_queries:
+                candidates &= self._candidates_for_word_query(word_query, sanitize)
+        return candidates
+
+    @staticmethod
+    def sentence_indexes(bitmap: int) -> List[int]:
+        """
+        :return: The (0-indexed) sentences in the bitmap, in document order
+        """
+        indexes: List[int] = []
+        for byte_index, byte in enumerate(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')):
+            while byte:
+                low_bit = byte & -byte
+                indexes.append(byte_index * 8 + low_bit.bit_length() - 1)
+                byte ^= low_bit
+        return indexes
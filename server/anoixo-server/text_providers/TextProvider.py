@@ -1,8 +1,33 @@
+from AnoixoError import AnoixoError
+from Deadline import Deadline
+from FacetQuery import FacetQuery
+from QueryCounts import FacetCounts, QueryCounts
 from QueryResult import QueryResult
 from TextQuery import TextQuery
-from typing import List
+from typing import Any, Callable, Dict, List, Optional, TypeVar, Union
 import abc
 
+T = TypeVar('T')
+
+
+class QueryTurn:
+    """
+    A turn to run a query, from TextProvider.admit_async. This one is for providers that don't limit their queries, so
+    there's nothing to give back.
+    """
+
+    def run(self, function: Callable[..., T], *args: Any) -> T:
+        """
+        Runs the query (in any thread), then gives back the turn
+        """
+        return function(*args)
+
+    def give_back(self) -> None:
+        """
+        Gives back the turn without running the query
+        """
+        pass
+
 
 class TextProvider(abc.ABC):
     @abc.abstractmethod
@@ -14,9 +39,103 @@ class TextProvider(abc.ABC):
         pass
 
     @abc.abstractmethod
-    def text_query(self, query: TextQuery) -> QueryResult:
+    def text_query(self, query: TextQuery, deadline: Optional[Deadline] = None) -> QueryResult:
+        """
+        :param deadline: If given, the query is stopped with a QueryTimeoutError if it runs past the deadline
+        """
+        pass
+
+    @abc.abstractmethod
+    def count_query(self, query: TextQuery, deadline: Optional[Deadline] = None) -> QueryCounts:
+        """
+        Counts the passages a text query matches, much more cheaply than running it with text_query. The query's page
+        is ignored.
+        :param deadline: If given, the query is stopped with a QueryTimeoutError if it runs past the deadline
+        """
+        pass
+
+    @abc.abstractmethod
+    def facet_query(self, facet_query: FacetQuery, deadline: Optional[Deadline] = None) -> FacetCounts:
+        """
+        Counts the values of some attributes among all the words matching one word query of a text query
+        :param deadline: If given, the query is stopped with a QueryTimeoutError if it runs past the deadline
+        """
         pass
 
+    def quick_text_query(self, query: TextQuery) -> Optional[QueryResult]:
+        """
+        Runs a text query if it can be answered without querying the database (like from a cache), so that callers
+        that wait on the event loop for a turn at the database (see admit_async) only do so when they need one. By
+        default no query can be.
+        :return: The result, or None if the query needs the database
+        """
+        return None
+
+    def quick_count_query(self, query: TextQuery) -> Optional[QueryCounts]:
+        """
+        Like quick_text_query, for count_query
+        """
+        return None
+
+    def quick_facet_query(self, facet_query: FacetQuery) -> Optional[FacetCounts]:
+        """
+        Like quick_text_query, for facet_query
+        """
+        return None
+
+    def text_query_batch(self, queries: List[TextQuery],
+                         deadline: Optional[Deadline] = None) -> List[Union[QueryResult, AnoixoError]]:
+        """
+        Runs several text queries. By default they run one after another; providers that can run them together should
+        override this.
+        :return: The result of each query, or the error it failed with
+        """
+        results: List[Union[QueryResult, AnoixoError]] = []
+        for query in queries:
+            try:
+                results.append(self.text_query(query, deadline))
+            except AnoixoError as error:
+                results.append(error)
+        return results
+
     @abc.abstractmethod
     def attribute_query(self, attribute_name: str) -> List[str]:
         pass
+
+    def attribute_names(self) -> List[str]:
+        """
+        :return: The attributes attribute_query answers for, so their responses can be built before any requests come
+        in. By default there are none to build ahead of time.
+        """
+        return []
+
+    async def admit_async(self, priority: bool = False, deadline: Optional[Deadline] = None) -> QueryTurn:
+        """
+        Waits on the event loop for a turn to run a query, for providers that limit how many run at once, so that
+        queries waiting for a turn don't tie up threads. By default there's no limit to wait for.
+        :param priority: Whether this is a cheap query that should skip ahead of waiting text queries
+        :param deadline: If given, the query never waits past it
+        :return: The turn to run the query with, which doesn't wait for another turn
+        """
+        return QueryTurn()
+
+    def warm_up(self) -> None:
+        """
+        Called in each worker process before it starts handling requests, to load anything that would otherwise slow
+        down the first requests.
+        """
+        pass
+
+    def close(self) -> None:
+        """
+        Called in each worker process as it exits, to close anything (like database connections) left open
+        """
+        pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        :return: Statistics about this provider in the current worker process (like how busy its database connections
+        are), for sizing its limits
+        """
+        return {}
+
@@ -0,0 +1,61 @@
+"""
+Which word attributes the Nestle 1904 Lowfat providers search, and how they clean up the values in a query, shared by
+Nestle1904LowfatProvider and Nestle1904LowfatInMemoryProvider so that both engines accept and match the same queries.
+"""
+import copy
+from typing import Iterable
+from AnoixoError import ProbableBugError
+from TextQuery import TextQuery
+
+allowed_attributes = [
+    'class',
+    'lemma',
+    'normalized',
+    'person',
+    'number',
+    'gender',
+    'case',
+    'tense',
+    'voice',
+    'mood'
+]
+
+
+def check_attributes(attributes: Iterable[str]) -> None:
+    """
+    :raise ProbableBugError: If any of the attributes isn't allowed
+    """
+    for attribute in attributes:
+        if attribute not in allowed_attributes:
+            raise ProbableBugError(f'Attribute \'{attribute}\' not allowed')
+
+
+def check_query_attributes(query: TextQuery) -> None:
+    """
+    :raise ProbableBugError: If any word query in the text query uses an attribute that isn't allowed
+    """
+    for sequence in query.sequences:
+        for word_query in sequence.word_queries:
+            check_attributes(word_query.attributes)
+
+
+def sanitize(string: str) -> str:
+    """
+    Sanitizes a user-input string so it can be safely included in an XQuery query without the risk of injection
+    attacks.
+    :param string: The string to sanitize
+    :return: The sanitized string
+    """
+    return string.replace('&', '').replace('\'', '’')
+
+
+def sanitized(query: TextQuery) -> TextQuery:
+    """
+    :return: A copy of the query with its attribute values sanitized, for engines that don't build XQuery but have to
+    match the same words as the ones that do
+    """
+    query = copy.deepcopy(query)
+    for sequence in query.sequences:
+        for word_query in sequence.word_queries:
+            word_query.attributes = {key: sanitize(value) for key, value in word_query.attributes.items()}
+    return query
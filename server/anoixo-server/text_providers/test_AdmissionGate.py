@@ -0,0 +1,212 @@
+import asyncio
+import os
+import pytest
+import threading
+import time
+from typing import List
+from AnoixoError import QueryTimeoutError, ServerOverwhelmedError
+from Deadline import Deadline
+from Metrics import Metrics
+from text_providers.AdmissionGate import AdmissionGate
+
+
+def wait_until(condition, timeout: float = 2) -> None:
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, 'Timed out waiting for condition'
+        time.sleep(0.005)
+
+
+def start_waiting(gate: AdmissionGate, order: List[str], name: str, priority: bool = False) -> threading.Thread:
+    def run():
+        with gate.admit(priority):
+            order.append(name)
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def test_admits_up_to_max_in_flight_immediately():
+    gate = AdmissionGate(max_in_flight=2, max_waiting=0, max_wait=1)
+    with gate.admit():
+        with gate.admit():
+            assert gate.stats()['in_flight'] == 2
+    stats = gate.stats()
+    assert stats['in_flight'] == 0
+    assert stats['admitted'] == 2
+
+
+def test_releases_turn_on_errors():
+    gate = AdmissionGate(max_in_flight=1, max_waiting=0, max_wait=1)
+    with pytest.raises(ValueError):
+        with gate.admit():
+            raise ValueError()
+    with gate.admit():
+        pass
+    assert gate.stats()['in_flight'] == 0
+
+
+def test_sheds_when_wait_line_is_full():
+    gate = AdmissionGate(max_in_flight=1, max_waiting=0, max_wait=1)
+    with gate.admit():
+        with pytest.raises(ServerOverwhelmedError) as excinfo:
+            with gate.admit():
+                pass
+    assert excinfo.value.message == 'Too many queries are waiting for the database'
+    assert gate.stats()['shed'] == 1
+
+
+def test_times_out_waiting():
+    gate = AdmissionGate(max_in_flight=1, max_waiting=1, max_wait=0.05)
+    with gate.admit():
+        with pytest.raises(ServerOverwhelmedError) as excinfo:
+            with gate.admit():
+                pass
+    assert excinfo.value.message.startswith('Timed out after')
+    stats = gate.stats()
+    assert stats['timed_out'] == 1
+    assert stats['waiting'] == 0
+    assert stats['longest_wait'] >= 0.05
+
+
+def test_never_waits_past_deadline():
+    gate = AdmissionGate(max_in_flight=1, max_waiting=1, max_wait=10)
+    with gate.admit():
+        start = time.monotonic()
+        with pytest.raises(QueryTimeoutError):
+            with gate.admit(deadline=Deadline(0.05)):
+                pass
+    assert time.monotonic() - start < 1
+
+
+def test_waiting_query_is_admitted_when_turn_is_free():
+    gate = AdmissionGate(max_in_flight=1, max_waiting=1, max_wait=2)
+    order: List[str] = []
+    with gate.admit():
+        thread = start_waiting(gate, order, 'waiting')
+        wait_until(lambda: gate.stats()['waiting'] == 1)
+        assert order == []
+    thread.join()
+    assert order == ['waiting']
+    assert gate.stats()['admitted'] == 2
+
+
+def test_priority_queries_go_first_and_are_not_shed():
+    gate = AdmissionGate(max_in_flight=1, max_waiting=1, max_wait=2)
+    order: List[str] = []
+    with gate.admit():
+        threads = [start_waiting(gate, order, 'normal')]
+        wait_until(lambda: gate.stats()['waiting'] == 1)
+        # the normal line is full, but the priority line still takes queries
+        threads += [start_waiting(gate, order, f'priority{i}', priority=True) for i in range(2)]
+        wait_until(lambda: gate.stats()['waiting_priority'] == 2)
+    for thread in threads:
+        thread.join()
+    assert order == ['priority0', 'priority1', 'normal']
+    assert gate.stats()['shed'] == 0
+
+
+def test_limits_are_shared_by_gates_on_the_same_path(tmp_path):
+    path = str(tmp_path / 'admission.sqlite3')
+    # like two gunicorn workers
+    worker_1 = AdmissionGate(max_in_flight=1, max_waiting=0, max_wait=1, path=path)
+    worker_2 = AdmissionGate(max_in_flight=1, max_waiting=0, max_wait=1, path=path)
+    with worker_1.admit():
+        assert worker_2.stats()['in_flight'] == 1
+        with pytest.raises(ServerOverwhelmedError):
+            with worker_2.admit():
+                pass
+    with worker_2.admit():
+        pass
+    assert worker_2.stats()['shed'] == 1
+
+
+def test_gives_back_turns_of_processes_that_died(tmp_path, monkeypatch):
+    path = str(tmp_path / 'admission.sqlite3')
+    gate = AdmissionGate(max_in_flight=1, max_waiting=0, max_wait=1, path=path)
+    dead_worker = AdmissionGate(max_in_flight=1, max_waiting=0, max_wait=1, path=path)
+    real_pid = os.getpid()
+    monkeypatch.setattr(os, 'getpid', lambda: 2 ** 22 + 1)  # above Linux's highest pid, so no process has it
+    # never left, as if the worker died while its query ran
+    turn = dead_worker.admit()
+    turn.__enter__()
+    monkeypatch.setattr(os, 'getpid', lambda: real_pid)
+    assert gate.stats()['in_flight'] == 1
+    with gate.admit():
+        assert gate.stats()['in_flight'] == 1
+
+
+def test_admits_async_and_skips_the_gate_for_queries_run_with_the_turn():
+    gate = AdmissionGate(max_in_flight=1, max_waiting=0, max_wait=1)
+
+    def query():
+        # would be shed if it needed a turn of its own
+        with gate.admit():
+            return gate.stats()['in_flight']
+
+    async def run():
+        turn = await gate.admit_async()
+        return await asyncio.get_running_loop().run_in_executor(None, turn.run, query)
+    assert asyncio.run(run()) == 1
+    stats = gate.stats()
+    assert stats['in_flight'] == 0
+    assert stats['admitted'] == 1
+
+
+def test_async_query_waits_for_a_turn_held_by_a_thread():
+    gate = AdmissionGate(max_in_flight=1, max_waiting=1, max_wait=2)
+    order: List[str] = []
+
+    async def run():
+        turn = await gate.admit_async()
+        turn.run(order.append, 'async')
+    with gate.admit():
+        thread = threading.Thread(target=asyncio.run, args=(run(),))
+        thread.start()
+        wait_until(lambda: gate.stats()['waiting'] == 1)
+        order.append('thread')
+    thread.join()
+    assert order == ['thread', 'async']
+
+
+def test_cancelled_async_query_leaves_the_line():
+    gate = AdmissionGate(max_in_flight=1, max_waiting=1, max_wait=2)
+
+    async def run():
+        waiting = asyncio.ensure_future(gate.admit_async())
+        while gate.stats()['waiting'] == 0:
+            await asyncio.sleep(0.005)
+        # like a client disconnecting
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+    with gate.admit():
+        asyncio.run(run())
+    wait_until(lambda: gate.stats()['waiting'] == 0)
+    with gate.admit():
+        pass
+    assert gate.stats()['timed_out'] == 0
+
+
+def test_turn_given_back_without_running_the_query():
+    gate = AdmissionGate(max_in_flight=1, max_waiting=0, max_wait=1)
+
+    async def run():
+        (await gate.admit_async()).give_back()
+    asyncio.run(run())
+    wait_until(lambda: gate.stats()['in_flight'] == 0)
+
+
+def test_records_metrics():
+    metrics = Metrics()
+    gate = AdmissionGate(max_in_flight=1, max_waiting=0, max_wait=1, metrics=metrics)
+    with gate.admit():
+        with pytest.raises(ServerOverwhelmedError):
+            with gate.admit():
+                pass
+        lines = metrics.render().splitlines()
+    assert 'anoixo_admission_total{line="normal",outcome="admitted"} 1' in lines
+    assert 'anoixo_admission_total{line="normal",outcome="shed"} 1' in lines
+    assert 'anoixo_admission_wait_seconds_count{line="normal"} 1' in lines
+    assert 'anoixo_admission_queries{state="running"} 1' in lines
+    assert 'anoixo_admission_queries{state="waiting"} 0' in lines
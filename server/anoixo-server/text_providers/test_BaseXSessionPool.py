@@ -0,0 +1,88 @@
+import pytest
+from unittest.mock import MagicMock
+from text_providers.BaseXSessionPool import BaseXSessionPool, SessionPoolExhaustedError
+
+
+@pytest.fixture
+def connect():
+    return MagicMock(side_effect=lambda: MagicMock())
+
+
+def test_reuses_checked_in_sessions(connect):
+    pool = BaseXSessionPool(connect, max_size=2)
+    with pool.session() as session1:
+        pass
+    with pool.session() as session2:
+        pass
+    assert session1 is session2
+    assert connect.call_count == 1
+
+
+def test_opens_new_sessions_up_to_max_size(connect):
+    pool = BaseXSessionPool(connect, max_size=2)
+    session1 = pool.checkout()
+    session2 = pool.checkout()
+    assert session1 is not session2
+    assert connect.call_count == 2
+
+
+def test_times_out_when_exhausted(connect):
+    pool = BaseXSessionPool(connect, max_size=1, checkout_timeout=0.01)
+    pool.checkout()
+    with pytest.raises(SessionPoolExhaustedError):
+        pool.checkout()
+
+
+def test_evicts_sessions_that_raise(connect):
+    pool = BaseXSessionPool(connect, max_size=1)
+    with pytest.raises(ValueError):
+        with pool.session() as broken_session:
+            raise ValueError()
+    broken_session.close.assert_called_once()
+
+    with pool.session() as session:
+        assert session is not broken_session
+    assert pool.stats()['evicted'] == 1
+
+
+def test_evicts_sessions_even_if_close_fails(connect):
+    pool = BaseXSessionPool(connect, max_size=1)
+    session = pool.checkout()
+    session.close.side_effect = BrokenPipeError()
+    pool.checkin(session, broken=True)
+    assert pool.stats()['open'] == 0
+
+
+def test_health_checks_idle_sessions(connect):
+    pool = BaseXSessionPool(connect, max_size=1, health_check_after=0)
+    stale_session = pool.checkout()
+    stale_session.execute.side_effect = ConnectionResetError()
+    pool.checkin(stale_session)
+
+    session = pool.checkout()
+    assert session is not stale_session
+    stale_session.close.assert_called_once()
+
+
+def test_frees_slot_when_connect_fails():
+    pool = BaseXSessionPool(MagicMock(side_effect=ConnectionRefusedError()), max_size=1)
+    with pytest.raises(ConnectionRefusedError):
+        pool.checkout()
+    assert pool.stats()['open'] == 0
+
+
+def test_stats(connect):
+    pool = BaseXSessionPool(connect, max_size=3)
+    session = pool.checkout()
+    pool.checkout()
+    pool.checkin(session)
+    assert pool.stats() == {
+        'max_size': 3,
+        'open': 2,
+        'idle': 1,
+        'in_use': 1,
+        'created': 2,
+        'evicted': 0,
+        'checkouts': 2,
+        'waits': 0,
+    }
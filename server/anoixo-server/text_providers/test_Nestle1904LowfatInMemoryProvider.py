@@ -0,0 +1,160 @@
+import pytest
+from AnoixoError import ProbableBugError, QueryTimeoutError, ServerOverwhelmedError
+from Deadline import Deadline
+from FacetQuery import FacetQuery
+from text_providers.Nestle1904LowfatInMemoryProvider import Nestle1904LowfatInMemoryProvider
+from TextQuery import TextQuery
+
+TREEBANK_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<book>
+  <sentence>
+    <p><milestone unit="verse" id="John.1.1">John 1:1</milestone>Ἐν ἀρχῇ ἦν ὁ λόγος.</p>
+    <wg>
+      <wg>
+        <w osisId="John.1.1!1" n="1" class="prep" lemma="ἐν" normalized="Ἐν">Ἐν</w>
+        <w osisId="John.1.1!2" n="2" class="noun" lemma="ἀρχή" normalized="ἀρχῇ" case="dative">ἀρχῇ</w>
+      </wg>
+      <w osisId="John.1.1!3" n="3" class="verb" lemma="εἰμί" normalized="ἦν" tense="imperfect">ἦν</w>
+      <wg>
+        <w osisId="John.1.1!4" n="4" class="det" lemma="ὁ" normalized="ὁ" case="nominative">ὁ</w>
+        <w osisId="John.1.1!5" n="5" class="noun" lemma="λόγος" normalized="λόγος" case="nominative">λόγος</w>
+        <pc>.</pc>
+      </wg>
+    </wg>
+  </sentence>
+  <sentence>
+    <p><milestone unit="verse" id="John.1.2">John 1:2</milestone><milestone unit="verse" id="John.1.3">John 1:3</milestone>οὗτος ἦν ὁ λόγος ὁ</p>
+    <wg>
+      <w osisId="John.1.2!1" n="6" class="det" lemma="ὁ" normalized="ὁ" case="nominative">ὁ</w>
+      <w osisId="John.1.2!3" n="8" class="noun" lemma="λόγος" normalized="λόγος" case="nominative">λόγος</w>
+      <w osisId="John.1.2!2" n="7" class="verb" lemma="εἰμί" normalized="ἦν" tense="imperfect">ἦν</w>
+      <w osisId="John.1.3!1" n="9" class="det" lemma="ὁ" normalized="ὁ" case="nominative">ὁ</w>
+    </wg>
+  </sentence>
+</book>
+"""
+
+
+@pytest.fixture
+def provider(tmp_path):
+    xml_path = tmp_path / 'nestle1904lowfat.xml'
+    xml_path.write_text(TREEBANK_XML, encoding='utf-8')
+    return Nestle1904LowfatInMemoryProvider(str(xml_path))
+
+
+def query_for(sequences, page: int = 1) -> TextQuery:
+    return TextQuery({'sequences': sequences, 'page': page}, lambda x: None)
+
+
+def matched_indexes(passage):
+    return [(word.matchedSequence, word.matchedWordQuery) for word in passage.words]
+
+
+def test_finds_single_word(provider):
+    result = provider.text_query(query_for([[{'attributes': {'lemma': 'ἀρχή'}}]]))
+    assert len(result.passages) == 1
+    assert result.passages[0].references[0].string_ref == 'John.1.1'
+    assert matched_indexes(result.passages[0]) == [(-1, -1), (0, 0), (-1, -1), (-1, -1), (-1, -1)]
+
+
+def test_builds_passages_like_basex_provider(provider):
+    result = provider.text_query(query_for([[{'attributes': {'lemma': 'λόγος'}}]]))
+    passage = result.passages[0].serialize()
+    assert passage['words'][4] == {
+        'text': 'λόγος.',
+        'matchedSequence': 0,
+        'matchedWordQuery': 0,
+        'class': 'noun',
+        'lemma': 'λόγος',
+        'normalized': 'λόγος',
+        'case': 'nominative',
+    }
+    assert passage['words'][0]['text'] == 'Ἐν'
+
+
+def test_orders_words_by_position(provider):
+    result = provider.text_query(query_for([[{'attributes': {'lemma': 'εἰμί'}}]]))
+    assert [word.text for word in result.passages[1].words] == ['ὁ', 'ἦν', 'λόγος', 'ὁ']
+    assert [reference.string_ref for reference in result.passages[1].references] == ['John.1.2', 'John.1.3']
+
+
+def test_matches_words_in_order(provider):
+    result = provider.text_query(query_for([[{'attributes': {'lemma': 'λόγος'}}, {'attributes': {'lemma': 'εἰμί'}}]]))
+    assert len(result.passages) == 0
+
+
+def test_respects_allowed_words_between(provider):
+    adjacent = [{'attributes': {'lemma': 'ἀρχή'}, 'link': {'allowedWordsBetween': 0}}, {'attributes': {'lemma': 'ὁ'}}]
+    assert len(provider.text_query(query_for([adjacent])).passages) == 0
+    one_between = [{'attributes': {'lemma': 'ἀρχή'}, 'link': {'allowedWordsBetween': 1}}, {'attributes': {'lemma': 'ὁ'}}]
+    result = provider.text_query(query_for([one_between]))
+    assert matched_indexes(result.passages[0]) == [(-1, -1), (0, 0), (-1, -1), (0, 1), (-1, -1)]
+
+
+def test_keeps_first_matched_word_query_for_each_word(provider):
+    result = provider.text_query(query_for([[{'attributes': {'class': 'det'}}, {}]]))
+    # In John 1:2-3, the first ὁ starts a match, and the second ὁ only ends one
+    assert matched_indexes(result.passages[1]) == [(0, 0), (0, 1), (0, 1), (0, 1)]
+
+
+def test_requires_every_sequence_to_match(provider):
+    result = provider.text_query(query_for([[{'attributes': {'lemma': 'λόγος'}}], [{'attributes': {'case': 'dative'}}]]))
+    assert len(result.passages) == 1
+    assert matched_indexes(result.passages[0]) == [(-1, -1), (1, 0), (-1, -1), (-1, -1), (0, 0)]
+
+
+def test_sanitizes_attribute_values_like_basex_provider(provider):
+    result = provider.text_query(query_for([[{'attributes': {'lemma': '&λόγος'}}]]))
+    assert len(result.passages) == 2
+
+
+def test_paginates(provider, mocker):
+    mocker.patch('app_constants.page_size', 1)
+    result = provider.text_query(query_for([[{'attributes': {'lemma': 'λόγος'}}]], page=2))
+    assert result.page == 2
+    assert result.total_pages == 2
+    assert result.passages[0].references[0].string_ref == 'John.1.2'
+
+    with pytest.raises(ProbableBugError) as excinfo:
+        provider.text_query(query_for([[{'attributes': {'lemma': 'λόγος'}}]], page=3))
+    assert excinfo.value.message == 'Requested page 3 is out of bounds for results with 2 total pages'
+
+
+def test_stops_searching_past_deadline(provider):
+    with pytest.raises(QueryTimeoutError):
+        provider.text_query(query_for([[{'attributes': {'lemma': 'λόγος'}}]]), Deadline(0))
+
+
+def test_handles_disallowed_attribute(provider):
+    with pytest.raises(ProbableBugError) as excinfo:
+        provider.text_query(query_for([[{'attributes': {'fake-attr': 'value'}}]]))
+    assert excinfo.value.message == 'Attribute \'fake-attr\' not allowed'
+
+
+def test_attribute_query(provider):
+    assert provider.attribute_query('class') == ['det', 'noun', 'prep', 'verb']
+    with pytest.raises(ProbableBugError):
+        provider.attribute_query('disallowed')
+
+
+def test_handles_missing_xml():
+    with pytest.raises(ServerOverwhelmedError) as excinfo:
+        Nestle1904LowfatInMemoryProvider('/nonexistent.xml').attribute_query('class')
+    assert excinfo.value.message == 'Error loading treebank XML: FileNotFoundError'
+
+
+def test_counts_matches_by_chapter(provider):
+    counts = provider.count_query(TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None))
+    assert counts.serialize() == {
+        'totalResults': 2,
+        'books': [{'book': 'John', 'count': 2, 'chapters': [{'chapter': 1, 'count': 2}]}],
+    }
+
+
+def test_counts_facet_values_of_matched_words(provider):
+    facet_query = FacetQuery({
+        'query': {'sequences': [[{'attributes': {'class': 'det'}}, {'attributes': {'lemma': 'λόγος'}}]]},
+        'sequence': 0, 'wordQuery': 0, 'attributes': ['lemma', 'tense'],
+    }, lambda x: None)
+    counts = provider.facet_query(facet_query)
+    assert counts.serialize() == {'totalWords': 2, 'attributes': {'lemma': {'ὁ': 2}, 'tense': {}}}
@@ -1,8 +1,15 @@
+import json
 import pytest
-from text_providers.Nestle1904LowfatProvider import Nestle1904LowfatProvider
-from typing import Callable
+import time
+from caching.MemoryCache import MemoryCache
+from text_providers.Nestle1904LowfatProvider import allowed_attributes, Nestle1904LowfatProvider
+from text_providers.SentenceIndex import SentenceIndex
+from typing import Callable, List, Optional
 from unittest.mock import MagicMock
-from AnoixoError import ProbableBugError, ServerOverwhelmedError
+from AnoixoError import ProbableBugError, QueryTimeoutError, QueryTooExpensiveError, ServerOverwhelmedError
+from Deadline import Deadline
+from FacetQuery import FacetQuery
+from Metrics import Metrics
 from TextQuery import TextQuery
 
 
@@ -18,12 +25,50 @@ def provider():
     return Nestle1904LowfatProvider()
 
 
-def mock_basex_on_query_execute(mocker, basex_session_mock: MagicMock, on_query_execute: Callable):
+NO_RESULTS = '[]'
+
+
+def attribute_values_response(values: List[str]) -> str:
+    """
+    :return: The database's response to loading attribute values, with the given values for every attribute
+    """
+    return json.dumps({attribute: values for attribute in allowed_attributes})
+
+
+ATTRIBUTE_VALUES = attribute_values_response(['value1', 'value2'])
+
+
+def matches_response(total_results: int) -> str:
+    """
+    :return: The database's response to searching for a text query's matches, with the given number of matches
+    """
+    return json.dumps([{'sentence': i, 'sequences': [{f'w{i}': 0}]} for i in range(1, total_results + 1)])
+
+
+def page_response(results: List[str]) -> str:
+    return f'[{",".join(results)}]'
+
+
+def count_matches_queries(basex_query_spy: MagicMock) -> int:
+    """
+    :return: How many of the queries run searched for a text query's matches, as opposed to building a page from them
+    """
+    return sum('"sequences": array' in call.args[1] for call in basex_query_spy.call_args_list)
+
+
+def mock_basex_on_query_execute(mocker, basex_session_mock: MagicMock, on_query_execute: Callable,
+                                on_page_query_execute: Optional[Callable] = None):
+    """
+    :param on_page_query_execute: If given, called instead of on_query_execute for queries that build a page of a text
+    query's results from its matches
+    """
     class MockQuery:
         def __init__(self, query_string):
-            pass
+            self.is_page_query = '"references": array' in query_string
 
         def execute(self):
+            if self.is_page_query and on_page_query_execute:
+                return on_page_query_execute()
             return on_query_execute()
 
     basex_session_mock.return_value.query = lambda query_string: MockQuery(query_string)
@@ -49,7 +94,7 @@ def test_reconnects_to_basex_after_error(mocker, provider):
 
     basex_session_mock = MagicMock()
     mocker.patch('BaseXClient.BaseXClient.Session', basex_session_mock)
-    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: '["value1","value2"]')
+    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: ATTRIBUTE_VALUES)
     result = provider.attribute_query('gender')
     assert result == ['value1', 'value2']
 
@@ -57,7 +102,7 @@ def test_reconnects_to_basex_after_error(mocker, provider):
 def test_retries_queries(basex_session_mock, provider):
     class MockQuery:
         def execute(self):
-            return '["value1","value2"]'
+            return ATTRIBUTE_VALUES
     basex_session_mock.return_value.query.side_effect = [Exception(), Exception(), MockQuery()]
 
     result = provider.attribute_query('gender')
@@ -65,10 +110,38 @@ def test_retries_queries(basex_session_mock, provider):
     assert basex_session_mock.return_value.query.call_count == 3
 
 
+def test_records_query_metrics(basex_session_mock):
+    class MockQuery:
+        def execute(self):
+            return ATTRIBUTE_VALUES
+    basex_session_mock.return_value.query.side_effect = [Exception(), MockQuery()]
+    metrics = Metrics()
+    provider = Nestle1904LowfatProvider(metrics=metrics)
+
+    provider.attribute_query('gender')
+    lines = metrics.render().splitlines()
+    assert 'anoixo_basex_retries_total 1' in lines
+    assert 'anoixo_basex_query_seconds_count 1' in lines
+    assert f'anoixo_basex_result_bytes_sum {len(ATTRIBUTE_VALUES)}' in lines
+    assert 'anoixo_result_processing_seconds_count 1' in lines
+
+
+def test_close_closes_pooled_sessions(basex_session_mock, provider):
+    class MockQuery:
+        def execute(self):
+            return ATTRIBUTE_VALUES
+    basex_session_mock.return_value.query.return_value = MockQuery()
+    provider.attribute_query('gender')
+
+    provider.close()
+    basex_session_mock.return_value.close.assert_called_once()
+    assert provider.session_pool.stats()['open'] == 0
+
+
 def test_reconnects_to_basex_even_if_close_fails(basex_session_mock, provider):
     class MockQuery:
         def execute(self):
-            return '["value1","value2"]'
+            return ATTRIBUTE_VALUES
 
     def raise_broken_pipe_error():
         raise BrokenPipeError()
@@ -80,6 +153,15 @@ def test_reconnects_to_basex_even_if_close_fails(basex_session_mock, provider):
     assert result == ['value1', 'value2']
 
 
+def test_reuses_basex_session_between_queries(mocker, basex_session_mock, provider):
+    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: ATTRIBUTE_VALUES)
+    provider.attribute_query('gender')
+    provider.attribute_values = None
+    provider.attribute_query('case')
+    assert basex_session_mock.call_count == 1
+    assert basex_session_mock.return_value.close.call_count == 0
+
+
 def test_closes_basex_session_even_on_errors(mocker, basex_session_mock, provider):
     def raise_exception():
         raise ServerOverwhelmedError('exception on query')
@@ -91,7 +173,8 @@ def test_closes_basex_session_even_on_errors(mocker, basex_session_mock, provide
 
 
 def test_build_query_string_adds_extra_attributes(mocker, basex_session_mock, provider):
-    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: '[]')
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: matches_response(1),
+                                                  lambda: NO_RESULTS)
     query = TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None)
     provider.text_query(query)
     assert '"class": data($w/@class)' in basex_query_spy.call_args.args[1]
@@ -106,36 +189,69 @@ def test_build_query_string_adds_extra_attributes(mocker, basex_session_mock, pr
     assert '"mood": data($w/@mood)' in basex_query_spy.call_args.args[1]
 
 
+def test_build_query_string_uses_precomputed_attributes(mocker, basex_session_mock, provider):
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: matches_response(1),
+                                                  lambda: NO_RESULTS)
+    provider.text_query(TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None))
+    assert '"text": string($w/@punctuated)' in basex_query_spy.call_args.args[1]
+    assert '"references": array {tokenize($sentence/@references)}' in basex_query_spy.call_args.args[1]
+    assert 'following-sibling' not in basex_query_spy.call_args.args[1]
+
+
 def test_text_query_includes_extra_attributes(mocker, basex_session_mock, provider):
     basex_results = [
         '{"references": ["Mark.1.1"], "words": [{"gender": "feminine", "matchedSequence": -1, "text": "ἣν", "matchedWordQuery": -1}]}']
-    basex_string = f'[{",".join(basex_results)}]'
-    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: basex_string)
+    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: matches_response(1),
+                                lambda: page_response(basex_results))
     result = provider.text_query(TextQuery({'sequences': []}, lambda x: None))
     assert result.passages[0].words[0].attributes["gender"] == "feminine"
 
 
 def test_text_query_excludes_null_attributes(mocker, basex_session_mock, provider):
     basex_results = ['{"references": ["Mark.1.1"], "words": [{"gender": "feminine", "matchedSequence": -1, "text": "ἣν", "tense": null, "matchedWordQuery": -1}]}']
-    basex_string = f'[{",".join(basex_results)}]'
-    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: basex_string)
+    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: matches_response(1),
+                                lambda: page_response(basex_results))
     result = provider.text_query(TextQuery({'sequences': []}, lambda x: None))
     assert "tense" not in result.passages[0].words[0].attributes
 
 
 def test_text_query_adds_pagination_info(mocker, basex_session_mock, provider):
-    basex_results = ['{"references": ["Mark.1.1"], "words": []}' for _ in range(23)]
-    basex_string = f'[{",".join(basex_results)}]'
-    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: basex_string)
+    basex_results = ['{"references": ["Mark.1.1"], "words": []}' for _ in range(10)]
+    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: matches_response(23),
+                                lambda: page_response(basex_results))
     result = provider.text_query(TextQuery({'sequences': []}, lambda x: None))
     assert result.page == 1
     assert result.total_pages == 3
 
 
+def test_text_query_requests_only_requested_page(mocker, basex_session_mock, provider):
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: matches_response(23),
+                                                  lambda: NO_RESULTS)
+    provider.text_query(TextQuery({'sequences': [], 'page': 2}, lambda x: None))
+    page_query_string = basex_query_spy.call_args.args[1]
+    assert "db:attribute('nestle1904lowfat', '11', 'index')/parent::sentence" in page_query_string
+    assert "db:attribute('nestle1904lowfat', '20', 'index')/parent::sentence" in page_query_string
+    assert "'10', 'index'" not in page_query_string
+    assert "'21', 'index'" not in page_query_string
+
+
+def test_text_query_builds_page_from_saved_matches(mocker, basex_session_mock, provider):
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: matches_response(1),
+                                                  lambda: NO_RESULTS)
+    provider.text_query(TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None))
+    [matches_query_string, page_query_string] = [call.args[1] for call in basex_query_spy.call_args_list]
+    assert '"sentence": xs:integer($match?sentence/@index)' in matches_query_string
+    assert '"sequences": array {$match?sequence0}' in matches_query_string
+    assert '"sequence0": map {\'w1\': 0}' in page_query_string
+    assert 'let $matching_sequence0 := $match?sequence0' in page_query_string
+    # the page's sentences aren't searched again
+    assert "@lemma='λόγος'" not in page_query_string
+
+
 def test_text_query_returns_requested_page(mocker, basex_session_mock, provider):
-    basex_results = [f'{{"references": ["Mark.1.{i}"], "words": []}}' for i in range(23)]
-    basex_string = f'[{",".join(basex_results)}]'
-    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: basex_string)
+    basex_results = [f'{{"references": ["Mark.1.{i}"], "words": []}}' for i in range(10, 20)]
+    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: matches_response(23),
+                                lambda: page_response(basex_results))
     result = provider.text_query(TextQuery({'sequences': [], 'page': 2}, lambda x: None))
     assert result.page == 2
     assert len(result.passages) == 10
@@ -145,23 +261,22 @@ def test_text_query_returns_requested_page(mocker, basex_session_mock, provider)
 
 def test_text_query_handles_page_smaller_than_pagesize(mocker, basex_session_mock, provider):
     basex_results = [f'{{"references": ["Mark.1.1"], "words": []}}' for i in range(5)]
-    basex_string = f'[{",".join(basex_results)}]'
-    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: basex_string)
+    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: matches_response(5),
+                                lambda: page_response(basex_results))
     result = provider.text_query(TextQuery({'sequences': []}, lambda x: None))
     assert len(result.passages) == 5
 
 
 def test_text_query_handles_request_for_invalid_page(mocker, basex_session_mock, provider):
-    basex_string = '[{"references": ["Mark.1.1"], "words": []}]'
-    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: basex_string)
+    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: matches_response(1),
+                                lambda: page_response([]))
     with pytest.raises(ProbableBugError) as excinfo:
         provider.text_query(TextQuery({'sequences': [], 'page': 2}, lambda x: None))
     assert excinfo.value.message == 'Requested page 2 is out of bounds for results with 1 total pages'
 
 
 def test_text_query_handles_pagination_for_no_results(mocker, basex_session_mock, provider):
-    basex_string = '[]'
-    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: basex_string)
+    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: NO_RESULTS)
     result = provider.text_query(TextQuery({'sequences': []}, lambda x: None))
     assert result.page == 1
     assert result.total_pages == 1
@@ -180,11 +295,12 @@ def test_text_query_error_on_processing_results(mocker, basex_session_mock, prov
     mock_basex_on_query_execute(mocker, basex_session_mock, lambda: '{"invalid": "json"}')
     with pytest.raises(ProbableBugError) as excinfo:
         provider.text_query(TextQuery({'sequences': []}, lambda x: None))
-    assert excinfo.value.message == 'Error parsing XML database response JSON: Results are not a list'
+    assert excinfo.value.message == 'Error parsing XML database response JSON: Matches are not a list of sentences ' \
+                                    'with the matches for each sequence'
 
 
 def test_text_query_handles_word_query_with_no_attributes(mocker, basex_session_mock, provider):
-    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: '[]')
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: NO_RESULTS)
     query = TextQuery({
         'sequences': [
             [
@@ -200,7 +316,8 @@ def test_text_query_handles_word_query_with_no_attributes(mocker, basex_session_
         ]
     }, lambda x: None)
     provider.text_query(query)
-    assert "for $word0 in $sentence//w[@lemma='λόγος'] for $word1 in $sentence//w" in basex_query_spy.call_args.args[1]
+    assert "for $word0 in $sentence//w[@lemma='λόγος']\nlet $pos0 := xs:integer($word0/@position)\n" \
+           "for $word1 in $sentence//w[@position > $pos0]\n" in basex_query_spy.call_args.args[1]
 
 
 def test_text_query_handles_disallowed_attribute(provider):
@@ -221,7 +338,7 @@ def test_text_query_handles_disallowed_attribute(provider):
 
 
 def test_text_query_sanitizes_attribute_values(mocker, basex_session_mock, provider):
-    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: '[]')
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: NO_RESULTS)
     query = TextQuery({
         'sequences': [
             [
@@ -238,25 +355,32 @@ def test_text_query_sanitizes_attribute_values(mocker, basex_session_mock, provi
 
 
 def test_attribute_query_success(mocker, basex_session_mock, provider):
-    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: '["value1","value2"]')
+    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: ATTRIBUTE_VALUES)
     result = provider.attribute_query('gender')
     assert result == ['value1', 'value2']
 
 
-def test_attribute_query_query_string(mocker, basex_session_mock, provider):
-    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: '["value1","value2"]')
+def test_attribute_query_loads_every_attribute_at_once(mocker, basex_session_mock, provider):
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: ATTRIBUTE_VALUES)
     provider.attribute_query('gender')
-    assert basex_query_spy.call_args.args[1] == """
-            json:serialize(
-              array {
-                sort(distinct-values(//w/@gender))
-              }
-            )
-        """
+    query_string = basex_query_spy.call_args.args[1]
+    assert '"gender": array {sort(distinct-values(//w/@gender))}' in query_string
+    assert '"lemma": array {sort(distinct-values(//w/@lemma))}' in query_string
+
+    assert provider.attribute_query('case') == ['value1', 'value2']
+    assert basex_query_spy.call_count == 1
+
+
+def test_warm_up_loads_attribute_values(mocker, basex_session_mock, provider):
+    mocker.patch.object(provider, 'load_sentence_index')
+    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: ATTRIBUTE_VALUES)
+    provider.warm_up()
+    assert provider.attribute_values['tense'] == ['value1', 'value2']
 
 
 def test_attribute_query_lemma_caching(mocker, basex_session_mock, provider):
-    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: '["lemma1","lemma2"]')
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock,
+                                                  lambda: attribute_values_response(['lemma1', 'lemma2']))
     result1 = provider.attribute_query('lemma')
     assert result1 == ['lemma1', 'lemma2']
     assert basex_query_spy.call_count == 1
@@ -266,7 +390,8 @@ def test_attribute_query_lemma_caching(mocker, basex_session_mock, provider):
 
 
 def test_attribute_query_surface_form_caching(mocker, basex_session_mock, provider):
-    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: '["normalized1","normalized2"]')
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock,
+                                                  lambda: attribute_values_response(['normalized1', 'normalized2']))
     result1 = provider.attribute_query('normalized')
     assert result1 == ['normalized1', 'normalized2']
     assert basex_query_spy.call_count == 1
@@ -295,3 +420,386 @@ def test_attribute_query_error_on_processing_results(mocker, basex_session_mock,
     with pytest.raises(ProbableBugError) as excinfo:
         provider.attribute_query('gender')
     assert excinfo.value.message == 'Error processing query results: JSONDecodeError'
+
+
+def test_text_query_caches_matches(mocker, basex_session_mock, provider):
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: matches_response(1),
+                                                  lambda: page_response(['{"references": ["Mark.1.1"], "words": []}']))
+    provider.text_query(TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος', 'case': 'genitive'}}]]},
+                                  lambda x: None))
+    result = provider.text_query(TextQuery({'sequences': [[{'attributes': {'case': 'genitive', 'lemma': 'λόγος'}}]]},
+                                           lambda x: None))
+    # only the page is built again
+    assert basex_query_spy.call_count == 3
+    assert count_matches_queries(basex_query_spy) == 1
+    assert result.passages[0].references[0].string_ref == 'Mark.1.1'
+
+
+def test_text_query_builds_every_page_from_the_same_matches(mocker, basex_session_mock, provider):
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: matches_response(23),
+                                                  lambda: page_response([]))
+    provider.text_query(TextQuery({'sequences': [], 'page': 1}, lambda x: None))
+    provider.text_query(TextQuery({'sequences': [], 'page': 2}, lambda x: None))
+    provider.text_query(TextQuery({'sequences': [], 'page': 1}, lambda x: None))
+    provider.text_query(TextQuery({'sequences': [], 'page': 2}, lambda x: None))
+    assert basex_query_spy.call_count == 5
+    assert count_matches_queries(basex_query_spy) == 1
+
+
+def test_text_query_does_not_cache_invalid_results(mocker, basex_session_mock, provider):
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: '{"invalid": "json"}')
+    for _ in range(2):
+        with pytest.raises(ProbableBugError):
+            provider.text_query(TextQuery({'sequences': []}, lambda x: None))
+    assert basex_query_spy.call_count == 2
+
+
+def test_text_query_cache_is_keyed_on_corpus_version(mocker, basex_session_mock, provider):
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: NO_RESULTS)
+    provider.text_query(TextQuery({'sequences': []}, lambda x: None))
+    provider.result_cache.corpus_version = 'new version'
+    provider.text_query(TextQuery({'sequences': []}, lambda x: None))
+    assert basex_query_spy.call_count == 2
+
+
+def test_uses_given_cache_backend(mocker, basex_session_mock):
+    cache = MemoryCache(max_size=1000)
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock,
+                                                  lambda: attribute_values_response(['lemma1', 'lemma2']))
+    Nestle1904LowfatProvider(cache).attribute_query('lemma')
+    result = Nestle1904LowfatProvider(cache).attribute_query('lemma')
+    assert result == ['lemma1', 'lemma2']
+    assert basex_query_spy.call_count == 1
+
+
+def test_loads_sentence_index(mocker, basex_session_mock, provider):
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: '[{"lemma": {"λόγος": 2}}, {}]')
+    provider.load_sentence_index()
+    assert 'for $sentence in //sentence' in basex_query_spy.call_args.args[1]
+    assert '"lemma": map:merge(for $value in $sentence//w/@lemma group by $key := string($value) ' \
+           'return map {$key: count($value)})' in basex_query_spy.call_args.args[1]
+    assert provider.sentence_index.bitmaps['lemma']['λόγος'] == 0b01
+    assert provider.sentence_index.value_counts['lemma']['λόγος'] == 2
+
+    Nestle1904LowfatProvider(provider.cache).load_sentence_index()
+    assert basex_query_spy.call_count == 1
+
+
+def test_retries_loading_sentence_index_after_it_fails(mocker, basex_session_mock, provider):
+    mocker.patch.object(provider, '_sentence_index_retry_delay', 0.05)
+    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: 'not json')
+    with pytest.raises(ProbableBugError):
+        provider.load_sentence_index()
+    text_query = TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None)
+
+    # an empty list is both an empty sentence index and no counts
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: '[]')
+    # too soon to try again
+    provider.count_query(text_query)
+    assert provider.sentence_index is None
+    assert basex_query_spy.call_count == 1
+
+    time.sleep(0.05)
+    provider.count_query(TextQuery({'sequences': [[{'attributes': {'lemma': 'ὁ'}}]]}, lambda x: None))
+    assert provider.sentence_index is not None
+    assert 'for $sentence in //sentence' in basex_query_spy.call_args_list[1].args[1]
+
+
+def test_waits_longer_after_each_failure_to_load_sentence_index(mocker, basex_session_mock, provider):
+    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: 'not json')
+    for _ in range(3):
+        with pytest.raises(ProbableBugError):
+            provider.load_sentence_index()
+    assert provider._sentence_index_retry_delay == provider.SENTENCE_INDEX_RETRY_MIN * 8
+
+
+def test_text_query_searches_only_candidate_sentences(mocker, basex_session_mock, provider):
+    provider.sentence_index = SentenceIndex.from_json([{'lemma': ['ὁ']}, {'lemma': ['λόγος']}, {'lemma': ['λόγος']}],
+                                                      lambda x: None)
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: NO_RESULTS)
+    provider.text_query(TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None))
+    assert "for $sentence_index in ('2', '3')" in basex_query_spy.call_args.args[1]
+
+
+def test_text_query_skips_database_when_nothing_can_match(mocker, basex_session_mock, provider):
+    provider.sentence_index = SentenceIndex.from_json([{'lemma': ['ὁ']}], lambda x: None)
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: NO_RESULTS)
+    result = provider.text_query(TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None))
+    assert basex_query_spy.call_count == 0
+    assert len(result.passages) == 0
+    assert result.total_pages == 1
+
+
+def test_text_query_searches_rarest_word_query_first(mocker, basex_session_mock, provider):
+    provider.sentence_index = SentenceIndex.from_json(
+        [{'class': {'noun': 5}, 'lemma': {'λόγος': 1}}, {'class': {'noun': 3}, 'lemma': {'λόγος': 1}}], lambda x: None)
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: NO_RESULTS)
+    query = TextQuery({'sequences': [
+        [{'attributes': {'class': 'noun'}, 'link': {'allowedWordsBetween': 0}}, {'attributes': {'lemma': 'λόγος'}}],
+    ]}, lambda x: None)
+    provider.text_query(query)
+    query_string = basex_query_spy.call_args.args[1]
+    assert "for $word1 in $sentence//w[@lemma='λόγος']\nlet $pos1 := xs:integer($word1/@position)\n" \
+           "for $word0 in $sentence//w[@class='noun'][@position < $pos1 and @position >= $pos1 - 1]\n" in query_string
+    assert 'order by db:node-pre($word0), db:node-pre($word1)' in query_string
+    assert 'return map {$word0/@osisId: 0, $word1/@osisId: 1}' in query_string
+
+
+def test_text_query_checks_rarest_sequence_first(mocker, basex_session_mock, provider):
+    provider.sentence_index = SentenceIndex.from_json(
+        [{'class': {'noun': 5}, 'lemma': {'λόγος': 1}}], lambda x: None)
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: NO_RESULTS)
+    query = TextQuery({'sequences': [
+        [{'attributes': {'class': 'noun'}}],
+        [{'attributes': {'lemma': 'λόγος'}}],
+    ]}, lambda x: None)
+    provider.text_query(query)
+    query_string = basex_query_spy.call_args.args[1]
+    assert query_string.index('where map:size($matching_sequence1) > 0') < \
+        query_string.index('let $matching_sequence0 :=')
+    assert 'order by db:node-pre' not in query_string
+
+
+def test_text_query_finds_sentences_with_attribute_index(mocker, basex_session_mock, provider):
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: NO_RESULTS)
+    query = TextQuery({'sequences': [
+        [{'attributes': {'lemma': 'κύριος', 'case': 'genitive'}}, {}],
+        [{'attributes': {'lemma': "μετ'"}}],
+    ]}, lambda x: None)
+    provider.text_query(query)
+    assert "for $sentence in " \
+           "(db:attribute('nestle1904lowfat', 'κύριος', 'lemma')/parent::w[@case='genitive']/ancestor::sentence)\n" \
+           "intersect (db:attribute('nestle1904lowfat', 'μετ’', 'lemma')/parent::w/ancestor::sentence)" \
+           in basex_query_spy.call_args.args[1]
+
+
+def test_attribute_index_lookup_uses_rarest_attribute(mocker, basex_session_mock, provider):
+    provider.sentence_index = SentenceIndex.from_json([{'lemma': {'λόγος': 1}, 'case': {'genitive': 5}}] * 2,
+                                                      lambda x: None)
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: NO_RESULTS)
+    provider.text_query(TextQuery({'sequences': [[{'attributes': {'case': 'genitive', 'lemma': 'λόγος'}}, {}]]},
+                                  lambda x: None))
+    assert "db:attribute('nestle1904lowfat', 'λόγος', 'lemma')/parent::w[@case='genitive']" in \
+           basex_query_spy.call_args.args[1]
+
+
+def test_text_query_walks_sentences_when_no_word_query_has_attributes(mocker, basex_session_mock, provider):
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: NO_RESULTS)
+    provider.text_query(TextQuery({'sequences': [[{}]]}, lambda x: None))
+    assert 'for $sentence in //sentence\n' in basex_query_spy.call_args.args[1]
+
+
+def test_text_query_with_deadline_asks_basex_to_time_out(mocker, basex_session_mock, provider):
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: NO_RESULTS)
+    provider.text_query(TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None),
+                        Deadline(2.5))
+    query_string = basex_query_spy.call_args.args[1]
+    assert query_string.startswith("xquery:eval('")
+    assert query_string.endswith("', map {}, map {'timeout': 3})")
+    assert "$sentence//w[@lemma=''λόγος'']" in query_string
+
+
+def test_text_query_that_timed_out_is_not_retried(mocker, basex_session_mock, provider):
+    deadline = Deadline(60)
+
+    def time_out():
+        mocker.patch.object(deadline, 'expired', return_value=True)
+        raise Exception('[BXXQ0005] Query timeout exceeded')
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, time_out)
+    with pytest.raises(QueryTimeoutError) as excinfo:
+        provider.text_query(TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None), deadline)
+    assert basex_query_spy.call_count == 1
+    assert excinfo.value.http_error_code == 504
+    assert provider.result_cache.get_matches(
+        TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None)) is None
+
+
+def test_text_query_past_deadline_does_not_query_basex(mocker, basex_session_mock, provider):
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: NO_RESULTS)
+    with pytest.raises(QueryTimeoutError):
+        provider.text_query(TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None),
+                            Deadline(0))
+    assert basex_query_spy.call_count == 0
+
+
+def test_text_query_is_shed_when_too_many_queries_wait(mocker, basex_session_mock, provider):
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: NO_RESULTS)
+    mocker.patch.object(provider.admission_gate, 'max_in_flight', 0)
+    mocker.patch.object(provider.admission_gate, 'max_waiting', 0)
+    with pytest.raises(ServerOverwhelmedError) as excinfo:
+        provider.text_query(TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None))
+    assert excinfo.value.message == 'Too many queries are waiting for the database'
+    assert basex_query_spy.call_count == 0
+    assert provider.get_stats()['admission_gate']['shed'] == 1
+
+
+def test_attribute_query_uses_priority_lane(mocker, basex_session_mock, provider):
+    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: ATTRIBUTE_VALUES)
+    admit_spy = mocker.spy(provider.admission_gate, 'admit')
+    provider.attribute_query('gender')
+    assert admit_spy.call_args.args[0] is True
+
+
+def test_get_stats(mocker, basex_session_mock, provider):
+    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: NO_RESULTS)
+    provider.text_query(TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None))
+    stats = provider.get_stats()
+    assert stats.keys() == {'admission_gate', 'session_pool', 'cache'}
+    assert stats['admission_gate']['admitted'] == 1
+    assert stats['admission_gate']['in_flight'] == 0
+
+
+def test_text_query_reports_estimated_cost(mocker, basex_session_mock, provider):
+    provider.sentence_index = SentenceIndex.from_json([{'lemma': {'λόγος': 2}}, {'lemma': {'ὁ': 2}}], lambda x: None)
+    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: NO_RESULTS)
+    result = provider.text_query(TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None))
+    assert result.query_info == {'estimatedCandidateSentences': 1, 'estimatedWordVisits': 2}
+
+
+def test_text_query_rejects_expensive_queries(mocker, basex_session_mock, provider):
+    provider.sentence_index = SentenceIndex.from_json([{'lemma': {'λόγος': 2}}, {'lemma': {'ὁ': 2}}], lambda x: None)
+    mocker.patch('app_constants.query_cost_limit', 1)
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: NO_RESULTS)
+    with pytest.raises(QueryTooExpensiveError) as excinfo:
+        provider.text_query(TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None))
+    assert excinfo.value.message == 'Query would look at about 2 words, more than the limit of 1'
+    assert excinfo.value.http_error_code == 422
+    assert basex_query_spy.call_count == 0
+
+
+def test_text_query_caps_results_when_it_could_match_too_many_sentences(mocker, basex_session_mock, provider):
+    provider.sentence_index = SentenceIndex.from_json([{'lemma': ['λόγος']}] * 30, lambda x: None)
+    mocker.patch('app_constants.query_result_limit', 20)
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: matches_response(21),
+                                                  lambda: NO_RESULTS)
+    result = provider.text_query(TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None))
+    matches_query_string = basex_query_spy.call_args_list[0].args[1]
+    assert 'let $matches := subsequence((' in matches_query_string
+    assert '), 1, 21)' in matches_query_string
+    assert result.total_pages == 2
+    assert result.serialize_pagination() == {'page': 1, 'totalPages': 2, 'resultLimit': 20}
+
+
+def test_text_query_reports_no_limit_when_results_fit(mocker, basex_session_mock, provider):
+    provider.sentence_index = SentenceIndex.from_json([{'lemma': ['λόγος']}] * 30, lambda x: None)
+    mocker.patch('app_constants.query_result_limit', 20)
+    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: matches_response(15), lambda: NO_RESULTS)
+    result = provider.text_query(TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None))
+    assert result.total_pages == 2
+    assert result.result_limit is None
+
+
+def test_text_query_does_not_cap_results_when_few_sentences_could_match(mocker, basex_session_mock, provider):
+    provider.sentence_index = SentenceIndex.from_json([{'lemma': ['λόγος']}] * 20, lambda x: None)
+    mocker.patch('app_constants.query_result_limit', 20)
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: NO_RESULTS)
+    provider.text_query(TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None))
+    assert 'subsequence((' not in basex_query_spy.call_args.args[1]
+
+
+def test_text_query_batch_returns_errors_in_place(mocker, basex_session_mock, provider):
+    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: matches_response(1),
+                                lambda: page_response(['{"references": ["Mark.1.1"], "words": []}']))
+    results = provider.text_query_batch([
+        TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None),
+        TextQuery({'sequences': [[{'attributes': {'disallowed': 'value'}}]]}, lambda x: None),
+        TextQuery({'sequences': [[{'attributes': {'lemma': 'ὁ'}}]]}, lambda x: None),
+    ])
+    assert [type(result).__name__ for result in results] == ['QueryResult', 'ProbableBugError', 'QueryResult']
+    assert results[2].passages[0].references[0].string_ref == 'Mark.1.1'
+
+
+def test_count_query(mocker, basex_session_mock, provider):
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock,
+                                                  lambda: '[["Mark.1.1", 2], ["Mark.2.3", 1]]')
+    counts = provider.count_query(TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None))
+    assert counts.total == 3
+    assert [book.book for book in counts.books] == ['Mark']
+    query_string = basex_query_spy.call_args.args[1]
+    assert 'return $sentence' in query_string
+    assert "group by $chapter := replace($first_reference, '\\.[^.]*$', '')" in query_string
+    # no words or pages are built
+    assert '"words"' not in query_string
+    assert 'subsequence(' not in query_string
+
+
+def test_count_query_is_cached(mocker, basex_session_mock, provider):
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: '[["Mark.1.1", 2]]')
+    provider.count_query(TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None))
+    counts = provider.count_query(TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]], 'page': 2},
+                                            lambda x: None))
+    assert counts.total == 2
+    assert basex_query_spy.call_count == 1
+
+
+def test_quick_count_query_only_answers_from_the_cache(mocker, basex_session_mock, provider):
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: '[["Mark.1.1", 2]]')
+    text_query = TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None)
+    assert provider.quick_count_query(text_query) is None
+    provider.count_query(text_query)
+    assert provider.quick_count_query(text_query).total == 2
+    assert basex_query_spy.call_count == 1
+
+
+def test_quick_text_query_needs_the_database_for_a_page_of_saved_matches(mocker, basex_session_mock, provider):
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: matches_response(1),
+                                                  lambda: page_response([]))
+    text_query = TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None)
+    assert provider.quick_text_query(text_query) is None
+    provider.text_query(text_query)
+    assert provider.quick_text_query(text_query) is None
+    assert basex_query_spy.call_count == 2
+
+    # nothing can match one that isn't saved
+    provider.sentence_index = SentenceIndex.from_json([{'lemma': ['ὁ']}], lambda x: None)
+    other_query = TextQuery({'sequences': [[{'attributes': {'lemma': 'ἄλλος'}}]]}, lambda x: None)
+    assert provider.quick_text_query(other_query).passages == []
+    assert basex_query_spy.call_count == 2
+
+
+def test_count_query_skips_database_when_nothing_can_match(mocker, basex_session_mock, provider):
+    provider.sentence_index = SentenceIndex.from_json([{'lemma': ['ὁ']}], lambda x: None)
+    basex_query_spy = mock_basex_on_query_execute(mocker, basex_session_mock, lambda: '[]')
+    counts = provider.count_query(TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None))
+    assert counts.total == 0
+    assert basex_query_spy.call_count == 0
+
+
+def test_count_and_facet_queries_report_estimated_cost(mocker, basex_session_mock, provider):
+    provider.sentence_index = SentenceIndex.from_json([{'lemma': {'λόγος': 2}}, {'lemma': {'ὁ': 2}}], lambda x: None)
+    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: '[["Mark.1.1", 2]]')
+    text_query = TextQuery({'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, lambda x: None)
+    provider.count_query(text_query)
+    # including when the counts come from the cache
+    counts = provider.count_query(text_query)
+    assert counts.serialize()['queryInfo'] == {'estimatedCandidateSentences': 1, 'estimatedWordVisits': 2}
+
+    mock_basex_on_query_execute(mocker, basex_session_mock, lambda: '{"totalWords": 2, "attributes": {"case": {}}}')
+    facet_query = FacetQuery({'query': {'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, 'sequence': 0,
+                              'wordQuery': 0, 'attributes': ['case']}, lambda x: None)
+    facet_counts = provider.facet_query(facet_query)
+    assert facet_counts.query_info == {'estimatedCandidateSentences': 1, 'estimatedWordVisits': 2}
+
+
+def test_facet_query(mocker, basex_session_mock, provider):
+    basex_query_spy = mock_basex_on_query_execute(
+        mocker, basex_session_mock, lambda: '{"totalWords": 3, "attributes": {"case": {"nominative": 3}}}')
+    facet_query = FacetQuery({'query': {'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, 'sequence': 0,
+                              'wordQuery': 0, 'attributes': ['case']}, lambda x: None)
+    counts = provider.facet_query(facet_query)
+    assert counts.serialize() == {'totalWords': 3, 'attributes': {'case': {'nominative': 3}}}
+    query_string = basex_query_spy.call_args.args[1]
+    assert 'where $matching_sequence0($id) = 0' in query_string
+    assert '"case": map:merge(for $value in $words/@case group by $key := string($value) ' \
+           'return map {$key: count($value)})' in query_string
+
+    provider.facet_query(facet_query)
+    assert basex_query_spy.call_count == 1
+
+
+def test_facet_query_disallowed_attribute(provider):
+    facet_query = FacetQuery({'query': {'sequences': [[{'attributes': {'lemma': 'λόγος'}}]]}, 'sequence': 0,
+                              'wordQuery': 0, 'attributes': ['osisId']}, lambda x: None)
+    with pytest.raises(ProbableBugError) as excinfo:
+        provider.facet_query(facet_query)
+    assert excinfo.value.message == 'Attribute \'osisId\' not allowed'
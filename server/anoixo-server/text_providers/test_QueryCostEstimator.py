@@ -0,0 +1,58 @@
+from text_providers.QueryCostEstimator import QueryCost, QueryCostEstimator
+from text_providers.SentenceIndex import SentenceIndex
+from TextQuery import TextQuery
+
+# 4 sentences of 4 words each
+SENTENCES = [
+    {'class': {'noun': 2, 'verb': 2}, 'lemma': {'λόγος': 1, 'ὁ': 1, 'εἰμί': 2}},
+    {'class': {'noun': 4}, 'lemma': {'λόγος': 4}},
+    {'class': {'verb': 4}, 'lemma': {'εἰμί': 4}},
+    {'class': {'noun': 4}, 'lemma': {'ὁ': 4}},
+]
+
+
+def estimate(sequences) -> QueryCost:
+    index = SentenceIndex.from_json(SENTENCES, lambda x: None)
+    query = TextQuery({'sequences': sequences}, lambda x: None)
+    return QueryCostEstimator(index).estimate(query, index.candidate_sentences(query))
+
+
+def test_single_word_query_looks_at_each_candidate_sentence_once():
+    cost = estimate([[{'attributes': {'lemma': 'λόγος'}}]])
+    assert cost.candidate_sentences == 2
+    assert cost.word_visits == 8
+
+
+def test_word_query_without_attributes_looks_at_every_sentence():
+    cost = estimate([[{}]])
+    assert cost.candidate_sentences == 4
+    assert cost.word_visits == 16
+
+
+def test_later_word_queries_look_again_for_each_earlier_match():
+    # λόγος is searched first, and has 2.5 matches per candidate sentence for noun to be searched around
+    cost = estimate([[{'attributes': {'class': 'noun'}}, {'attributes': {'lemma': 'λόγος'}}]])
+    assert cost.candidate_sentences == 2
+    assert cost.word_visits == 28
+
+
+def test_links_limit_matches_next_to_a_neighbour():
+    unlinked = estimate([[{'attributes': {'class': 'noun'}}, {'attributes': {'lemma': 'λόγος'}},
+                          {'attributes': {'lemma': 'ὁ'}}]])
+    linked = estimate([[{'attributes': {'class': 'noun'}},
+                        {'attributes': {'lemma': 'λόγος'}, 'link': {'allowedWordsBetween': 0}},
+                        {'attributes': {'lemma': 'ὁ'}}]])
+    # 1 scan for λόγος, then 5 for ὁ, then 25 (or 5 when ὁ has to be right after λόγος) for noun
+    assert unlinked.word_visits == 4 * 31
+    assert linked.word_visits == 4 * 11
+
+
+def test_sequences_add_up():
+    cost = estimate([[{'attributes': {'lemma': 'λόγος'}}], [{'attributes': {'class': 'noun'}}]])
+    assert cost.candidate_sentences == 2
+    assert cost.word_visits == 16
+
+
+def test_nothing_to_search():
+    cost = estimate([[{'attributes': {'lemma': 'unknown'}}]])
+    assert cost.serialize() == {'estimatedCandidateSentences': 0, 'estimatedWordVisits': 0}
@@ -0,0 +1,38 @@
+from text_providers.QueryPlanner import QueryPlanner
+from TextQuery import TextQuery, WordSequence
+
+LEMMA_COUNTS = {'ὁ': 100, 'λόγος': 5, 'θεός': 20, 'ἀρχή': 1}
+
+
+def planner() -> QueryPlanner:
+    return QueryPlanner(lambda word_query: LEMMA_COUNTS[word_query.attributes['lemma']])
+
+
+def sequence(*lemmas: str) -> WordSequence:
+    return WordSequence([{'attributes': {'lemma': lemma}} for lemma in lemmas], lambda x: None)
+
+
+def test_starts_from_most_selective_word_query():
+    assert planner().plan_sequence(sequence('ὁ', 'λόγος')) == [(1, None), (0, 1)]
+
+
+def test_grows_toward_more_selective_neighbour():
+    assert planner().plan_sequence(sequence('ὁ', 'λόγος', 'θεός', 'ὁ')) == [(1, None), (2, 1), (3, 2), (0, 1)]
+
+
+def test_keeps_user_order_on_ties():
+    plan = QueryPlanner(lambda word_query: 0).plan_sequence(sequence('ὁ', 'λόγος', 'θεός'))
+    assert plan == [(0, None), (1, 0), (2, 1)]
+
+
+def test_empty_sequence_has_empty_plan():
+    assert planner().plan_sequence(sequence()) == []
+
+
+def test_orders_sequences_by_most_selective_word_query():
+    query = TextQuery({'sequences': [
+        [{'attributes': {'lemma': 'ὁ'}}, {'attributes': {'lemma': 'θεός'}}],
+        [{'attributes': {'lemma': 'ἀρχή'}}],
+        [{'attributes': {'lemma': 'λόγος'}}],
+    ]}, lambda x: None)
+    assert planner().plan_sequences(query) == [1, 2, 0]
@@ -0,0 +1,72 @@
+import math
+from text_providers.SentenceIndex import SentenceIndex
+from TextQuery import TextQuery
+
+SENTENCES = [
+    {'lemma': ['λόγος', 'ὁ'], 'case': ['nominative']},
+    {'lemma': ['ἀρχή'], 'case': ['dative']},
+    {'lemma': ['λόγος'], 'case': ['genitive', 'nominative']},
+]
+
+
+def candidates_for(index: SentenceIndex, sequences) -> list:
+    query = TextQuery({'sequences': sequences}, lambda x: None)
+    return SentenceIndex.sentence_indexes(index.candidate_sentences(query))
+
+
+def test_builds_bitmaps():
+    index = SentenceIndex.from_json(SENTENCES, lambda x: None)
+    assert index.sentence_count == 3
+    assert index.bitmaps['lemma']['λόγος'] == 0b101
+    assert index.bitmaps['case']['dative'] == 0b010
+
+
+def test_intersects_attributes_word_queries_and_sequences():
+    index = SentenceIndex.from_json(SENTENCES, lambda x: None)
+    assert candidates_for(index, [[{'attributes': {'lemma': 'λόγος', 'case': 'nominative'}}]]) == [0, 2]
+    assert candidates_for(index, [[{'attributes': {'lemma': 'λόγος'}}, {'attributes': {'case': 'genitive'}}]]) == [2]
+    assert candidates_for(index, [[{'attributes': {'lemma': 'λόγος'}}], [{'attributes': {'lemma': 'ὁ'}}]]) == [0]
+
+
+def test_word_query_without_attributes_matches_every_sentence():
+    index = SentenceIndex.from_json(SENTENCES, lambda x: None)
+    assert candidates_for(index, [[{}]]) == [0, 1, 2]
+    assert candidates_for(index, []) == [0, 1, 2]
+
+
+def test_unknown_values_and_empty_sequences_match_nothing():
+    index = SentenceIndex.from_json(SENTENCES, lambda x: None)
+    assert candidates_for(index, [[{'attributes': {'lemma': 'unknown'}}]]) == []
+    assert candidates_for(index, [[]]) == []
+
+
+def test_sanitizes_values():
+    index = SentenceIndex.from_json(SENTENCES, lambda x: None)
+    query = TextQuery({'sequences': [[{'attributes': {'lemma': '&λόγος'}}]]}, lambda x: None)
+    assert SentenceIndex.sentence_indexes(index.candidate_sentences(query, lambda value: value.replace('&', ''))) == \
+        [0, 2]
+
+
+def test_sentence_indexes_of_large_bitmap():
+    assert SentenceIndex.sentence_indexes((1 << 1000) | (1 << 9) | 1) == [0, 9, 1000]
+
+
+def test_counts_words_with_each_value():
+    index = SentenceIndex.from_json([{'lemma': {'λόγος': 2, 'ὁ': 1}}, {'lemma': ['λόγος', 'λόγος']}], lambda x: None)
+    assert index.bitmaps['lemma']['λόγος'] == 0b11
+    assert index.value_counts['lemma'] == {'λόγος': 4, 'ὁ': 1}
+
+
+def test_estimates_matches_from_rarest_attribute_value():
+    index = SentenceIndex.from_json(SENTENCES, lambda x: None)
+    query = TextQuery({'sequences': [[
+        {'attributes': {'lemma': 'λόγος', 'case': 'genitive'}}, {'attributes': {'lemma': 'unknown'}}, {},
+    ]]}, lambda x: None)
+    estimates = [index.estimated_matches(word_query) for word_query in query.sequences[0].word_queries]
+    assert estimates == [1, 0, math.inf]
+
+
+def test_counts_total_words():
+    index = SentenceIndex.from_json([{'class': ['noun', 'verb'], 'case': ['nominative']}, {'class': ['noun']}],
+                                    lambda x: None)
+    assert index.total_words == 3
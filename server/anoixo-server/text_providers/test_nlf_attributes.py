@@ -0,0 +1,31 @@
+import pytest
+from AnoixoError import ProbableBugError
+from text_providers.nlf_attributes import check_attributes, check_query_attributes, sanitize, sanitized
+from TextQuery import TextQuery
+
+
+def text_query(attributes):
+    return TextQuery({'sequences': [[{'attributes': attributes}]]}, lambda message: None)
+
+
+def test_rejects_attributes_not_allowed():
+    check_attributes(['lemma', 'case'])
+    with pytest.raises(ProbableBugError) as excinfo:
+        check_attributes(['lemma', 'text'])
+    assert excinfo.value.message == 'Attribute \'text\' not allowed'
+
+
+def test_rejects_query_attributes_not_allowed():
+    check_query_attributes(text_query({'lemma': 'λόγος'}))
+    with pytest.raises(ProbableBugError):
+        check_query_attributes(text_query({'lemma': 'λόγος', 'text': 'λόγος'}))
+
+
+def test_sanitize():
+    assert sanitize('a&b\'c') == 'ab’c'
+
+
+def test_sanitized_leaves_the_query_as_it_was():
+    query = text_query({'lemma': 'a&b\'c'})
+    assert sanitized(query).sequences[0].word_queries[0].attributes == {'lemma': 'ab’c'}
+    assert query.sequences[0].word_queries[0].attributes == {'lemma': 'a&b\'c'}
@@ -0,0 +1,44 @@
+import asyncio
+import concurrent.futures
+import os
+import threading
+from typing import Any, Awaitable, Optional
+
+
+class BackgroundEventLoop:
+    """
+    An asyncio event loop running forever in a daemon thread, so that synchronous code (like our Flask handlers) can
+    run coroutines on a loop that outlives any single request. That lets resources bound to the loop, like an aiohttp
+    session and its pool of keep-alive connections, be reused from request to request.
+
+    The thread is started on first use, and started again if the process has forked since, since threads don't survive
+    a fork.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pid: Optional[int] = None
+
+    def _get_running_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._pid = os.getpid()
+                threading.Thread(target=self._loop.run_forever, name='BackgroundEventLoop', daemon=True).start()
+            return self._loop
+
+    def run(self, coroutine: Awaitable, timeout: Optional[float] = None) -> Any:
+        """
+        Runs a coroutine on the background loop and waits for its result.
+        :param coroutine: The coroutine to run
+        :param timeout: How many seconds to wait before cancelling the coroutine and raising
+        concurrent.futures.TimeoutError
+        :return: The coroutine's result
+        """
+        future = asyncio.run_coroutine_threadsafe(coroutine, self._get_running_loop())
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
@@ -1,9 +1,16 @@
 import aiohttp
 import asyncio
+import app_constants
+import concurrent.futures
 from translation_providers import ESVApiTranslationProvider_Secret as Config
-from typing import Dict, List
-from AnoixoError import ProbableBugError, ServerOverwhelmedError
-from QueryResult import QueryResult, Reference
+from typing import Dict, List, Optional, Set
+from AnoixoError import ProbableBugError, QueryTimeoutError, ServerOverwhelmedError
+from caching.CacheBackend import CacheBackend
+from caching.MemoryCache import MemoryCache
+from Deadline import Deadline
+from Metrics import Metrics
+from QueryResult import PassageResult, QueryResult, Reference
+from translation_providers.BackgroundEventLoop import BackgroundEventLoop
 from translation_providers.TranslationProvider import TranslationProvider
 
 
@@ -36,6 +43,28 @@ class ESVApiTranslationProvider(TranslationProvider):
         'indent-paragraphs': '0',
     }
 
+    """
+    The ESV API terms of use don't allow storing more than 500 verses at a time, so that's the size limit for all the
+    translation caches on a host put together (entries are sized by how many verses they hold).
+    """
+    MAX_CACHED_VERSES = 500
+
+    def __init__(self, cache: Optional[CacheBackend] = None, metrics: Optional[Metrics] = None):
+        """
+        :param cache: Where to cache translations, keyed on the passage's verse reference/range. Its size limit,
+        together with those of the caches in the host's other worker processes, must respect MAX_CACHED_VERSES.
+        Defaults to an in-memory cache for this provider alone, holding all MAX_CACHED_VERSES, so when there are several
+        worker processes, pass a cache shared between them (as api_common does) or one with a share of the limit.
+        :param metrics: Where to record how long the API takes
+        """
+        self.cache = cache or MemoryCache(self.MAX_CACHED_VERSES)
+        self.metrics = metrics or Metrics()
+        # Requests run on a long-lived loop with a persistent session, so connections to the API are kept alive
+        # between searches instead of paying for a new TLS handshake every time
+        self._event_loop = BackgroundEventLoop()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._session_loop: Optional[asyncio.AbstractEventLoop] = None
+
     def _get_verse_query(self, references: List[Reference]) -> str:
         if not references:
             raise ProbableBugError('Result has no references')
@@ -60,49 +89,168 @@ class ESVApiTranslationProvider(TranslationProvider):
                 raise ServerOverwhelmedError(f'Error response from ESV API: {err.status} {err.message}')
         return TranslationsForResultIndexes(json, chunk_start_index)
 
-    async def _request_translations(self, query_result: QueryResult) -> List[TranslationsForResultIndexes]:
-        # trust_env pulls proxy information from environment variables (HTTP_PROXY and HTTPS_PROXY)
-        async with aiohttp.ClientSession(
-                headers={'Authorization': Config.esv_api_key}, trust_env=True, raise_for_status=True) as session:
-            result_index = 0
-            verses_in_chunk_counter = 0
-            query_string_length = self.STARTING_REQUEST_LINE_SIZE
-            chunk_verse_queries: List[str] = []
-            chunk_start_index = 0
-            requests = []
-
-            while result_index < len(query_result.passages):
-                result = query_result.passages[result_index]
-                verses_in_chunk_counter += len(result.references)
-                verse_query = self._get_verse_query(result.references)
-                query_string_length += len(verse_query) + 3  # add 3 chars for URL-encoded semicolon character
-
-                # Partition requests into 300-verse chunks/4094-char request lines
-                if verses_in_chunk_counter > 300 or query_string_length > 4094:
-                    requests.append(self._send_query(session, chunk_verse_queries, chunk_start_index))
-                    verses_in_chunk_counter = 0
-                    query_string_length = self.STARTING_REQUEST_LINE_SIZE
-                    chunk_verse_queries = []
-                    chunk_start_index = result_index
-                else:
-                    chunk_verse_queries.append(verse_query)
-                    result_index += 1
-
-            # if there is a remainder from the 300-verse/4094-char chunks
-            if verses_in_chunk_counter > 0:
+    async def _get_session(self) -> aiohttp.ClientSession:
+        # A session can only be used on the loop it was created on
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            if self._session is not None:
+                self._close_session_on_its_loop()
+            # trust_env pulls proxy information from environment variables (HTTP_PROXY and HTTPS_PROXY)
+            self._session = aiohttp.ClientSession(
+                headers={'Authorization': Config.esv_api_key}, trust_env=True, raise_for_status=True)
+            self._session_loop = loop
+        return self._session
+
+    def _close_session_on_its_loop(self) -> Optional[concurrent.futures.Future]:
+        """
+        Starts closing the session on the loop it was created on, which is the only loop that can close its connections
+        :return: The future for the closing, or None if there's nothing left that can be closed
+        """
+        if self._session is None or self._session.closed or self._session_loop is None or \
+                not self._session_loop.is_running():
+            # a loop that has stopped has already dropped the session's connections
+            return None
+        return asyncio.run_coroutine_threadsafe(self._session.close(), self._session_loop)
+
+    def close(self) -> None:
+        """
+        Closes the session's connections. Must not be called from the session's own loop; use close_async there.
+        """
+        closing = self._close_session_on_its_loop()
+        if closing is not None:
+            closing.result(app_constants.translation_timeout)
+
+    async def close_async(self) -> None:
+        if self._session is not None and self._session_loop is asyncio.get_running_loop():
+            await self._session.close()
+        else:
+            self.close()
+
+    async def _request_translations(self, passages: List[PassageResult]) -> List[TranslationsForResultIndexes]:
+        session = await self._get_session()
+        result_index = 0
+        verses_in_chunk_counter = 0
+        query_string_length = self.STARTING_REQUEST_LINE_SIZE
+        chunk_verse_queries: List[str] = []
+        chunk_start_index = 0
+        requests = []
+
+        while result_index < len(passages):
+            result = passages[result_index]
+            verses_in_chunk_counter += len(result.references)
+            verse_query = self._get_verse_query(result.references)
+            query_string_length += len(verse_query) + 3  # add 3 chars for URL-encoded semicolon character
+
+            # Partition requests into 300-verse chunks/4094-char request lines
+            if verses_in_chunk_counter > 300 or query_string_length > 4094:
                 requests.append(self._send_query(session, chunk_verse_queries, chunk_start_index))
+                verses_in_chunk_counter = 0
+                query_string_length = self.STARTING_REQUEST_LINE_SIZE
+                chunk_verse_queries = []
+                chunk_start_index = result_index
+            else:
+                chunk_verse_queries.append(verse_query)
+                result_index += 1
+
+        # if there is a remainder from the 300-verse/4094-char chunks
+        if verses_in_chunk_counter > 0:
+            requests.append(self._send_query(session, chunk_verse_queries, chunk_start_index))
 
+        with self.metrics.time('anoixo_esv_request_seconds'):
             results = await asyncio.gather(*requests)
-            return results
+        return results
 
-    def _add_translations_to_result(self, query_result: QueryResult,
-                                    translation_chunks: List[TranslationsForResultIndexes]) -> None:
+    def _add_translations_to_passages(self, passages: List[PassageResult],
+                                      translation_chunks: List[TranslationsForResultIndexes]) -> None:
         for translation_chunk in translation_chunks:
             result_start_index = translation_chunk.result_start_index
             translations = translation_chunk.translations
             for i in range(len(translations)):
-                query_result.passages[result_start_index + i].translation = translations[i]
+                passages[result_start_index + i].translation = translations[i]
 
-    def add_translations(self, query_result: QueryResult) -> None:
-        translations = asyncio.run(self._request_translations(query_result))
-        self._add_translations_to_result(query_result, translations)
+    def _get_cache_key(self, passage: PassageResult) -> str:
+        return f'esv:{self._get_verse_query(passage.references)}'
+
+    def _add_cached_translations(self, query_results: List[QueryResult]) -> List[PassageResult]:
+        """
+        :return: The passages that didn't have a cached translation. A passage for the same verses as one in an earlier
+        query result is left out, so those verses are only requested once.
+        """
+        uncached_passages: List[PassageResult] = []
+        requested_keys: Set[str] = set()
+        for query_result in query_results:
+            result_keys: Set[str] = set()
+            for passage in query_result.passages:
+                cache_key = self._get_cache_key(passage)
+                cached_translation = self.cache.get(cache_key)
+                if cached_translation is not None:
+                    passage.translation = cached_translation
+                elif cache_key not in requested_keys:
+                    uncached_passages.append(passage)
+                    result_keys.add(cache_key)
+            requested_keys |= result_keys
+        return uncached_passages
+
+    def _add_requested_translations(self, passages: List[PassageResult], requested_passages: List[PassageResult],
+                                    translations: List[TranslationsForResultIndexes]) -> None:
+        """
+        :param passages: All the passages being translated
+        :param requested_passages: The passages translations were requested for
+        """
+        self._add_translations_to_passages(requested_passages, translations)
+        requested_translations: Dict[str, str] = {}
+        for passage in requested_passages:
+            if passage.translation:
+                cache_key = self._get_cache_key(passage)
+                self.cache.set(cache_key, passage.translation, size=len(passage.references))
+                requested_translations[cache_key] = passage.translation
+        # passages for the same verse range as a requested one share its translation
+        for passage in passages:
+            if not passage.translation:
+                passage.translation = requested_translations.get(self._get_cache_key(passage), '')
+
+    def _get_timeout(self, deadline: Optional[Deadline]) -> float:
+        if deadline is None:
+            return app_constants.translation_timeout
+        deadline.check()
+        return min(app_constants.translation_timeout, deadline.remaining())
+
+    def _timeout_error(self, deadline: Optional[Deadline]) -> Exception:
+        if deadline and deadline.expired():
+            return QueryTimeoutError(
+                f'ESV API request exceeded the request\'s time budget of {deadline.budget} seconds')
+        return ServerOverwhelmedError('ESV API request timed out')
+
+    def add_translations(self, query_result: QueryResult, deadline: Optional[Deadline] = None) -> None:
+        self.add_translations_batch([query_result], deadline)
+
+    async def add_translations_async(self, query_result: QueryResult, deadline: Optional[Deadline] = None) -> None:
+        await self.add_translations_batch_async([query_result], deadline)
+
+    def add_translations_batch(self, query_results: List[QueryResult], deadline: Optional[Deadline] = None) -> None:
+        # All the query results' passages are requested together, so they share requests to the API
+        passages = [passage for query_result in query_results for passage in query_result.passages]
+        uncached_passages = self._add_cached_translations(query_results)
+        if not uncached_passages:
+            return
+
+        timeout = self._get_timeout(deadline)
+        try:
+            translations = self._event_loop.run(self._request_translations(uncached_passages), timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            raise self._timeout_error(deadline)
+        self._add_requested_translations(passages, uncached_passages, translations)
+
+    async def add_translations_batch_async(self, query_results: List[QueryResult],
+                                           deadline: Optional[Deadline] = None) -> None:
+        passages = [passage for query_result in query_results for passage in query_result.passages]
+        uncached_passages = self._add_cached_translations(query_results)
+        if not uncached_passages:
+            return
+
+        timeout = self._get_timeout(deadline)
+        try:
+            translations = await asyncio.wait_for(self._request_translations(uncached_passages), timeout=timeout)
+        except asyncio.TimeoutError:
+            raise self._timeout_error(deadline)
+        self._add_requested_translations(passages, uncached_passages, translations)
@@ -1,8 +1,50 @@
 import abc
+import asyncio
+from Deadline import Deadline
 from QueryResult import QueryResult
+from typing import List, Optional
 
 
 class TranslationProvider(abc.ABC):
     @abc.abstractmethod
-    def add_translations(self, query_result: QueryResult) -> None:
+    def add_translations(self, query_result: QueryResult, deadline: Optional[Deadline] = None) -> None:
+        """
+        :param deadline: If given, fetching translations gives up with a QueryTimeoutError once it has passed
+        """
         pass
+
+    async def add_translations_async(self, query_result: QueryResult, deadline: Optional[Deadline] = None) -> None:
+        """
+        Does the same as add_translations, for callers running on an event loop. By default, add_translations is run in
+        a thread so it doesn't block the loop; providers that can fetch translations asynchronously should override
+        this.
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self.add_translations, query_result, deadline)
+
+    def add_translations_batch(self, query_results: List[QueryResult], deadline: Optional[Deadline] = None) -> None:
+        """
+        Adds translations to several query results at once. By default, each one is translated in turn; providers that
+        can share requests between query results should override this.
+        """
+        for query_result in query_results:
+            self.add_translations(query_result, deadline)
+
+    async def add_translations_batch_async(self, query_results: List[QueryResult],
+                                           deadline: Optional[Deadline] = None) -> None:
+        """
+        Does the same as add_translations_batch, for callers running on an event loop
+        """
+        for query_result in query_results:
+            await self.add_translations_async(query_result, deadline)
+
+    def close(self) -> None:
+        """
+        Called in each worker process as it exits, to close anything (like connections to an API) left open
+        """
+        pass
+
+    async def close_async(self) -> None:
+        """
+        Does the same as close, for callers running on an event loop
+        """
+        self.close()
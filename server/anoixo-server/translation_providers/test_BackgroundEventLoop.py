@@ -0,0 +1,18 @@
+import asyncio
+import concurrent.futures
+import pytest
+from translation_providers.BackgroundEventLoop import BackgroundEventLoop
+
+
+def test_runs_coroutines_on_the_same_loop():
+    async def get_loop():
+        return asyncio.get_running_loop()
+    event_loop = BackgroundEventLoop()
+    assert event_loop.run(get_loop()) is event_loop.run(get_loop())
+
+
+def test_raises_and_cancels_on_timeout():
+    async def sleep_forever():
+        await asyncio.sleep(60)
+    with pytest.raises(concurrent.futures.TimeoutError):
+        BackgroundEventLoop().run(sleep_forever(), timeout=0.01)
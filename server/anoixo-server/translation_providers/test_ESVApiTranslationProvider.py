@@ -1,8 +1,13 @@
+import aiohttp
+import asyncio
 import pytest
 from unittest.mock import AsyncMock
 from typing import Callable, List
 from translation_providers.ESVApiTranslationProvider import ESVApiTranslationProvider
-from AnoixoError import ProbableBugError, ServerOverwhelmedError
+from AnoixoError import ProbableBugError, QueryTimeoutError, ServerOverwhelmedError
+from Deadline import Deadline
+from caching.MemoryCache import MemoryCache
+from Metrics import Metrics
 from QueryResult import QueryResult
 
 
@@ -28,7 +33,9 @@ def query_result_for_json(json: List) -> QueryResult:
 
 @pytest.fixture
 def esv_provider():
-    return ESVApiTranslationProvider()
+    esv_provider = ESVApiTranslationProvider()
+    yield esv_provider
+    esv_provider.close()
 
 
 def test_gets_translations_for_few_results(mocker, esv_provider: ESVApiTranslationProvider):
@@ -60,6 +67,15 @@ def test_requests_proper_endpoint(mocker, esv_provider: ESVApiTranslationProvide
     assert mock_get.call_args.args[0] == 'https://api.esv.org/v3/passage/text'
 
 
+def test_records_request_time(mocker):
+    metrics = Metrics()
+    esv_provider = ESVApiTranslationProvider(metrics=metrics)
+    mock_response(mocker, lambda: {'passages': ['text']})
+    esv_provider.add_translations(query_result_for_json([{'references': ['John.1.1'], 'words': []}]))
+    esv_provider.close()
+    assert 'anoixo_esv_request_seconds_count 1' in metrics.render().splitlines()
+
+
 def test_properly_formats_verse_query_string(mocker, esv_provider: ESVApiTranslationProvider):
     result = query_result_for_json([
         {
@@ -177,3 +193,164 @@ def test_handles_other_api_exceptions(mocker, esv_provider: ESVApiTranslationPro
     with pytest.raises(ServerOverwhelmedError) as excinfo:
         esv_provider.add_translations(result)
     assert excinfo.value.message == 'Error response from ESV API: 500 Internal Server Error'
+
+
+def test_caches_translations(mocker, esv_provider: ESVApiTranslationProvider):
+    mock_get = mock_response(mocker, lambda: {'passages': ['text of John.1.1']})
+    esv_provider.add_translations(query_result_for_json([{'references': ['John.1.1'], 'words': []}]))
+    result = query_result_for_json([{'references': ['John.1.1'], 'words': []}])
+    esv_provider.add_translations(result)
+    assert mock_get.call_count == 1
+    assert result.passages[0].translation == 'text of John.1.1'
+
+
+def test_only_requests_uncached_translations(mocker, esv_provider: ESVApiTranslationProvider):
+    mock_response(mocker, lambda: {'passages': ['text of John.1.1-John.1.2']})
+    esv_provider.add_translations(query_result_for_json([{'references': ['John.1.1', 'John.1.2'], 'words': []}]))
+
+    mock_get = mock_response(mocker, lambda: {'passages': ['text of Mark.1.1']})
+    result = query_result_for_json([
+        {'references': ['Mark.1.1'], 'words': []},
+        {'references': ['John.1.1', 'John.1.2'], 'words': []},
+    ])
+    esv_provider.add_translations(result)
+    assert mock_get.call_args.kwargs['params']['q'] == 'Mark.1.1'
+    assert result.passages[0].translation == 'text of Mark.1.1'
+    assert result.passages[1].translation == 'text of John.1.1-John.1.2'
+
+
+def test_translation_cache_is_limited_by_verse_count(mocker):
+    esv_provider = ESVApiTranslationProvider(MemoryCache(max_size=2))
+    mock_response(mocker, lambda: {'passages': ['text', 'text']})
+    esv_provider.add_translations(query_result_for_json([
+        {'references': ['John.1.1', 'John.1.2'], 'words': []},
+        {'references': ['Mark.1.1'], 'words': []},
+    ]))
+    assert esv_provider.cache.stats()['size'] == 1
+
+
+def test_reuses_session_between_requests(mocker, esv_provider: ESVApiTranslationProvider):
+    session_spy = mocker.spy(aiohttp.ClientSession, '__init__')
+    mock_response(mocker, lambda: {'passages': ['text']})
+    esv_provider.add_translations(query_result_for_json([{'references': ['John.1.1'], 'words': []}]))
+    esv_provider.add_translations(query_result_for_json([{'references': ['Mark.1.1'], 'words': []}]))
+    assert session_spy.call_count == 1
+    assert session_spy.call_args.kwargs['trust_env'] is True
+    assert session_spy.call_args.kwargs['raise_for_status'] is True
+
+
+def test_closes_session_replaced_for_another_loop(mocker, esv_provider: ESVApiTranslationProvider):
+    mock_response(mocker, lambda: {'passages': ['text']})
+    esv_provider.add_translations(query_result_for_json([{'references': ['John.1.1'], 'words': []}]))
+    background_session = esv_provider._session
+
+    async def add_translations():
+        await esv_provider.add_translations_async(query_result_for_json([{'references': ['Mark.1.1'], 'words': []}]))
+        await esv_provider.close_async()
+    asyncio.run(add_translations())
+    # the replaced session is closed on the background loop, without waiting for it
+    esv_provider._event_loop.run(asyncio.sleep(0.01))
+    assert background_session.closed
+    assert esv_provider._session.closed
+
+
+def test_close_closes_session(mocker, esv_provider: ESVApiTranslationProvider):
+    mock_response(mocker, lambda: {'passages': ['text']})
+    esv_provider.add_translations(query_result_for_json([{'references': ['John.1.1'], 'words': []}]))
+    esv_provider.close()
+    assert esv_provider._session.closed
+
+
+def test_handles_timeout(mocker, esv_provider: ESVApiTranslationProvider):
+    mocker.patch('app_constants.translation_timeout', 0.01)
+
+    async def hang(*args, **kwargs):
+        await asyncio.sleep(60)
+    mocker.patch('aiohttp.ClientSession.get', new=hang)
+
+    result = query_result_for_json([{'references': ['John.1.1'], 'words': []}])
+    with pytest.raises(ServerOverwhelmedError) as excinfo:
+        esv_provider.add_translations(result)
+    assert excinfo.value.message == 'ESV API request timed out'
+
+
+def test_adds_translations_on_running_event_loop(mocker, esv_provider: ESVApiTranslationProvider):
+    mock_get = mock_response(mocker, lambda: {'passages': ['text of John.1.1']})
+    result = query_result_for_json([{'references': ['John.1.1'], 'words': []}])
+    cached_result = query_result_for_json([{'references': ['John.1.1'], 'words': []}])
+
+    async def add_translations():
+        await esv_provider.add_translations_async(result)
+        await esv_provider.add_translations_async(cached_result)
+        await esv_provider.close_async()
+    asyncio.run(add_translations())
+    assert result.passages[0].translation == 'text of John.1.1'
+    assert cached_result.passages[0].translation == 'text of John.1.1'
+    assert mock_get.call_count == 1
+
+
+def test_handles_timeout_on_running_event_loop(mocker, esv_provider: ESVApiTranslationProvider):
+    mocker.patch('app_constants.translation_timeout', 0.01)
+
+    async def hang(*args, **kwargs):
+        await asyncio.sleep(60)
+    mocker.patch('aiohttp.ClientSession.get', new=hang)
+
+    async def add_translations():
+        try:
+            result = query_result_for_json([{'references': ['John.1.1'], 'words': []}])
+            await esv_provider.add_translations_async(result)
+        finally:
+            await esv_provider.close_async()
+    with pytest.raises(ServerOverwhelmedError) as excinfo:
+        asyncio.run(add_translations())
+    assert excinfo.value.message == 'ESV API request timed out'
+
+
+def test_gives_up_at_request_deadline(mocker, esv_provider: ESVApiTranslationProvider):
+    async def hang(*args, **kwargs):
+        await asyncio.sleep(60)
+    mocker.patch('aiohttp.ClientSession.get', new=hang)
+
+    result = query_result_for_json([{'references': ['John.1.1'], 'words': []}])
+    with pytest.raises(QueryTimeoutError) as excinfo:
+        esv_provider.add_translations(result, Deadline(0.01))
+    assert excinfo.value.message == 'ESV API request exceeded the request\'s time budget of 0.01 seconds'
+
+
+def test_does_not_request_translations_past_deadline(mocker, esv_provider: ESVApiTranslationProvider):
+    mock_get = mock_response(mocker, lambda: {'passages': ['text']})
+    with pytest.raises(QueryTimeoutError):
+        esv_provider.add_translations(query_result_for_json([{'references': ['John.1.1'], 'words': []}]), Deadline(0))
+    assert mock_get.call_count == 0
+
+
+def test_batch_shares_requests_between_query_results(mocker, esv_provider: ESVApiTranslationProvider):
+    mock_get = mock_response(mocker, lambda: {'passages': ['text of Mark.1.1', 'text of John.1.1']})
+    results = [
+        query_result_for_json([{'references': ['Mark.1.1'], 'words': []}]),
+        query_result_for_json([{'references': ['John.1.1'], 'words': []}, {'references': ['Mark.1.1'], 'words': []}]),
+    ]
+    esv_provider.add_translations_batch(results)
+    assert mock_get.call_count == 1
+    # verses already requested for an earlier query result aren't requested again
+    assert mock_get.call_args.kwargs['params']['q'] == 'Mark.1.1;John.1.1'
+    assert results[0].passages[0].translation == 'text of Mark.1.1'
+    assert results[1].passages[0].translation == 'text of John.1.1'
+    assert results[1].passages[1].translation == 'text of Mark.1.1'
+
+
+def test_batch_on_running_event_loop(mocker, esv_provider: ESVApiTranslationProvider):
+    mock_get = mock_response(mocker, lambda: {'passages': ['text of Mark.1.1', 'text of John.1.1']})
+    results = [
+        query_result_for_json([{'references': ['Mark.1.1'], 'words': []}]),
+        query_result_for_json([{'references': ['John.1.1'], 'words': []}]),
+    ]
+
+    async def add_translations():
+        await esv_provider.add_translations_batch_async(results)
+        await esv_provider._session.close()
+    asyncio.run(add_translations())
+    assert mock_get.call_count == 1
+    assert results[0].passages[0].translation == 'text of Mark.1.1'
+    assert results[1].passages[0].translation == 'text of John.1.1'